@@ -15,11 +15,14 @@ import cv2
 from ml.detect import detect_single_frame
 from ml.tools import process_boxes
 from ml.tools import display_numbers
+from ml.logger import setup_logging
 
 
 def main():
     """Main function."""
 
+    setup_logging()
+
     image = 'assets/zidane.jpeg'
     logo = 'assets/datlacuache_white.png'
     boxes, confidence, classes, names = detect_single_frame(image)
@@ -11,11 +11,14 @@
 # ============================================================================
 
 from ml.detect import detect_in_video
+from ml.logger import setup_logging
 
 
 def main():
     """Main function."""
 
+    setup_logging()
+
     video = 'assets/test.mp4'
     logo = 'assets/datlacuache_black.png'
     detect_in_video(video,
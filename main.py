@@ -11,11 +11,14 @@
 # ============================================================================
 
 from ml.track import object_tracking_in_video
+from ml.logger import setup_logging
 
 
 def main():
     """Main function."""
 
+    setup_logging()
+
     video = 'assets/clip.mp4'
     logo = 'assets/datlacuache_black.png'
 
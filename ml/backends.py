@@ -0,0 +1,560 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Inference backends.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from abc import ABC
+from abc import abstractmethod
+from time import perf_counter
+import ast
+import json
+import sys
+import os
+
+import numpy as np
+import cv2
+
+from ml.logger import get_logger
+from ml.logger import log_event
+
+
+logger = get_logger('backends')
+
+# Threads of the runtimes, see `set_threads`
+THREADS = {'intra_op': None, 'inter_op': None}
+
+# Same post-processing as the YOLOv5 hub model (AutoShape)
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.45
+MAX_DETECTIONS = 1000
+MAX_WH = 7680
+
+
+def set_threads(intra_op=None, inter_op=None):
+    """Sets the threads used by the inference runtimes.
+
+    The settings apply to the backends loaded afterwards and, right away,
+    to torch if it is already imported.
+
+    Parameters
+    ----------
+    intra_op : int
+        Threads used within an operator. None keeps the runtime default.
+    inter_op : int
+        Threads used to run independent operators in parallel (streams in
+        OpenVINO). None keeps the runtime default.
+    """
+
+    THREADS['intra_op'] = intra_op
+    THREADS['inter_op'] = inter_op
+
+    if 'torch' in sys.modules:
+        set_torch_threads(sys.modules['torch'])
+
+
+def set_torch_threads(torch):
+    """Applies the thread settings to torch."""
+
+    if THREADS['intra_op'] is not None:
+        torch.set_num_threads(THREADS['intra_op'])
+
+    if THREADS['inter_op'] is not None:
+        try:
+            torch.set_num_interop_threads(THREADS['inter_op'])
+        except RuntimeError:
+            # Only allowed before any inter-op parallel work has started
+            log_event(logger, 'interop_threads_not_set',
+                      threads=THREADS['inter_op'])
+
+
+def letterbox(image, shape, color=(114, 114, 114)):
+    """Resizes an image keeping its aspect ratio and pads it to a shape.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        HWC image.
+    shape : tuple
+        (height, width) of the padded image.
+    color : tuple
+        Color of the padding.
+
+    Returns
+    -------
+    numpy.ndarray
+        Padded image.
+    """
+
+    height, width = image.shape[:2]
+    ratio = min(shape[0] / height, shape[1] / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    dw, dh = (shape[1] - new_width) / 2, (shape[0] - new_height) / 2
+
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height),
+                           interpolation=cv2.INTER_LINEAR)
+
+    top, bottom = round(dh - 0.1), round(dh + 0.1)
+    left, right = round(dw - 0.1), round(dw + 0.1)
+
+    return cv2.copyMakeBorder(image, top, bottom, left, right,
+                              cv2.BORDER_CONSTANT, value=color)
+
+
+def nms(boxes, scores, iou_threshold):
+    """Greedy non-maximum suppression.
+
+    Parameters
+    ----------
+    boxes : numpy.ndarray
+        (N, 4) xyxy boxes.
+    scores : numpy.ndarray
+        (N,) scores.
+    iou_threshold : float
+        Boxes overlapping a kept one above this IoU are discarded.
+
+    Returns
+    -------
+    numpy.ndarray
+        Indices of the kept boxes, by decreasing score.
+    """
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+
+    while len(order):
+        index, order = order[0], order[1:]
+        keep.append(index)
+
+        xx1 = np.maximum(boxes[index, 0], boxes[order, 0])
+        yy1 = np.maximum(boxes[index, 1], boxes[order, 1])
+        xx2 = np.minimum(boxes[index, 2], boxes[order, 2])
+        yy2 = np.minimum(boxes[index, 3], boxes[order, 3])
+        inter = np.maximum(0., xx2 - xx1) * np.maximum(0., yy2 - yy1)
+        iou = inter / (areas[index] + areas[order] - inter)
+        order = order[iou <= iou_threshold]
+
+    return np.array(keep, dtype=int)
+
+
+def non_max_suppression(prediction,
+                        conf_threshold=CONF_THRESHOLD,
+                        iou_threshold=IOU_THRESHOLD,
+                        max_detections=MAX_DETECTIONS):
+    """YOLOv5 post-processing of the raw predictions of one image.
+
+    Parameters
+    ----------
+    prediction : numpy.ndarray
+        (N, 5 + classes) rows of center x, center y, width, height,
+        objectness and class scores.
+    conf_threshold : float
+        Minimum confidence.
+    iou_threshold : float
+        IoU threshold of the per-class NMS.
+    max_detections : int
+        Maximum number of detections.
+
+    Returns
+    -------
+    numpy.ndarray
+        (M, 6) rows of x1, y1, x2, y2, confidence and class.
+    """
+
+    prediction = prediction[prediction[:, 4] > conf_threshold]
+    scores = prediction[:, 5:] * prediction[:, 4:5]
+    classes = scores.argmax(1)
+    confidence = scores[np.arange(len(scores)), classes]
+
+    xy, wh = prediction[:, :2], prediction[:, 2:4] / 2
+    detections = np.concatenate((xy - wh, xy + wh, confidence[:, None],
+                                 classes[:, None]), axis=1)
+    detections = detections[confidence > conf_threshold]
+
+    # Offset the boxes by class so one NMS call keeps them apart
+    offsets = detections[:, 5:6] * MAX_WH
+    keep = nms(detections[:, :4] + offsets, detections[:, 4], iou_threshold)
+
+    return detections[keep[:max_detections]].astype(np.float32)
+
+
+def normalize_boxes(detections, input_shape, image_shape):
+    """Maps boxes from the letterboxed input to normalized image xyxy.
+
+    Parameters
+    ----------
+    detections : numpy.ndarray
+        (M, 6) detections in input pixels.
+    input_shape : tuple
+        (height, width) of the model input.
+    image_shape : tuple
+        (height, width) of the original image.
+
+    Returns
+    -------
+    numpy.ndarray
+        (M, 6) detections with boxes relative to the image size.
+    """
+
+    height, width = image_shape[:2]
+    gain = min(input_shape[0] / height, input_shape[1] / width)
+    pad_x = (input_shape[1] - width * gain) / 2
+    pad_y = (input_shape[0] - height * gain) / 2
+
+    detections = detections.copy()
+    detections[:, [0, 2]] = ((detections[:, [0, 2]] - pad_x) / gain).clip(
+        0, width) / width
+    detections[:, [1, 3]] = ((detections[:, [1, 3]] - pad_y) / gain).clip(
+        0, height) / height
+
+    return detections
+
+
+def read_image(path):
+    """Reads an image file in RGB, as the hub model does with paths.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+
+    Returns
+    -------
+    numpy.ndarray
+        HWC RGB image.
+    """
+
+    image = cv2.imread(path)
+
+    if image is None:
+        raise FileNotFoundError(f'Image {path} could not be read.')
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class Detections:
+    """Results of a backend, with the fields used from the hub results."""
+
+    def __init__(self, xyxyn, names, t):
+        """Class constructor.
+
+        Parameters
+        ----------
+        xyxyn : list
+            (M, 6) arrays of normalized x1, y1, x2, y2, confidence and
+            class, one per image.
+        names : dict
+            Class id -> name.
+        t : tuple
+            Preprocess, inference and NMS milliseconds per image.
+        """
+
+        self.xyxyn = xyxyn
+        self.names = names
+        self.t = t
+
+
+class Backend(ABC):
+    """YOLOv5 exported model behind the interface of the hub model.
+
+    Subclasses load the model and implement `forward`. Frames are used as
+    given (like the hub model does with arrays) and paths are read in RGB
+    (like the hub model does with PIL). Images are letterboxed to the input
+    shape of the model, and the raw predictions are post-processed as the
+    hub model does.
+    """
+
+    def __init__(self, path, device='cpu', precision='fp32'):
+        """Class constructor.
+
+        Parameters
+        ----------
+        path : str
+            Path to the exported model.
+        device : str
+            Device for inference.
+        precision : str
+            Model precision.
+        """
+
+        self.path = path
+        self.device = device
+        self.precision = precision
+        self.names = {}
+        self.shape = None
+        self.batch_size = None
+
+    @abstractmethod
+    def forward(self, batch):
+        """Runs the model.
+
+        Parameters
+        ----------
+        batch : numpy.ndarray
+            (N, 3, H, W) float32 images in [0, 1].
+
+        Returns
+        -------
+        numpy.ndarray
+            (N, boxes, 5 + classes) raw predictions.
+        """
+
+    def __call__(self, images, size=640):
+        """Detects objects in a list of images.
+
+        Parameters
+        ----------
+        images : list or numpy.ndarray
+            Image, path to an image, or list of them.
+        size : int
+            Input size, used if the model does not fix it.
+
+        Returns
+        -------
+        Detections
+            Detections of every image.
+        """
+
+        if not isinstance(images, list):
+            images = [images]
+
+        images = [read_image(image) if isinstance(image, str) else image
+                  for image in images]
+        shape = self.shape or (size, size)
+
+        start = perf_counter()
+        batch = np.stack([letterbox(image, shape) for image in images])
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2),
+                                     dtype=np.float32) / 255.
+        preprocessed = perf_counter()
+
+        # Models exported with a static batch run one image at a time
+        step = self.batch_size or len(batch)
+        prediction = np.concatenate([self.forward(batch[index:index + step])
+                                     for index in range(0, len(batch), step)])
+        inferred = perf_counter()
+
+        xyxyn = [normalize_boxes(non_max_suppression(pred), shape,
+                                 image.shape)
+                 for pred, image in zip(prediction, images)]
+        end = perf_counter()
+
+        t = tuple((b - a) * 1000 / len(images)
+                  for a, b in ((start, preprocessed), (preprocessed, inferred),
+                               (inferred, end)))
+
+        return Detections(xyxyn, self.names, t)
+
+
+class TorchScriptBackend(Backend):
+    """TorchScript model exported by YOLOv5 ('.torchscript')."""
+
+    def __init__(self, path, device='cpu', precision='fp32'):
+        super().__init__(path, device, precision)
+
+        import torch
+
+        if precision == 'fp16' and device == 'cpu':
+            raise ValueError('TorchScript fp16 needs a GPU device.')
+
+        if precision not in ['fp32', 'fp16']:
+            raise ValueError(f'TorchScript does not support {precision}.')
+
+        set_torch_threads(torch)
+        extra_files = {'config.txt': ''}
+        self.torch = torch
+        self.model = torch.jit.load(path, map_location=device,
+                                    _extra_files=extra_files)
+        self.model.eval()
+
+        if precision == 'fp16':
+            self.model.half()
+
+        if extra_files['config.txt']:
+            config = json.loads(extra_files['config.txt'])
+            self.names = {int(key): value
+                          for key, value in config['names'].items()}
+            self.shape = tuple(config['shape'][2:])
+
+    def forward(self, batch):
+        batch = self.torch.from_numpy(batch).to(self.device)
+
+        if self.precision == 'fp16':
+            batch = batch.half()
+
+        with self.torch.no_grad():
+            prediction = self.model(batch)
+
+        if isinstance(prediction, (list, tuple)):
+            prediction = prediction[0]
+
+        return prediction.float().cpu().numpy()
+
+
+class OnnxBackend(Backend):
+    """ONNX model exported by YOLOv5 ('.onnx'), run with ONNX Runtime.
+
+    With 'int8' precision, a dynamically quantized copy of the model is
+    created next to it (see `quantize_onnx`) and used instead.
+    """
+
+    def __init__(self, path, device='cpu', precision='fp32'):
+        super().__init__(path, device, precision)
+
+        import onnxruntime
+
+        if precision not in ['fp32', 'int8']:
+            raise ValueError(f'ONNX Runtime does not support {precision}.')
+
+        if precision == 'int8':
+            path = quantize_onnx(path)
+
+        options = onnxruntime.SessionOptions()
+
+        if THREADS['intra_op'] is not None:
+            options.intra_op_num_threads = THREADS['intra_op']
+
+        if THREADS['inter_op'] is not None:
+            options.inter_op_num_threads = THREADS['inter_op']
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+
+        providers = ['CPUExecutionProvider']
+
+        if device != 'cpu':
+            providers.insert(0, 'CUDAExecutionProvider')
+
+        self.session = onnxruntime.InferenceSession(path, options,
+                                                    providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+        batch_size, _, *shape = self.session.get_inputs()[0].shape
+
+        if all(isinstance(value, int) for value in shape):
+            self.shape = tuple(shape)
+
+        if isinstance(batch_size, int):
+            self.batch_size = batch_size
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+
+        if 'names' in metadata:
+            self.names = ast.literal_eval(metadata['names'])
+
+    def forward(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class OpenVINOBackend(Backend):
+    """OpenVINO model exported by YOLOv5 (the '.xml' file)."""
+
+    def __init__(self, path, device='cpu', precision='fp32'):
+        super().__init__(path, device, precision)
+
+        import openvino
+        import yaml
+
+        if precision not in ['fp32', 'fp16']:
+            raise ValueError(f'OpenVINO does not support {precision}.')
+
+        config = {}
+
+        if THREADS['intra_op'] is not None:
+            config['INFERENCE_NUM_THREADS'] = str(THREADS['intra_op'])
+
+        if THREADS['inter_op'] is not None:
+            config['NUM_STREAMS'] = str(THREADS['inter_op'])
+
+        if precision == 'fp16':
+            config['INFERENCE_PRECISION_HINT'] = 'f16'
+
+        core = openvino.Core()
+        model = core.read_model(path)
+        self.model = core.compile_model(model, 'CPU', config)
+
+        batch_size, _, *shape = self.model.inputs[0].get_partial_shape()
+
+        if all(value.is_static for value in shape):
+            self.shape = tuple(value.get_length() for value in shape)
+
+        if batch_size.is_static:
+            self.batch_size = batch_size.get_length()
+
+        metadata = os.path.splitext(path)[0] + '.yaml'
+
+        if os.path.isfile(metadata):
+            with open(metadata) as metadata_file:
+                self.names = yaml.safe_load(metadata_file)['names']
+
+    def forward(self, batch):
+        return self.model(batch)[self.model.outputs[0]]
+
+
+BACKENDS = {'.torchscript': TorchScriptBackend,
+            '.onnx': OnnxBackend,
+            '.xml': OpenVINOBackend}
+
+
+def load_backend(path, device='cpu', precision='fp32'):
+    """Loads an exported model with its backend.
+
+    Parameters
+    ----------
+    path : str
+        Path to the exported model. The backend is chosen by its extension,
+        one of `BACKENDS`.
+    device : str
+        Device for inference.
+    precision : str
+        Model precision.
+
+    Returns
+    -------
+    Backend
+        Loaded model.
+    """
+
+    extension = os.path.splitext(path)[1]
+
+    if extension not in BACKENDS:
+        raise ValueError(f'No backend for {path}. Use one of '
+                         f'{list(BACKENDS)}.')
+
+    return BACKENDS[extension](path, device, precision)
+
+
+def quantize_onnx(path, output_path=None):
+    """Dynamically quantizes the weights of an ONNX model to int8.
+
+    Parameters
+    ----------
+    path : str
+        Path to the ONNX model.
+    output_path : str
+        Path to the quantized model. Defaults to '<name>-int8.onnx' next to
+        the model. It is only created if it does not exist.
+
+    Returns
+    -------
+    str
+        Path to the quantized model.
+    """
+
+    from onnxruntime.quantization import QuantType
+    from onnxruntime.quantization import quantize_dynamic
+
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + '-int8.onnx'
+
+    if not os.path.exists(output_path):
+        log_event(logger, 'quantizing_model', model=path, output=output_path)
+        quantize_dynamic(path, output_path, weight_type=QuantType.QUInt8)
+
+    return output_path
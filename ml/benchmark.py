@@ -0,0 +1,225 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Benchmarks.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from itertools import product
+from time import perf_counter
+import subprocess
+import argparse
+import json
+import sys
+
+import numpy as np
+import cv2
+
+
+# Cold start of a fresh interpreter, timed phase by phase
+STARTUP_SCRIPT = '''
+from time import perf_counter
+import json
+import sys
+
+version = sys.argv[1] or None
+start = perf_counter()
+from ml.detect import detect_single_frame
+from ml.registry import get_model
+imported = perf_counter()
+get_model(version)
+loaded = perf_counter()
+detect_single_frame(sys.argv[2], version)
+first = perf_counter()
+detect_single_frame(sys.argv[2], version)
+second = perf_counter()
+
+print(json.dumps({'import_s': imported - start,
+                  'load_s': loaded - imported,
+                  'first_inference_s': first - loaded,
+                  'inference_s': second - first}))
+'''
+
+
+def startup(version=None, image='assets/zidane.jpeg', repeat=3):
+    """Measures the cold start of detection in fresh processes.
+
+    Parameters
+    ----------
+    version : str
+        Model version, or path to a model file.
+    image : str
+        Path to the image to detect.
+    repeat : int
+        Number of processes to run.
+
+    Returns
+    -------
+    dict
+        Median seconds of each phase: importing the detection module,
+        loading the model, the first and the second inference, and the
+        whole process.
+    """
+
+    runs = []
+
+    for _ in range(repeat):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT,
+                                 version or '', image],
+                                capture_output=True, text=True)
+
+        if output.returncode:
+            raise RuntimeError(f'Startup benchmark failed:\n{output.stderr}')
+
+        run = json.loads(output.stdout.strip().splitlines()[-1])
+        run['process_s'] = perf_counter() - start
+        runs.append(run)
+
+    return {phase: float(np.median([run[phase] for run in runs]))
+            for phase in runs[0]}
+
+
+def backends(models,
+             images=('assets/zidane.jpeg', 'assets/perritos.png'),
+             precisions=('fp32',),
+             repeat=10,
+             batch_size=1,
+             intra_op=None,
+             inter_op=None):
+    """Compares the latency of models and backends on a set of images.
+
+    Parameters
+    ----------
+    models : list
+        Model versions or files. Exported models run with their backend
+        (see ml.backends).
+    images : list
+        Paths to the images.
+    precisions : list
+        Precisions to try with every model. Unsupported combinations are
+        reported with their error.
+    repeat : int
+        Number of timed runs over the images, after one warm-up run.
+    batch_size : int
+        Number of images per forward pass.
+    intra_op : int
+        Threads within an operator.
+    inter_op : int
+        Threads across operators.
+
+    Returns
+    -------
+    list
+        One dict per model and precision with the milliseconds per image
+        (mean and percentiles) and the number of detections, or the error.
+    """
+
+    from ml.backends import set_threads
+    from ml.detect import detect_batch
+    from ml.registry import unload_model
+
+    set_threads(intra_op, inter_op)
+    frames = [cv2.imread(image) for image in images]
+    results = []
+
+    for model, precision in product(models, precisions):
+        result = {'model': model, 'precision': precision}
+        results.append(result)
+
+        try:
+            detections = detect_batch(frames, model, batch_size, 'cpu',
+                                      precision)
+        except (ValueError, ImportError) as error:
+            result['error'] = str(error)
+            continue
+
+        times = []
+
+        for _ in range(repeat):
+            start = perf_counter()
+            detect_batch(frames, model, batch_size, 'cpu', precision)
+            times.append((perf_counter() - start) * 1000 / len(frames))
+
+        result['mean_ms'] = float(np.mean(times))
+        result['p50_ms'] = float(np.median(times))
+        result['p90_ms'] = float(np.quantile(times, 0.9))
+        result['detections'] = sum(len(boxes) for boxes, *_ in detections)
+        unload_model(model, 'cpu', precision)
+
+    return results
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(description='Datlacuache benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_startup = subparsers.add_parser(
+        'startup', help='Cold start of detection in fresh processes.')
+    parser_startup.add_argument('--version', help='Model version or file.',
+                                type=str, default=None)
+    parser_startup.add_argument('--image', help='Image to detect.', type=str,
+                                default='assets/zidane.jpeg')
+    parser_startup.add_argument('--repeat', help='Number of processes.',
+                                type=int, default=3)
+
+    parser_backends = subparsers.add_parser(
+        'backends', help='Latency of models and backends on images.')
+    parser_backends.add_argument('--models', help='Model versions or files.',
+                                 type=str, nargs='+', required=True)
+    parser_backends.add_argument('--images', help='Images to detect.',
+                                 type=str, nargs='+',
+                                 default=['assets/zidane.jpeg',
+                                          'assets/perritos.png'])
+    parser_backends.add_argument('--precisions', help='Model precisions.',
+                                 type=str, nargs='+', default=['fp32'])
+    parser_backends.add_argument('--repeat', help='Number of timed runs.',
+                                 type=int, default=10)
+    parser_backends.add_argument('--batch_size', help='Images per pass.',
+                                 type=int, default=1)
+    parser_backends.add_argument('--intra_op', help='Intra-op threads.',
+                                 type=int, default=None)
+    parser_backends.add_argument('--inter_op', help='Inter-op threads.',
+                                 type=int, default=None)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Main function."""
+
+    args = parse_args()
+
+    if args.benchmark == 'startup':
+        results = startup(args.version, args.image, args.repeat)
+
+        for phase, seconds in results.items():
+            print(f'{phase:>20} {seconds:>10.3f}')
+
+    if args.benchmark == 'backends':
+        results = backends(args.models, args.images, args.precisions,
+                           args.repeat, args.batch_size, args.intra_op,
+                           args.inter_op)
+
+        print(f'{"model":>30} {"precision":>9} {"mean_ms":>9} '
+              f'{"p50_ms":>9} {"p90_ms":>9} {"detections":>10}')
+        for result in results:
+            if 'error' in result:
+                print(f'{result["model"]:>30} {result["precision"]:>9}  '
+                      f'{result["error"]}')
+                continue
+
+            print(f'{result["model"]:>30} {result["precision"]:>9} '
+                  f'{result["mean_ms"]:>9.2f} {result["p50_ms"]:>9.2f} '
+                  f'{result["p90_ms"]:>9.2f} {result["detections"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Detection cache.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from hashlib import sha1
+import shutil
+import json
+import os
+
+import numpy as np
+
+
+COLUMNS = ['offsets', 'detected', 'boxes', 'confidence', 'classes']
+
+
+def video_hash(video_path, chunk_size=1 << 20):
+    """Hashes a video from its size and its first and last chunks.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to video.
+    chunk_size : int
+        Number of bytes read from each end of the file.
+
+    Returns
+    -------
+    str
+        Hex digest.
+    """
+
+    size = os.path.getsize(video_path)
+    digest = sha1(str(size).encode())
+
+    with open(video_path, 'rb') as video_file:
+        digest.update(video_file.read(chunk_size))
+        video_file.seek(max(size - chunk_size, 0))
+        digest.update(video_file.read(chunk_size))
+
+    return digest.hexdigest()
+
+
+def cache_path(video_path,
+               version,
+               size,
+               cache_dir,
+               roi=None,
+               detection_stride=1,
+               max_stride=None,
+               motion_gate=None):
+    """Path of the detection cache of a video.
+
+    Every setting that changes which frames are detected, or how, is part of
+    the key, so a cache is only replayed by runs with the same settings.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to video.
+    version : str
+        Model version, or path to a model file.
+    size : int
+        Model input size.
+    cache_dir : str
+        Directory of the detection caches.
+    roi : RegionOfInterest
+        Region of interest the detections were restricted to.
+    detection_stride : int
+        Stride of the detector.
+    max_stride : int
+        Adaptive stride of the detector.
+    motion_gate : MotionGate
+        Motion gate that skipped the detector on static frames.
+
+    Returns
+    -------
+    str
+        Path to the cache directory of the video.
+    """
+
+    model = os.path.basename(version)
+
+    # Model files with the same name (e.g. 'best.pt' of two training runs)
+    # are told apart by their contents
+    if os.path.isfile(version):
+        model += f'-{video_hash(version)[:12]}'
+
+    key = f'{video_hash(video_path)}_{model}_{size}'
+    key += f'_s{detection_stride}-{max_stride or detection_stride}'
+
+    if roi is not None:
+        key += f'_roi{roi.key()}'
+
+    if motion_gate is not None:
+        key += f'_gate{motion_gate.key()}'
+
+    return os.path.join(cache_dir, key)
+
+
+def names_dict(names):
+    """Class names as a dict of class id -> name.
+
+    Parameters
+    ----------
+    names : dict or list
+        Class names.
+
+    Returns
+    -------
+    dict
+        Class names by class id.
+    """
+
+    if isinstance(names, dict):
+        return {int(index): name for index, name in names.items()}
+
+    return dict(enumerate(names))
+
+
+class DetectionCache:
+    """Per-frame detections stored as memory-mapped columns.
+
+    Boxes, confidences and classes of every frame are concatenated in
+    columnar .npy files, and `offsets[i]:offsets[i + 1]` indexes the rows of
+    frame `i`. Frames the detector skipped are flagged in `detected`.
+    """
+
+    def __init__(self, path):
+        """Class constructor.
+
+        Parameters
+        ----------
+        path : str
+            Path to the cache directory.
+        """
+
+        self.path = path
+
+        for column in COLUMNS:
+            column_path = os.path.join(path, f'{column}.npy')
+            setattr(self, column, np.load(column_path, mmap_mode='r'))
+
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.names = names_dict(self.meta['names'])
+
+    def __len__(self):
+        return len(self.detected)
+
+    def __getitem__(self, index):
+        """Detections of a frame.
+
+        Parameters
+        ----------
+        index : int
+            Frame index.
+
+        Returns
+        -------
+        tuple
+            (boxes, confidence, classes, names), all None if the detector
+            skipped the frame.
+        """
+
+        if not self.detected[index]:
+            return None, None, None, None
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return (self.boxes[start:end], self.confidence[start:end],
+                self.classes[start:end], self.names)
+
+    def frames(self, batch_size=1, start=0):
+        """Replays the frames without decoding the video.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of frames per group.
+        start : int
+            Index of the first frame.
+
+        Yields
+        ------
+        list
+            List of (None, detect) tuples, as `read_strided_frames`.
+        """
+
+        for index in range(start, len(self), batch_size):
+            detected = self.detected[index:index + batch_size]
+            yield [(None, bool(detect)) for detect in detected]
+
+
+class DetectionCacheWriter:
+    """Streams per-frame detections to disk and saves them as a cache.
+
+    The columns are appended to raw files in a temporary directory every
+    `chunk_size` frames, so memory does not grow with the length of the
+    video. `save` writes the offsets of the frames and turns the raw files
+    into the columns of a `DetectionCache`.
+    """
+
+    DTYPES = {'detected': np.bool_,
+              'lengths': np.int64,
+              'boxes': np.float32,
+              'confidence': np.float32,
+              'classes': np.int16}
+
+    def __init__(self, path, meta=None, chunk_size=1024):
+        """Class constructor.
+
+        Parameters
+        ----------
+        path : str
+            Path to the cache directory.
+        meta : dict
+            Extra metadata to save with the cache.
+        chunk_size : int
+            Number of frames kept in memory between writes.
+        """
+
+        self.path = path
+        self.meta = dict(meta or {})
+        self.chunk_size = chunk_size
+        self.names = []
+        self.frames = 0
+        self.rows = 0
+        self.chunk = {column: [] for column in self.DTYPES}
+
+        # Left over by an interrupted run
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def raw_path(self, column):
+        """Path to the raw file of a column."""
+
+        return os.path.join(self.tmp_path, f'{column}.bin')
+
+    def append(self, results):
+        """Adds the detections of the next frame.
+
+        Parameters
+        ----------
+        results : tuple
+            (boxes, confidence, classes, names), or None values if the
+            detector skipped the frame.
+        """
+
+        boxes, confidence, classes, names = results
+        chunk = self.chunk
+        chunk['detected'].append(boxes is not None)
+
+        if boxes is None:
+            chunk['lengths'].append(0)
+        else:
+            self.names = names
+            chunk['lengths'].append(len(confidence))
+            chunk['boxes'].append(np.asarray(boxes, dtype=np.float32))
+            chunk['confidence'].append(
+                np.asarray(confidence, dtype=np.float32))
+            chunk['classes'].append(np.asarray(classes).astype(np.int16))
+            self.rows += len(confidence)
+
+        self.frames += 1
+
+        if len(chunk['detected']) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Appends the frames in memory to the raw files."""
+
+        for column, values in self.chunk.items():
+            if not values:
+                continue
+
+            if column in ('detected', 'lengths'):
+                values = np.array(values, dtype=self.DTYPES[column])
+            else:
+                values = np.concatenate(values)
+
+            with open(self.raw_path(column), 'ab') as raw_file:
+                values.tofile(raw_file)
+
+            self.chunk[column] = []
+
+    def save(self):
+        """Saves the cache, replacing the directory atomically.
+
+        Returns
+        -------
+        DetectionCache
+            Saved cache.
+        """
+
+        self.flush()
+
+        # The offset index, from the number of rows of each frame
+        lengths = np.empty(0, dtype=np.int64)
+        if self.frames:
+            lengths = np.fromfile(self.raw_path('lengths'), dtype=np.int64)
+            os.remove(self.raw_path('lengths'))
+
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        np.save(os.path.join(self.tmp_path, 'offsets.npy'), offsets)
+
+        shapes = {'detected': (self.frames,),
+                  'boxes': (self.rows, 4),
+                  'confidence': (self.rows,),
+                  'classes': (self.rows,)}
+
+        for column, shape in shapes.items():
+            raw_to_npy(self.raw_path(column),
+                       os.path.join(self.tmp_path, f'{column}.npy'),
+                       self.DTYPES[column], shape)
+
+        meta = dict(self.meta,
+                    names=names_dict(self.names),
+                    frames=self.frames)
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+        return DetectionCache(self.path)
+
+
+def raw_to_npy(raw_path, npy_path, dtype, shape):
+    """Turns a raw file into a .npy file, without loading it in memory.
+
+    Parameters
+    ----------
+    raw_path : str
+        Path to the raw file, removed afterwards. It may not exist if the
+        array is empty.
+    npy_path : str
+        Path to the .npy file.
+    dtype : numpy.dtype
+        Type of the values.
+    shape : tuple
+        Shape of the array.
+    """
+
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+              'fortran_order': False,
+              'shape': shape}
+
+    with open(npy_path, 'wb') as npy_file:
+        np.lib.format.write_array_header_1_0(npy_file, header)
+
+        if os.path.exists(raw_path):
+            with open(raw_path, 'rb') as raw_file:
+                shutil.copyfileobj(raw_file, npy_file)
+
+            os.remove(raw_path)
@@ -0,0 +1,173 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tracking checkpoints.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import pickle
+import json
+import os
+
+from ml.logger import get_logger
+from ml.logger import log_event
+
+
+logger = get_logger('checkpoint')
+
+CHECKPOINT_VERSION = 2
+
+
+def snapshot(state):
+    """Serializes a tracking state, so later changes do not alter it.
+
+    Parameters
+    ----------
+    state : dict
+        Tracking state: the Sort tracker, trackable objects, counts and the
+        index of the next frame to process, among others.
+
+    Returns
+    -------
+    bytes
+        Serialized state.
+    """
+
+    state = dict(state, version=CHECKPOINT_VERSION)
+
+    return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def save_checkpoint(path, data):
+    """Writes a serialized state, replacing the checkpoint atomically.
+
+    Parameters
+    ----------
+    path : str
+        Path to the checkpoint.
+    data : bytes
+        State serialized by `snapshot`.
+    """
+
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as checkpoint_file:
+        checkpoint_file.write(data)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """Loads a checkpoint, if there is one.
+
+    Parameters
+    ----------
+    path : str
+        Path to the checkpoint.
+
+    Returns
+    -------
+    dict
+        Tracking state, or None if the checkpoint does not exist.
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as checkpoint_file:
+        state = pickle.load(checkpoint_file)
+
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f'Checkpoint {path} has version '
+                         f'{state.get("version")}, expected '
+                         f'{CHECKPOINT_VERSION}.')
+
+    log_event(logger, 'checkpoint_loaded', path=path,
+              frame=state['frame_index'])
+
+    return state
+
+
+class RecordLog:
+    """Records appended to a JSON-lines file next to a checkpoint.
+
+    The records of finished tracks only grow, so checkpoints store the size
+    of the file instead of the records, and each checkpoint costs the same
+    however far into the video it is taken.
+    """
+
+    def __init__(self, path, offset=None):
+        """Class constructor.
+
+        Parameters
+        ----------
+        path : str
+            Path to the records file.
+        offset : int
+            Size of the file as of the checkpoint being resumed. Records
+            written after it are dropped. If None, the file starts empty.
+        """
+
+        self.path = path
+
+        if offset is None:
+            self.file = open(path, 'w')
+            return
+
+        if not os.path.exists(path) or os.path.getsize(path) < offset:
+            raise ValueError(f'Records {path} are behind their checkpoint.')
+
+        os.truncate(path, offset)
+        self.file = open(path, 'a')
+
+    def append(self, record):
+        """Appends a record.
+
+        Parameters
+        ----------
+        record : dict
+            JSON serializable record.
+        """
+
+        self.file.write(json.dumps(record) + '\n')
+
+    def offset(self):
+        """Size of the file, once its records are on disk.
+
+        Returns
+        -------
+        int
+            Size of the file in bytes.
+        """
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        return self.file.tell()
+
+    def read(self):
+        """Reads back every record.
+
+        Returns
+        -------
+        list
+            Records, in the order they were appended.
+        """
+
+        self.file.flush()
+
+        with open(self.path) as records_file:
+            return [json.loads(line) for line in records_file]
+
+    def remove(self):
+        """Closes and removes the file."""
+
+        self.file.close()
+        os.remove(self.path)
@@ -10,16 +10,30 @@
 # according to the license provided and its conditions.
 # ============================================================================
 
+from time import perf_counter
 from time import time
+import logging
 
 from tqdm import tqdm
-import torch
+import numpy as np
 import cv2
 
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.metrics import metrics
+from ml.pipeline import Pipeline
+from ml.registry import get_model
 from ml.tools import process_boxes
 
 
-def detect_single_frame(frame, version=None):
+logger = get_logger('detect')
+
+
+def detect_single_frame(frame,
+                        version=None,
+                        device=None,
+                        precision='fp32',
+                        roi=None):
     """Detects from batch of images.
 
     Parameters
@@ -27,7 +41,13 @@ def detect_single_frame(frame, version=None):
     frame : numpy.ndarray
         Image.
     version : str
-        Model version.
+        Model version, or path to a model file.
+    device : str
+        Device for inference. Defaults to GPU if available.
+    precision : str
+        Model precision, 'fp32', 'fp16' or 'int8'.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frame are detected.
 
     Returns
     -------
@@ -41,35 +61,25 @@ def detect_single_frame(frame, version=None):
         Names.
     """
 
-    if version is None:
-        msg = '[INFO] Version not specified. '
-        msg += 'Version \'yolov5m\' will be used by default.'
-        print(msg)
-
-        version = 'yolov5m'
-
-    if version not in ['yolov5s', 'yolov5m', 'yolov5l', 'yolov5x']:
-        msg = f'[INFO] Version {version} is not supported. '
-        msg += 'Version \'yolov5m\' will be used by default.'
-        print(msg)
+    if roi is not None:
+        return detect_batch([frame], version, 1, device, precision,
+                            roi=roi)[0]
 
-        version = 'yolov5m'
+    model = get_model(version, device, precision)
 
-    model = torch.hub.load('ultralytics/yolov5', version)
-
-    print('[INFO] Detecting from frame/image')
     start = time()
 
+    called = perf_counter()
     results = model(frame)
+    record_model_times(results, 1, perf_counter() - called)
     names = results.names
 
-    if torch.cuda.device_count():
-        results = results.xyxyn[0].cpu().numpy()
-    else:
-        results = results.xyxyn[0].numpy()
+    with metrics.time('to_numpy'):
+        results = to_numpy(results.xyxyn[0])
 
     end = time()
-    print(f'[INFO] Image processed in {(end - start) * 1000:.3f} ms.')
+    log_event(logger, 'frame_detected', logging.DEBUG,
+              ms=round((end - start) * 1000, 3))
 
     boxes = results[:, :4]
     confidence = results[:, 4]
@@ -78,6 +88,313 @@ def detect_single_frame(frame, version=None):
     return boxes, confidence, classes, names
 
 
+def detect_batch(frames,
+                 version=None,
+                 batch_size=8,
+                 device=None,
+                 precision='fp32',
+                 size=640,
+                 roi=None):
+    """Detects from a list of frames, running them in batches.
+
+    Parameters
+    ----------
+    frames : list
+        List of images (numpy.ndarray).
+    version : str
+        Model version, or path to a model file.
+    batch_size : int
+        Number of frames per forward pass.
+    device : str
+        Device for inference. Defaults to GPU if available.
+    precision : str
+        Model precision, 'fp32', 'fp16' or 'int8'.
+    size : int
+        Model input size.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frames are detected. The
+        crops of `batch_size` frames run in one forward pass, and their
+        boxes are merged back into frame coordinates.
+
+    Returns
+    -------
+    list
+        List of (boxes, confidence, classes, names) tuples, one per frame
+        and in the same order as `frames`.
+    """
+
+    if roi is not None:
+        return detect_regions(frames, roi, version, batch_size, device,
+                              precision, size)
+
+    model = get_model(version, device, precision)
+    detections = []
+
+    for index in range(0, len(frames), batch_size):
+        batch = list(frames[index:index + batch_size])
+
+        start = time()
+
+        called = perf_counter()
+        results = model(batch, size=size)
+        record_model_times(results, len(batch), perf_counter() - called)
+        names = results.names
+
+        with metrics.time('to_numpy'):
+            for xyxyn in results.xyxyn:
+                xyxyn = to_numpy(xyxyn)
+                detections.append((xyxyn[:, :4], xyxyn[:, 4], xyxyn[:, 5],
+                                   names))
+
+        end = time()
+        log_event(logger, 'batch_detected', logging.DEBUG,
+                  frames=len(batch), ms=round((end - start) * 1000, 3))
+
+    return detections
+
+
+def detect_regions(frames,
+                   roi,
+                   version=None,
+                   batch_size=8,
+                   device=None,
+                   precision='fp32',
+                   size=640):
+    """Detects in the regions of interest of a list of frames.
+
+    Parameters
+    ----------
+    frames : list
+        List of images (numpy.ndarray).
+    roi : RegionOfInterest or list
+        Crops or tiles to detect, or a list with the region of each frame,
+        where None detects the whole frame.
+    version : str
+        Model version, or path to a model file.
+    batch_size : int
+        Number of frames whose crops run in one forward pass.
+    device : str
+        Device for inference. Defaults to GPU if available.
+    precision : str
+        Model precision, 'fp32', 'fp16' or 'int8'.
+    size : int
+        Model input size.
+
+    Returns
+    -------
+    list
+        List of (boxes, confidence, classes, names) tuples, one per frame
+        and in the same order as `frames`, with boxes relative to the frame.
+    """
+
+    rois = roi if isinstance(roi, list) else [roi] * len(frames)
+
+    with metrics.time('roi'):
+        crops = [[frame] if roi is None else roi.crop(frame)
+                 for frame, roi in zip(frames, rois)]
+
+    n_crops = max([len(frame_crops) for frame_crops in crops] + [1])
+    detections = iter(detect_batch([crop for frame_crops in crops
+                                    for crop in frame_crops],
+                                   version, batch_size * n_crops, device,
+                                   precision, size))
+    results = []
+
+    with metrics.time('roi'):
+        for frame, frame_crops, roi in zip(frames, crops, rois):
+            height, width = frame.shape[:2]
+            frame_detections = [next(detections) for _ in frame_crops]
+            results.append(frame_detections[0] if roi is None else
+                           roi.merge(frame_detections, (width, height)))
+
+    return results
+
+
+def to_numpy(detections):
+    """Detections of an image as a NumPy array.
+
+    Parameters
+    ----------
+    detections : torch.Tensor or numpy.ndarray
+        Detections of the hub model (tensor) or of a backend (array).
+
+    Returns
+    -------
+    numpy.ndarray
+        Detections.
+    """
+
+    if isinstance(detections, np.ndarray):
+        return detections
+
+    return detections.cpu().numpy()
+
+
+def record_model_times(results, n_images, seconds):
+    """Records the preprocess, inference and NMS times of a model call.
+
+    Only the forward pass is recorded as 'inference', so the stages do not
+    overlap. Models that do not report their times are recorded as a whole.
+
+    Parameters
+    ----------
+    results : models.common.Detections
+        YOLOv5 results, with per-image (preprocess, inference, NMS)
+        milliseconds in `t` when available.
+    n_images : int
+        Number of images in the call.
+    seconds : float
+        Duration of the whole call.
+    """
+
+    if not metrics.enabled:
+        return
+
+    times = getattr(results, 't', None)
+
+    if times is None:
+        metrics.record('inference', seconds)
+        return
+
+    metrics.record('preprocess', times[0] * n_images / 1000)
+    metrics.record('inference', times[1] * n_images / 1000)
+    metrics.record('nms', times[2] * n_images / 1000)
+
+
+def seek_frame(vid, frame_index):
+    """Moves a video capture to a frame, checking where it landed.
+
+    Seeking is frame accurate for intra-frame codecs (MJPEG) and most
+    containers with an index, but some backends land on a nearby keyframe
+    or ignore the request. The position is checked after seeking, and on a
+    mismatch the video is read from the start up to the frame instead.
+
+    Parameters
+    ----------
+    vid : cv2.VideoCapture
+        Video capture.
+    frame_index : int
+        Index of the next frame to read.
+    """
+
+    vid.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    position = int(vid.get(cv2.CAP_PROP_POS_FRAMES))
+
+    if position == frame_index:
+        return
+
+    log_event(logger, 'seek_mismatch', logging.WARNING,
+              requested=frame_index, position=position)
+
+    vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    position = 0
+
+    with metrics.time('decode'):
+        while position < frame_index and vid.grab():
+            position += 1
+
+    if position != frame_index:
+        raise IOError(f'Frame {frame_index} could not be reached, the '
+                      f'video ended at frame {position}.')
+
+
+def read_frames(vid, batch_size=1):
+    """Reads frames from a video capture in groups.
+
+    Parameters
+    ----------
+    vid : cv2.VideoCapture
+        Video capture.
+    batch_size : int
+        Number of frames per group.
+
+    Yields
+    ------
+    list
+        List of up to `batch_size` consecutive frames.
+    """
+
+    frames = []
+    while True:
+        with metrics.time('decode'):
+            ret, frame = vid.read()
+
+        if not ret:
+            break
+
+        frames.append(frame)
+
+        if len(frames) == batch_size:
+            yield frames
+            frames = []
+
+    if len(frames):
+        yield frames
+
+
+def read_strided_frames(vid, batch_size=1, stride=1, retrieve_skipped=True):
+    """Reads frames from a video capture, flagging the ones to detect.
+
+    Parameters
+    ----------
+    vid : cv2.VideoCapture
+        Video capture.
+    batch_size : int
+        Number of frames to detect per group.
+    stride : int or callable
+        Detect every `stride`-th frame. A callable is called after each
+        detected frame is read, before it is tracked, and returns the stride
+        until the next one.
+    retrieve_skipped : bool
+        Decodes the skipped frames. If False, they are only grabbed and
+        yielded as None.
+
+    Yields
+    ------
+    list
+        List of (frame, detect) tuples with up to `batch_size` frames to
+        detect, in frame order.
+    """
+
+    items = []
+    detected = 0
+    countdown = 0
+
+    while True:
+        if countdown == 0:
+            with metrics.time('decode'):
+                ret, frame = vid.read()
+
+            if not ret:
+                break
+
+            items.append((frame, True))
+            detected += 1
+            countdown = (stride() if callable(stride) else stride) - 1
+
+            if detected == batch_size:
+                yield items
+                items = []
+                detected = 0
+
+            continue
+
+        with metrics.time('decode'):
+            if retrieve_skipped:
+                ret, frame = vid.read()
+            else:
+                ret, frame = vid.grab(), None
+
+        if not ret:
+            break
+
+        items.append((frame, False))
+        countdown -= 1
+
+    if len(items):
+        yield items
+
+
 def detect_in_video(video_path,
                     version=None,
                     tracked_classes=None,
@@ -85,7 +402,10 @@ def detect_in_video(video_path,
                     color=(245, 135, 66),
                     logo_path=None,
                     position='top',
-                    tag=True):
+                    tag=True,
+                    batch_size=1,
+                    mode='serial',
+                    queue_size=8):
     """Detects from video.
 
     Parameters
@@ -93,7 +413,7 @@ def detect_in_video(video_path,
     video_path : str
         Path to video.
     version : str
-        Model version.
+        Model version, or path to a model file.
     tracked_classes : list
         List of tracked classes.
     threshold : float
@@ -106,6 +426,14 @@ def detect_in_video(video_path,
         Position to draw logo.
     tag : bool
         Tag mode. Draws class name.
+    batch_size : int
+        Number of frames per forward pass.
+    mode : str
+        Execution mode. 'serial' runs everything on the calling thread,
+        'threaded' runs decode, inference, drawing and encode as separate
+        stages connected by bounded queues.
+    queue_size : int
+        Maximum number of batches waiting between stages in 'threaded' mode.
     """
 
     # Load video capture
@@ -121,23 +449,47 @@ def detect_in_video(video_path,
     vid_size = (width, height)
     out = cv2.VideoWriter(output_file, codec, fps, vid_size)
 
-    print(f'[INFO] Processing video {video_path} with {total_frames} frames')
+    log_event(logger, 'processing_video', video=video_path,
+              frames=total_frames)
 
     pbar = tqdm(total=total_frames - 1)
-    while True:
-        ret, frame = vid.read()
 
-        if not ret:
-            break
+    def infer(frames):
+        return list(zip(frames, detect_batch(frames, version, batch_size)))
+
+    def draw(batch):
+        images = []
+
+        for img, results in batch:
+            boxes, confidence, classes, names = results
+
+            # Process boxes
+            with metrics.time('drawing'):
+                img = process_boxes(img, boxes, confidence, classes, names,
+                                    tracked_classes, threshold, color,
+                                    logo_path, position, tag)
+            images.append(img)
+
+        return images
+
+    def write(images):
+        for img in images:
+            with metrics.time('encode'):
+                out.write(img)
+            pbar.update(1)
+
+        if mode == 'threaded':
+            pbar.set_postfix(pipeline.queue_depths())
 
-        img = frame.copy()
-        results = detect_single_frame(img, version=version)
-        boxes, confidence, classes, names = results
+    pipeline = Pipeline(read_frames(vid, batch_size), [infer, draw], write,
+                        mode=mode,
+                        queue_size=queue_size,
+                        names=['decoded', 'detected', 'drawn'])
+    pipeline.run()
 
-        # Process boxes
-        img = process_boxes(img, boxes, confidence, classes, names,
-                            tracked_classes, threshold, color, logo_path,
-                            position, tag)
+    if mode == 'threaded':
+        log_event(logger, 'max_queue_depths', **pipeline.max_queue_depths())
 
-        out.write(img)
-        pbar.update(1)
\ No newline at end of file
+    vid.release()
+    out.release()
+    pbar.close()
@@ -0,0 +1,435 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Batch job runner.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from datetime import datetime
+from datetime import timezone
+from time import monotonic
+import argparse
+import logging
+import json
+import os
+
+from tqdm import tqdm
+
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.logger import setup_logging
+
+
+logger = get_logger('jobs')
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg')
+MANIFEST = 'jobs.json'
+
+
+def list_videos(inputs):
+    """Videos of a list of directories, manifests and video paths.
+
+    Parameters
+    ----------
+    inputs : list
+        Directories (their videos, sorted by name), manifests (text files
+        with one video path per line, relative to the manifest, or JSON
+        lists of paths) and video paths.
+
+    Returns
+    -------
+    list
+        Video paths, without duplicates and in input order.
+    """
+
+    videos = []
+
+    for path in inputs:
+        if os.path.isdir(path):
+            videos.extend(os.path.join(path, name)
+                          for name in sorted(os.listdir(path))
+                          if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif path.lower().endswith(VIDEO_EXTENSIONS):
+            videos.append(path)
+        else:
+            with open(path) as manifest_file:
+                if path.endswith('.json'):
+                    entries = json.load(manifest_file)
+                else:
+                    entries = [line.strip() for line in manifest_file]
+                    entries = [entry for entry in entries
+                               if entry and not entry.startswith('#')]
+
+            root = os.path.dirname(path)
+            videos.extend(os.path.join(root, entry) for entry in entries)
+
+    return list(dict.fromkeys(os.path.normpath(video) for video in videos))
+
+
+def job_paths(video_path, output_dir):
+    """Paths to the counts file and the checkpoint of a video.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to the video.
+    output_dir : str
+        Directory of the outputs.
+
+    Returns
+    -------
+    output_file : str
+        Path to the counts file.
+    checkpoint_path : str
+        Path to the checkpoint.
+    """
+
+    name = os.path.splitext(os.path.basename(video_path))[0]
+
+    return (os.path.join(output_dir, name + '_counts.json'),
+            os.path.join(output_dir, name + '_checkpoint.pkl'))
+
+
+def available_memory():
+    """Available physical memory in bytes, or None if unknown."""
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def max_workers(workers=None, threads=1, worker_memory=1.5):
+    """Number of workers that fit the cores and the available memory.
+
+    Parameters
+    ----------
+    workers : int
+        Requested number of workers. Defaults to as many as fit.
+    threads : int
+        Inference threads per worker.
+    worker_memory : float
+        Gigabytes used by a worker with its model loaded.
+
+    Returns
+    -------
+    int
+        Number of workers, at least 1.
+    """
+
+    limit = max(1, (os.cpu_count() or 1) // threads)
+    memory = available_memory()
+
+    if memory is not None and worker_memory:
+        limit = min(limit, max(1, int(memory / (worker_memory * 2 ** 30))))
+
+    return min(workers, limit) if workers else limit
+
+
+def load_manifest(path):
+    """Status of the jobs by video, empty if there is no manifest yet."""
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(path, jobs):
+    """Writes the status of the jobs, replacing the manifest atomically."""
+
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(jobs, manifest_file, indent=2)
+
+    os.replace(tmp_path, path)
+
+
+def init_worker(version=None, threads=None, level='INFO'):
+    """Sets up a worker process and loads its model once."""
+
+    from ml.backends import set_threads
+    from ml.registry import get_model
+
+    setup_logging(level)
+    set_threads(threads)
+    get_model(version)
+
+
+def run_job(video_path, output_file, checkpoint_path=None, options=None):
+    """Tracks and counts the objects of a video in a worker.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to the video.
+    output_file : str
+        Path to the counts file.
+    checkpoint_path : str
+        Path to the checkpoint of the job, so an interrupted job resumes.
+    options : dict
+        Keyword arguments for `object_tracking_in_video`.
+
+    Returns
+    -------
+    dict
+        Status of the job: 'done' with the total and seconds, or 'failed'
+        with the error.
+    """
+
+    import cv2
+
+    from ml.track import object_tracking_in_video
+
+    start = monotonic()
+
+    try:
+        vid = cv2.VideoCapture(video_path)
+        opened = vid.isOpened()
+        vid.release()
+
+        if not opened:
+            raise IOError(f'Video {video_path} could not be opened.')
+
+        total = object_tracking_in_video(video_path,
+                                         headless=True,
+                                         output_file=output_file,
+                                         checkpoint_path=checkpoint_path,
+                                         **(options or {}))
+    except Exception as error:
+        return {'status': 'failed', 'error': repr(error)}
+
+    return {'status': 'done',
+            'output': output_file,
+            'total': total,
+            'seconds': round(monotonic() - start, 3)}
+
+
+def run_jobs(inputs,
+             output_dir,
+             workers=None,
+             threads=1,
+             worker_memory=1.5,
+             force=False,
+             checkpoint_interval=9000,
+             spill_history=False,
+             level='INFO',
+             **options):
+    """Processes a batch of videos in a pool of workers.
+
+    Every worker loads the model once and processes videos from a shared
+    queue. The status of every job is kept in a 'jobs.json' manifest in
+    `output_dir`, updated as the jobs end. Videos whose counts file already
+    exists are skipped, and interrupted jobs resume from their checkpoint.
+
+    Parameters
+    ----------
+    inputs : list
+        Directories, manifests and video paths (see `list_videos`).
+    output_dir : str
+        Directory of the counts files, checkpoints and manifest.
+    workers : int
+        Maximum number of worker processes. The pool is further capped to
+        the cores and the available memory.
+    threads : int
+        Inference threads per worker.
+    worker_memory : float
+        Gigabytes used by a worker with its model loaded.
+    force : bool
+        Processes the videos again even if their counts file exists.
+    checkpoint_interval : int
+        Minimum number of frames between the checkpoints of a job.
+    spill_history : bool
+        Spills the full centroid history of every object to a
+        '<video>_history' directory next to the counts file.
+    level : str
+        Logging level of the workers.
+    **options
+        Keyword arguments for `object_tracking_in_video`, such as
+        `version`, `tracked_classes` or `detection_stride`.
+
+    Returns
+    -------
+    dict
+        Status of the jobs of `inputs` by video path. The manifest also
+        keeps the jobs of earlier runs on other videos.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    jobs = load_manifest(manifest_path)
+    videos = list_videos(inputs)
+
+    paths = [job_paths(video, output_dir) for video in videos]
+    outputs = [output_file for output_file, _ in paths]
+    duplicates = sorted({output_file for output_file in outputs
+                         if outputs.count(output_file) > 1})
+
+    if duplicates:
+        raise ValueError(f'Videos with the same name would share their '
+                         f'outputs: {duplicates}.')
+
+    pending = []
+
+    for video, (output_file, checkpoint_path) in zip(videos, paths):
+        if not force and os.path.exists(output_file):
+            # The counts file is only written once the job is done
+            if jobs.get(video, {}).get('status') != 'done':
+                jobs[video] = {'status': 'done', 'output': output_file}
+
+            continue
+
+        jobs[video] = {'status': 'pending', 'output': output_file}
+        pending.append((video, output_file, checkpoint_path))
+
+    save_manifest(manifest_path, jobs)
+
+    workers = min(max_workers(workers, threads, worker_memory),
+                  max(1, len(pending)))
+    log_event(logger, 'jobs_started', videos=len(videos),
+              pending=len(pending), skipped=len(videos) - len(pending),
+              workers=workers, threads=threads)
+
+    if not pending:
+        return {video: jobs[video] for video in videos}
+
+    options = dict(options, checkpoint_interval=checkpoint_interval)
+    start = monotonic()
+    pbar = tqdm(total=len(pending), unit='video')
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(options.get('version'), threads,
+                                       level)) as executor:
+        futures = {}
+
+        for video, output_file, checkpoint_path in pending:
+            job_options = options
+
+            if spill_history:
+                name = os.path.splitext(os.path.basename(video))[0]
+                job_options = dict(options, spill_dir=os.path.join(
+                    output_dir, name + '_history'))
+
+            future = executor.submit(run_job, video, output_file,
+                                     checkpoint_path, job_options)
+            futures[future] = video
+
+        for future in as_completed(futures):
+            video = futures[future]
+
+            try:
+                result = future.result()
+            except Exception as error:
+                # The worker died, e.g. killed for running out of memory
+                result = {'status': 'failed', 'error': repr(error)}
+
+            result['finished_at'] = datetime.now(timezone.utc).isoformat()
+            jobs[video] = dict(jobs[video], **result)
+            save_manifest(manifest_path, jobs)
+
+            failed = result['status'] == 'failed'
+            log_event(logger, f'job_{result["status"]}',
+                      logging.WARNING if failed else logging.INFO,
+                      video=video,
+                      total=result.get('total'),
+                      seconds=result.get('seconds'),
+                      error=result.get('error'))
+            pbar.update(1)
+
+    pbar.close()
+
+    statuses = [jobs[video]['status'] for video, *_ in pending]
+    log_event(logger, 'jobs_done', done=statuses.count('done'),
+              failed=statuses.count('failed'),
+              seconds=round(monotonic() - start, 3))
+
+    return {video: jobs[video] for video in videos}
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Datlacuache batch tracking of videos')
+    parser.add_argument('inputs', help='Video directories, manifests or '
+                        'videos.', type=str, nargs='+')
+    parser.add_argument('--output_dir', help='Directory of the counts, '
+                        'checkpoints and jobs manifest.', type=str,
+                        default='outputs')
+    parser.add_argument('--workers', help='Maximum worker processes.',
+                        type=int, default=None)
+    parser.add_argument('--threads', help='Inference threads per worker.',
+                        type=int, default=1)
+    parser.add_argument('--worker_memory', help='Gigabytes per worker.',
+                        type=float, default=1.5)
+    parser.add_argument('--force', help='Process completed videos again.',
+                        action='store_true')
+    parser.add_argument('--version', help='Model version or file.',
+                        type=str, default=None)
+    parser.add_argument('--classes', help='Tracked classes.', type=str,
+                        nargs='+', default=['car', 'truck'])
+    parser.add_argument('--threshold', help='Detection threshold.',
+                        type=float, default=0.5)
+    parser.add_argument('--batch_size', help='Frames per forward pass.',
+                        type=int, default=1)
+    parser.add_argument('--detection_stride', help='Detect every n frames.',
+                        type=int, default=1)
+    parser.add_argument('--max_stride', help='Stride without live tracks.',
+                        type=int, default=None)
+    parser.add_argument('--size', help='Model input size.', type=int,
+                        default=640)
+    parser.add_argument('--checkpoint_interval', help='Frames between '
+                        'checkpoints.', type=int, default=9000)
+    parser.add_argument('--spill_history', help='Spill the full history '
+                        'of every object to disk.', action='store_true')
+    parser.add_argument('--log_level', help='Logging level.', type=str,
+                        default='INFO')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Main function."""
+
+    args = parse_args()
+    setup_logging(args.log_level)
+
+    jobs = run_jobs(args.inputs, args.output_dir,
+                    workers=args.workers,
+                    threads=args.threads,
+                    worker_memory=args.worker_memory,
+                    force=args.force,
+                    checkpoint_interval=args.checkpoint_interval,
+                    spill_history=args.spill_history,
+                    level=args.log_level,
+                    version=args.version,
+                    tracked_classes=args.classes,
+                    threshold=args.threshold,
+                    batch_size=args.batch_size,
+                    detection_stride=args.detection_stride,
+                    max_stride=args.max_stride,
+                    size=args.size)
+
+    failed = [video for video, job in jobs.items()
+              if job['status'] == 'failed']
+
+    if failed:
+        log_event(logger, 'jobs_failed', logging.ERROR, failed=len(failed),
+                  videos=failed,
+                  manifest=os.path.join(args.output_dir, MANIFEST))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,386 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Live-stream tracking script.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from threading import Condition
+from threading import Thread
+from time import monotonic
+from time import sleep
+from time import time
+import logging
+import os
+
+import numpy as np
+import cv2
+
+from ml.tracker.sort.sort import Sort
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.metrics import metrics
+from ml.detect import detect_batch
+from ml.tools import track_boxes
+from ml.tools import display_counts
+from ml.track import save_counts
+from ml.track import track_record
+from ml.zones import default_counter
+
+
+logger = get_logger('live')
+
+
+class LatestFrameReader:
+    """Capture thread that keeps only the newest frame of a source.
+
+    The capture is read continuously on its own thread into a single slot,
+    so a slow consumer always gets the most recent frame and the frames it
+    could not process are overwritten instead of queued.
+    """
+
+    def __init__(self, capture, fps=None):
+        """Class constructor.
+
+        Parameters
+        ----------
+        capture : cv2.VideoCapture
+            Source, or any object with a `read()` method returning
+            (ret, frame) like it.
+        fps : float
+            Paces the reads to this rate, to replay a file as if it was a
+            live source. Live sources are paced by the device itself.
+        """
+
+        self.capture = capture
+        self.fps = fps
+        self.condition = Condition()
+        self.item = None
+        self.captured = 0
+        self.ended = False
+        self.stopped = False
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Starts the capture thread."""
+
+        self.thread.start()
+
+        return self
+
+    def run(self):
+        """Reads frames into the slot until the source ends or is stopped."""
+
+        next_read = monotonic()
+
+        while not self.stopped:
+            if self.fps:
+                delay = next_read - monotonic()
+
+                if delay > 0:
+                    sleep(delay)
+
+                next_read = max(next_read + 1 / self.fps, monotonic())
+
+            with metrics.time('decode'):
+                ret, frame = self.capture.read()
+
+            if not ret:
+                break
+
+            with self.condition:
+                self.item = (self.captured, frame, time())
+                self.captured += 1
+                self.condition.notify()
+
+        with self.condition:
+            self.ended = True
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Takes the newest frame, waiting for one if the slot is empty.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum seconds to wait.
+
+        Returns
+        -------
+        tuple
+            (index, frame, captured_at) of the newest frame, where `index`
+            counts every frame read from the source and `captured_at` is the
+            epoch time it was read. None if the source ended or the timeout
+            expired.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None or
+                                    self.ended, timeout)
+            item, self.item = self.item, None
+
+        return item
+
+    def stop(self, timeout=5.):
+        """Stops the capture thread, waiting for a blocked read."""
+
+        self.stopped = True
+        self.thread.join(timeout)
+
+
+def object_tracking_live(source,
+                         version=None,
+                         tracked_classes=None,
+                         tracking_params=None,
+                         threshold=0.5,
+                         color=(245, 135, 66),
+                         logo_path=None,
+                         position='top',
+                         output_path=None,
+                         headless=True,
+                         latency_budget=0.5,
+                         fps=None,
+                         duration=None,
+                         stop=None,
+                         sink=None,
+                         size=640,
+                         counter=None,
+                         roi=None,
+                         summary_interval=10.):
+    """Object tracking in a live source, always on its newest frame.
+
+    A capture thread keeps the newest frame of the source, and the frames
+    read while the previous one was being processed are dropped. The
+    tracker is advanced by prediction over the dropped frames, so the
+    motion model keeps the source frame rate. Frames older than the latency
+    budget when they are taken are dropped as well, so the counts never lag
+    behind the source.
+
+    Parameters
+    ----------
+    source : str, int or object
+        Camera index, stream URL or video path, or a capture-like object
+        with a `read()` method.
+    version : str
+        Version of the model to use.
+    tracked_classes : list
+        List of classes to track.
+    tracking_params : dict
+        Parameters for tracking.
+    threshold : float
+        Threshold for detection.
+    color : tuple
+        Color for the bounding boxes.
+    logo_path : str
+        Path to the logo.
+    position : str
+        Position of the logo.
+    output_path : str
+        Where to write the counts and track records (headless), or the
+        processed frames. Nothing is written if None.
+    headless : bool
+        Only tracks and counts, without drawing.
+    latency_budget : float
+        Maximum seconds from capture to the start of processing. Older
+        frames are dropped, and the processed frames that end later than
+        this are reported as late.
+    fps : float
+        Paces the reads of the source to this rate. Defaults to the frame
+        rate of video files, which are replayed in real time.
+    duration : float
+        Seconds to run. Runs until the source ends if None.
+    stop : threading.Event
+        Stops the tracking when set.
+    sink : callable
+        Called with every trackable object evicted once its track ends.
+    size : int
+        Model input size.
+    counter : Counter
+        Counting lines and zones. Defaults to `default_counter()`.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frames are detected.
+    summary_interval : float
+        Seconds between the periodic summary log records.
+
+    Returns
+    -------
+    dict
+        Total of counted objects, and processed, dropped (by the slot),
+        stale (over the budget when taken) and late frames.
+    """
+
+    if tracking_params is None:
+        tracking_params = {'max_age': 10, 'min_hits': 2, 'iou_threshold': 0.25}
+
+    if counter is None:
+        counter = default_counter()
+
+    centroid_tracker = Sort(max_age=tracking_params['max_age'],
+                            min_hits=tracking_params['min_hits'],
+                            iou_threshold=tracking_params['iou_threshold'])
+    trackable_objects = {}
+
+    if hasattr(source, 'read'):
+        capture = source
+    else:
+        capture = cv2.VideoCapture(source)
+
+        if fps is None and isinstance(source, str) and \
+                os.path.isfile(source):
+            fps = capture.get(cv2.CAP_PROP_FPS) or None
+
+    reader = LatestFrameReader(capture, fps).start()
+    log_event(logger, 'processing_live', source=str(source), fps=fps,
+              latency_budget=latency_budget)
+
+    global_total = 0
+    last_index = -1
+    processed = dropped = stale = late = 0
+    counts = []
+    tracks = []
+    latencies = []
+    frame_size = None
+    out = None
+
+    def record(trackable_object):
+        tracks.append(track_record(trackable_object, last_index))
+
+        if sink is not None:
+            sink(trackable_object)
+
+    def advance(frame_index, image=None, detections=(None,) * 4,
+                timestamp=None):
+        nonlocal global_total
+        boxes, confidence, classes, names = detections
+
+        image, total = track_boxes(image, boxes, confidence, classes, names,
+                                   centroid_tracker, trackable_objects,
+                                   tracked_classes, threshold, color,
+                                   logo_path, position,
+                                   sink=record if headless else sink,
+                                   draw=image is not None,
+                                   frame_size=frame_size,
+                                   counter=counter,
+                                   frame_index=frame_index,
+                                   timestamp=timestamp,
+                                   source=str(source))
+        global_total += total
+
+        if total:
+            counts.append([frame_index, global_total])
+
+        return image
+
+    start_time = monotonic()
+    last_summary = start_time
+
+    def log_summary(force=False):
+        nonlocal last_summary
+        now = monotonic()
+
+        if not force and now - last_summary < summary_interval:
+            return
+
+        last_summary = now
+        log_event(logger, 'live_summary', frames=last_index + 1,
+                  processed=processed, dropped=dropped, stale=stale,
+                  late=late, total=global_total,
+                  live_tracks=len(centroid_tracker.live_ids()),
+                  fps=round(processed / (now - start_time), 2),
+                  latency_p50_ms=round(np.median(latencies) * 1000, 1)
+                  if latencies else None)
+        latencies.clear()
+
+    try:
+        while not (stop is not None and stop.is_set()):
+            if duration is not None and monotonic() - start_time > duration:
+                break
+
+            item = reader.get(timeout=1.)
+
+            if item is None:
+                if reader.ended:
+                    break
+
+                continue
+
+            frame_index, frame, captured_at = item
+
+            if frame_size is None:
+                frame_size = (frame.shape[1], frame.shape[0])
+
+                if output_path is not None and not headless:
+                    codec = cv2.VideoWriter_fourcc(*'XVID')
+                    out = cv2.VideoWriter(output_path, codec,
+                                          int(fps or 25), frame_size)
+
+            # The frames overwritten in the slot are tracked by prediction,
+            # like the frames skipped by a detection stride. Prediction does
+            # not age the tracks, so the whole gap is predicted to keep the
+            # boxes where the objects are now.
+            gap = frame_index - last_index - 1
+            dropped += gap
+
+            with metrics.time('gap'):
+                for index in range(last_index + 1, frame_index):
+                    advance(index)
+
+            last_index = frame_index
+
+            if time() - captured_at > latency_budget:
+                stale += 1
+                log_event(logger, 'stale_frame', logging.DEBUG,
+                          frame=frame_index,
+                          age_ms=round((time() - captured_at) * 1000, 1))
+                advance(frame_index, timestamp=round(captured_at, 3))
+                continue
+
+            detections = detect_batch([frame], version, 1, size=size,
+                                      roi=roi)[0]
+            image = advance(frame_index, None if headless else frame,
+                            detections, round(captured_at, 3))
+            processed += 1
+
+            if not headless:
+                with metrics.time('drawing'):
+                    image = display_counts(image, counter.counts, position,
+                                           color)
+
+            if out is not None:
+                with metrics.time('encode'):
+                    out.write(image)
+
+            latency = time() - captured_at
+            latencies.append(latency)
+            metrics.record('latency', latency)
+
+            if latency > latency_budget:
+                late += 1
+
+            log_summary()
+    finally:
+        reader.stop()
+
+        if not hasattr(source, 'read'):
+            capture.release()
+
+        if out is not None:
+            out.release()
+
+    log_summary(force=True)
+
+    if headless and output_path is not None:
+        save_counts(output_path, str(source), last_index + 1, global_total,
+                    counter, counts, tracks, trackable_objects)
+
+    return {'total': global_total,
+            'frames': last_index + 1,
+            'processed': processed,
+            'dropped': dropped,
+            'stale': stale,
+            'late': late}
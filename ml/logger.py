@@ -0,0 +1,192 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Structured logging.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from threading import Lock
+from time import monotonic
+import logging
+import json
+
+
+ROOT = 'datlacuache'
+QUOTED = (' ', '=', '"', '\t', '\n')
+
+
+def get_logger(name):
+    """Returns a logger under the project namespace.
+
+    Parameters
+    ----------
+    name : str
+        Module name.
+
+    Returns
+    -------
+    logging.Logger
+        Logger.
+    """
+
+    return logging.getLogger(f'{ROOT}.{name}')
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """Logs a structured event.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger.
+    event : str
+        Event name.
+    level : int
+        Logging level.
+    **fields
+        Key-value fields of the event.
+    """
+
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as key=value pairs or as JSON lines."""
+
+    def __init__(self, fmt='kv'):
+        """Class constructor.
+
+        Parameters
+        ----------
+        fmt : str
+            'kv' for key=value pairs, 'json' for JSON lines.
+        """
+
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record):
+        fields = {'ts': round(record.created, 3),
+                  'level': record.levelname,
+                  'logger': record.name,
+                  'event': record.getMessage()}
+        fields.update(getattr(record, 'fields', {}))
+
+        if self.fmt == 'json':
+            return json.dumps(fields, default=str)
+
+        return ' '.join(f'{key}={kv_value(value)}'
+                        for key, value in fields.items())
+
+
+def kv_value(value):
+    """Value of a key=value pair, quoted if it would be ambiguous."""
+
+    text = str(value)
+
+    if not text or any(char in text for char in QUOTED):
+        return json.dumps(text)
+
+    return text
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per event, so repeated events cannot flood the logs.
+
+    Only the per-frame records, logged at DEBUG level, are limited. Records
+    of a higher level, like every counted object, always go through, as
+    they are the output of the tracking. Events that are dropped are
+    counted and reported in the `suppressed` field of the next record of
+    the same event that goes through.
+    """
+
+    def __init__(self, rate=10., burst=20, level=logging.DEBUG):
+        """Class constructor.
+
+        Parameters
+        ----------
+        rate : float
+            Records per second allowed per event.
+        burst : int
+            Maximum number of records allowed at once per event.
+        level : int
+            Records above this level are never limited.
+        """
+
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self.buckets = {}
+        self.lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+
+        key = (record.name, record.msg)
+        now = monotonic()
+
+        with self.lock:
+            tokens, last, suppressed = self.buckets.get(key,
+                                                        (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+
+            self.buckets[key] = (tokens - 1, now, 0)
+
+        if suppressed:
+            record.fields = dict(getattr(record, 'fields', {}),
+                                 suppressed=suppressed)
+
+        return True
+
+
+def setup_logging(level='INFO', fmt='kv', rate=10., burst=20, stream=None):
+    """Configures the project loggers.
+
+    Parameters
+    ----------
+    level : str or int
+        Logging level. Per-frame messages are logged at DEBUG level.
+    fmt : str
+        'kv' for key=value pairs, 'json' for JSON lines.
+    rate : float
+        Records per second allowed per DEBUG event. None disables rate
+        limiting.
+    burst : int
+        Maximum number of records allowed at once per DEBUG event.
+    stream : file
+        Stream to write to. Defaults to stderr.
+
+    Returns
+    -------
+    logging.Logger
+        Project root logger.
+    """
+
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(StructuredFormatter(fmt))
+
+    if rate is not None:
+        handler.addFilter(RateLimitFilter(rate, burst))
+
+    logger.addHandler(handler)
+
+    return logger
@@ -0,0 +1,295 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Pipeline metrics.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from collections import deque
+from contextlib import nullcontext
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import perf_counter
+import json
+
+import numpy as np
+
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class StageTimer:
+    """Context manager that records the duration of a stage."""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.record(self.name, perf_counter() - self.start)
+
+
+class Metrics:
+    """Per-stage durations with rolling percentiles.
+
+    When disabled, `time` returns a shared no-op context manager and
+    `record` returns right away, so instrumented code costs close to
+    nothing. Durations are recorded and read under a lock, as the stages
+    of the threaded pipeline record them concurrently.
+    """
+
+    def __init__(self, enabled=False, window=1000):
+        """Class constructor.
+
+        Parameters
+        ----------
+        enabled : bool
+            Whether durations are recorded.
+        window : int
+            Number of recent durations kept per stage for the percentiles.
+        """
+
+        self.enabled = enabled
+        self.window = window
+        self.durations = {}
+        self.counts = {}
+        self.totals = {}
+        self.lock = Lock()
+        self.noop = nullcontext()
+        self.stop = Event()
+        self.server = None
+
+    def enable(self):
+        """Starts recording durations."""
+
+        self.enabled = True
+
+    def disable(self):
+        """Stops recording durations."""
+
+        self.enabled = False
+
+    def reset(self):
+        """Clears every recorded duration."""
+
+        with self.lock:
+            self.durations = {}
+            self.counts = {}
+            self.totals = {}
+
+    def time(self, name):
+        """Context manager that times a stage.
+
+        Parameters
+        ----------
+        name : str
+            Stage name.
+
+        Returns
+        -------
+        StageTimer
+            Timer, or a no-op context manager if disabled.
+        """
+
+        if not self.enabled:
+            return self.noop
+
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        """Records a duration.
+
+        Parameters
+        ----------
+        name : str
+            Stage name.
+        seconds : float
+            Duration in seconds.
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+                self.counts[name] = 0
+                self.totals[name] = 0.
+
+            self.durations[name].append(seconds)
+            self.counts[name] += 1
+            self.totals[name] += seconds
+
+    def snapshot(self):
+        """Consistent copy of the recorded durations.
+
+        Returns
+        -------
+        dict
+            Stage name -> (durations array, count, total seconds).
+        """
+
+        with self.lock:
+            return {name: (np.array(durations), self.counts[name],
+                           self.totals[name])
+                    for name, durations in self.durations.items()}
+
+    def summary(self):
+        """Summary of every stage.
+
+        Returns
+        -------
+        dict
+            Stage name -> count, total and mean seconds, and rolling
+            percentiles in milliseconds.
+        """
+
+        summary = {}
+
+        for name, (durations, count, total) in self.snapshot().items():
+            values = durations * 1000
+            stats = {'count': count,
+                     'total_s': total,
+                     'mean_ms': total / count * 1000}
+
+            for quantile, value in zip(QUANTILES,
+                                       np.quantile(values, QUANTILES)):
+                stats[f'p{quantile * 100:g}_ms'] = float(value)
+
+            summary[name] = stats
+
+        return summary
+
+    def dump(self, path):
+        """Writes the summary to a JSON or CSV file.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file. CSV if it ends with '.csv', JSON otherwise.
+        """
+
+        summary = self.summary()
+
+        with open(path, 'w') as metrics_file:
+            if not path.endswith('.csv'):
+                json.dump(summary, metrics_file, indent=2)
+                return
+
+            columns = ['count', 'total_s', 'mean_ms'] + \
+                [f'p{quantile * 100:g}_ms' for quantile in QUANTILES]
+            metrics_file.write(','.join(['stage'] + columns) + '\n')
+
+            for name, stats in summary.items():
+                row = [name] + [str(stats[column]) for column in columns]
+                metrics_file.write(','.join(row) + '\n')
+
+    def start_dumping(self, path, interval=10.):
+        """Dumps the summary periodically on a background thread.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file.
+        interval : float
+            Seconds between dumps.
+        """
+
+        if self.stop.is_set():
+            self.stop = Event()
+
+        stop = self.stop
+
+        def run():
+            while not stop.wait(interval):
+                self.dump(path)
+
+        Thread(target=run, daemon=True).start()
+
+    def prometheus(self):
+        """Summary in Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            Metrics text.
+        """
+
+        metric = 'datlacuache_stage_duration_seconds'
+        lines = [f'# HELP {metric} Duration of each pipeline stage.',
+                 f'# TYPE {metric} summary']
+
+        for name, (durations, count, total) in self.snapshot().items():
+            values = np.quantile(durations, QUANTILES)
+
+            for quantile, value in zip(QUANTILES, values):
+                lines.append(f'{metric}{{stage="{name}",'
+                             f'quantile="{quantile}"}} {value}')
+
+            lines.append(f'{metric}_sum{{stage="{name}"}} {total}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """Serves the metrics over HTTP on a background thread.
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on.
+        host : str
+            Host to bind.
+
+        Returns
+        -------
+        ThreadingHTTPServer
+            Running server.
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self.server
+
+    def close(self):
+        """Stops the periodic dumps and the HTTP server."""
+
+        self.stop.set()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+metrics = Metrics()
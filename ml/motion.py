@@ -0,0 +1,165 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Motion gate.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from time import perf_counter
+import hashlib
+
+import numpy as np
+import cv2
+
+
+METHODS = ['diff', 'mog2']
+
+
+class MotionGate:
+    """Cheap motion test to skip the detector on static frames.
+
+    Frames are downscaled, converted to grayscale and blurred, and compared
+    with the previous checked frame ('diff') or with a background model
+    ('mog2'). A frame has motion when the fraction of changed pixels is
+    above `min_area`.
+    """
+
+    def __init__(self,
+                 method='diff',
+                 width=160,
+                 pixel_threshold=25,
+                 min_area=0.002,
+                 blur=5):
+        """Class constructor.
+
+        Parameters
+        ----------
+        method : str
+            'diff' for frame differencing, 'mog2' for MOG2 background
+            subtraction.
+        width : int
+            Width the frames are downscaled to.
+        pixel_threshold : int
+            Minimum gray level difference of a changed pixel ('diff').
+        min_area : float
+            Minimum fraction of changed pixels of a frame with motion.
+        blur : int
+            Size of the Gaussian blur kernel, odd. 0 disables the blur.
+        """
+
+        if method not in METHODS:
+            raise ValueError(f'Method {method} is not supported. '
+                             f'Use one of {METHODS}.')
+
+        self.method = method
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_area = min_area
+        self.blur = blur
+        self.previous = None
+        self.subtractor = None
+
+        if method == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(
+                detectShadows=False)
+
+        self.checked = 0
+        self.skipped = 0
+        self.seconds = 0.
+
+    def key(self):
+        """Short hash of the configuration, to tell caches apart."""
+
+        settings = (self.method, self.width, self.pixel_threshold,
+                    self.min_area, self.blur)
+
+        return hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+
+    def preprocess(self, frame):
+        """Downscaled, blurred grayscale version of a frame."""
+
+        height, width = frame.shape[:2]
+        size = (self.width, max(1, round(height * self.width / width)))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if self.blur:
+            small = cv2.GaussianBlur(small, (self.blur, self.blur), 0)
+
+        return small
+
+    def changed_area(self, frame):
+        """Fraction of pixels that changed.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            BGR frame.
+
+        Returns
+        -------
+        float
+            Fraction of changed pixels, 1 for the first frame.
+        """
+
+        small = self.preprocess(frame)
+
+        if self.subtractor is not None:
+            mask = self.subtractor.apply(small)
+
+            return np.count_nonzero(mask) / mask.size
+
+        previous, self.previous = self.previous, small
+
+        if previous is None or previous.shape != small.shape:
+            return 1.
+
+        difference = cv2.absdiff(small, previous)
+
+        return np.count_nonzero(difference > self.pixel_threshold) / \
+            difference.size
+
+    def moving(self, frame):
+        """Whether a frame has motion, updating the statistics.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            BGR frame.
+
+        Returns
+        -------
+        bool
+            True if the changed area is above `min_area`.
+        """
+
+        start = perf_counter()
+        moving = self.changed_area(frame) > self.min_area
+        self.seconds += perf_counter() - start
+
+        self.checked += 1
+        self.skipped += not moving
+
+        return moving
+
+    def stats(self):
+        """Statistics of the gate.
+
+        Returns
+        -------
+        dict
+            Checked and skipped frames, fraction skipped and mean
+            milliseconds per check.
+        """
+
+        return {'checked': self.checked,
+                'skipped': self.skipped,
+                'skipped_ratio': self.skipped / self.checked
+                if self.checked else 0.,
+                'ms_per_check': self.seconds * 1000 / self.checked
+                if self.checked else 0.}
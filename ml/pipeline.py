@@ -0,0 +1,176 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Staged processing pipeline.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from threading import Event
+from threading import Thread
+import queue
+
+
+MODES = ['serial', 'threaded']
+END = object()
+
+
+class Pipeline:
+    """Source -> stages -> sink pipeline.
+
+    In 'serial' mode every item goes through the whole chain on the calling
+    thread. In 'threaded' mode the source, each stage and the sink run on
+    their own thread, connected by bounded queues, so a slow stage applies
+    backpressure on the previous ones. Each stage runs on a single thread,
+    so items keep their order.
+    """
+
+    def __init__(self,
+                 source,
+                 stages,
+                 sink,
+                 mode='serial',
+                 queue_size=8,
+                 names=None):
+        """Class constructor.
+
+        Parameters
+        ----------
+        source : iterable
+            Iterable of input items (e.g. batches of decoded frames).
+        stages : list
+            List of callables, each one maps an item to the next item.
+        sink : callable
+            Callable that consumes the output items.
+        mode : str
+            Execution mode, 'serial' or 'threaded'.
+        queue_size : int
+            Maximum number of items per queue in 'threaded' mode.
+        names : list
+            Names of the queues, one per stage plus one for the sink.
+        """
+
+        if mode not in MODES:
+            raise ValueError(f'Mode {mode} is not supported. '
+                             f'Use one of {MODES}.')
+
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+        self.mode = mode
+
+        n_queues = len(self.stages) + 1
+        self.names = names or [f'queue_{i}' for i in range(n_queues)]
+        self.queues = [queue.Queue(maxsize=queue_size)
+                       for _ in range(n_queues)]
+        self.max_depths = [0] * n_queues
+        self.stop = Event()
+        self.errors = []
+
+    def queue_depths(self):
+        """Returns the current number of items waiting in each queue.
+
+        Returns
+        -------
+        dict
+            Queue name -> depth.
+        """
+
+        return {name: q.qsize() for name, q in zip(self.names, self.queues)}
+
+    def max_queue_depths(self):
+        """Returns the maximum depth observed in each queue.
+
+        Returns
+        -------
+        dict
+            Queue name -> maximum depth.
+        """
+
+        return dict(zip(self.names, self.max_depths))
+
+    def run(self):
+        """Runs the pipeline until the source is exhausted."""
+
+        if self.mode == 'serial':
+            for item in self.source:
+                for stage in self.stages:
+                    item = stage(item)
+                self.sink(item)
+            return
+
+        threads = [Thread(target=self._guard, args=(self._run_source,))]
+        for index, stage in enumerate(self.stages):
+            threads.append(Thread(target=self._guard,
+                                  args=(self._run_stage, index, stage)))
+        threads.append(Thread(target=self._guard, args=(self._run_sink,)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if len(self.errors):
+            raise self.errors[0]
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except Exception as error:
+            self.errors.append(error)
+            self.stop.set()
+
+    def _put(self, index, item):
+        while not self.stop.is_set():
+            try:
+                self.queues[index].put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+            depth = self.queues[index].qsize()
+            self.max_depths[index] = max(self.max_depths[index], depth)
+            return True
+
+        return False
+
+    def _get(self, index):
+        while not self.stop.is_set():
+            try:
+                return self.queues[index].get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return END
+
+    def _run_source(self):
+        for item in self.source:
+            if not self._put(0, item):
+                return
+
+        self._put(0, END)
+
+    def _run_stage(self, index, stage):
+        while True:
+            item = self._get(index)
+
+            if item is END:
+                self._put(index + 1, END)
+                return
+
+            if not self._put(index + 1, stage(item)):
+                return
+
+    def _run_sink(self):
+        while True:
+            item = self._get(len(self.stages))
+
+            if item is END:
+                return
+
+            self.sink(item)
@@ -0,0 +1,398 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Model registry.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+import logging
+import os
+
+from ml.backends import BACKENDS
+from ml.backends import load_backend
+from ml.backends import set_torch_threads
+from ml.logger import get_logger
+from ml.logger import log_event
+
+
+SUPPORTED_VERSIONS = ['yolov5s', 'yolov5m', 'yolov5l', 'yolov5x']
+DEFAULT_VERSION = 'yolov5m'
+PRECISIONS = ['fp32', 'fp16', 'int8']
+
+# Model files: PyTorch weights, loaded through the YOLOv5 'custom' hub entry
+# point, and exported models, loaded with their backend (see ml.backends)
+MODEL_FORMATS = ['.pt'] + list(BACKENDS)
+
+# Offline loading: local clone of ultralytics/yolov5 and directory with
+# '<version>.pt' weights
+HUB_REPO = 'ultralytics/yolov5:master'
+LOCAL_REPO = os.environ.get('DATLACUACHE_YOLOV5_REPO')
+WEIGHTS_DIR = os.environ.get('DATLACUACHE_WEIGHTS_DIR', '.')
+
+logger = get_logger('registry')
+
+
+def resolve_version(version=None):
+    """Resolves the model version, falling back to the default one.
+
+    Parameters
+    ----------
+    version : str
+        Model version, or path to a model file.
+
+    Returns
+    -------
+    str
+        Supported model version, or the path to the model file.
+    """
+
+    if version is None:
+        log_event(logger, 'version_not_specified', logging.DEBUG,
+                  default=DEFAULT_VERSION)
+
+        return DEFAULT_VERSION
+
+    if is_model_file(version):
+        return version
+
+    if version not in SUPPORTED_VERSIONS:
+        log_event(logger, 'version_not_supported', logging.DEBUG,
+                  version=version, default=DEFAULT_VERSION)
+
+        return DEFAULT_VERSION
+
+    return version
+
+
+def is_model_file(version):
+    """Whether a model version is a path to a model file.
+
+    Parameters
+    ----------
+    version : str
+        Model version.
+
+    Returns
+    -------
+    bool
+        True if it ends with one of `MODEL_FORMATS`.
+    """
+
+    return os.path.splitext(version)[1] in MODEL_FORMATS
+
+
+def default_device():
+    """Returns the default device for inference.
+
+    Returns
+    -------
+    str
+        'cuda' if a GPU is available, 'cpu' otherwise.
+    """
+
+    try:
+        import torch
+    except ImportError:
+        # Exported models can run without torch
+        return 'cpu'
+
+    return 'cuda' if torch.cuda.device_count() else 'cpu'
+
+
+def local_repo():
+    """Local copy of the YOLOv5 repository, if there is one.
+
+    Returns
+    -------
+    str
+        `LOCAL_REPO` if set, the torch hub cache of ultralytics/yolov5 if it
+        exists, None otherwise.
+    """
+
+    if LOCAL_REPO is not None:
+        return LOCAL_REPO
+
+    import torch
+
+    cached = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+
+    return cached if os.path.isdir(cached) else None
+
+
+def load_model(version):
+    """Loads a YOLOv5 hub model, without network access when possible.
+
+    '.pt' model files and '<version>.pt' weights found in `WEIGHTS_DIR` are
+    loaded through the 'custom' entry point. With a local repository (see
+    `local_repo`) no network access is needed. Otherwise, torch hub
+    downloads the repository and the weights.
+
+    Parameters
+    ----------
+    version : str
+        Model version, or path to a model file.
+
+    Returns
+    -------
+    torch.nn.Module
+        AutoShape model.
+    """
+
+    import torch
+
+    set_torch_threads(torch)
+    path = version if is_model_file(version) else \
+        os.path.join(WEIGHTS_DIR, f'{version}.pt')
+
+    if is_model_file(version) and not os.path.isfile(path):
+        raise FileNotFoundError(f'Model file {path} not found.')
+
+    repo = local_repo()
+    source = 'github' if repo is None else 'local'
+    repo = repo or HUB_REPO
+
+    if not os.path.isfile(path):
+        return torch.hub.load(repo, version, source=source)
+
+    return torch.hub.load(repo, 'custom', path=path, source=source)
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models with LRU eviction."""
+
+    def __init__(self, max_models=2):
+        """Class constructor.
+
+        Parameters
+        ----------
+        max_models : int
+            Maximum number of models kept in memory at the same time.
+        """
+
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.loading = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def key(version=None, device=None, precision='fp32'):
+        """Builds the registry key of a model.
+
+        Parameters
+        ----------
+        version : str
+            Model version, or path to a model file.
+        device : str
+            Device where the model lives.
+        precision : str
+            Model precision, 'fp32', 'fp16' or 'int8'.
+
+        Returns
+        -------
+        tuple
+            (version, device, precision) key.
+        """
+
+        if precision not in PRECISIONS:
+            raise ValueError(f'Precision {precision} is not supported. '
+                             f'Use one of {PRECISIONS}.')
+
+        version = resolve_version(version)
+        device = device or default_device()
+
+        return version, device, precision
+
+    def load(self, version=None, device=None, precision='fp32'):
+        """Loads a model, or returns it if it is already loaded.
+
+        Models are loaded outside the registry lock. Concurrent requests for
+        a model being loaded wait for that load, while the other models are
+        served right away.
+
+        Parameters
+        ----------
+        version : str
+            Model version, or path to a model file.
+        device : str
+            Device where the model lives.
+        precision : str
+            Model precision, 'fp32', 'fp16' or 'int8'.
+
+        Returns
+        -------
+        torch.nn.Module or Backend
+            Loaded model.
+        """
+
+        key = self.key(version, device, precision)
+
+        with self.lock:
+            model = self.models.get(key, None)
+
+            if model is not None:
+                self.models.move_to_end(key)
+                return model
+
+            # Only the first caller loads a model, the others wait for it
+            # without holding the lock, so other models stay available
+            future = self.loading.get(key, None)
+            loader = future is None
+
+            if loader:
+                future = Future()
+                self.loading[key] = future
+
+        if not loader:
+            return future.result()
+
+        try:
+            model = self.build(*key)
+        except BaseException as error:
+            with self.lock:
+                del self.loading[key]
+
+            future.set_exception(error)
+            raise
+
+        with self.lock:
+            del self.loading[key]
+            self.models[key] = model
+
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                log_event(logger, 'model_evicted', version=evicted[0],
+                          device=evicted[1], precision=evicted[2])
+
+        future.set_result(model)
+
+        return model
+
+    @staticmethod
+    def build(version, device, precision):
+        """Loads a model from disk or the hub.
+
+        Parameters
+        ----------
+        version : str
+            Model version, or path to a model file.
+        device : str
+            Device where the model lives.
+        precision : str
+            Model precision, 'fp32', 'fp16' or 'int8'.
+
+        Returns
+        -------
+        torch.nn.Module or Backend
+            Loaded model.
+        """
+
+        log_event(logger, 'model_loading', version=version, device=device,
+                  precision=precision)
+
+        if os.path.splitext(version)[1] in BACKENDS:
+            return load_backend(version, device, precision)
+
+        if precision == 'int8':
+            raise ValueError('int8 precision is only supported by exported '
+                             'models, see ml.backends.')
+
+        if precision == 'fp16' and device == 'cpu':
+            raise ValueError('fp16 precision needs a GPU device.')
+
+        model = load_model(version)
+        model = model.to(device)
+
+        if precision == 'fp16':
+            model = model.half()
+
+        model.eval()
+
+        return model
+
+    def unload(self, version=None, device=None, precision='fp32'):
+        """Unloads a model from the registry.
+
+        Parameters
+        ----------
+        version : str
+            Model version, or path to a model file.
+        device : str
+            Device where the model lives.
+        precision : str
+            Model precision, 'fp32', 'fp16' or 'int8'.
+
+        Returns
+        -------
+        bool
+            True if the model was loaded, False otherwise.
+        """
+
+        key = self.key(version, device, precision)
+
+        with self.lock:
+            return self.models.pop(key, None) is not None
+
+    def clear(self):
+        """Unloads every model from the registry."""
+
+        with self.lock:
+            self.models.clear()
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+
+registry = ModelRegistry()
+
+
+def get_model(version=None, device=None, precision='fp32'):
+    """Returns a model from the shared registry, loading it if needed.
+
+    Parameters
+    ----------
+    version : str
+        Model version, or path to a model file.
+    device : str
+        Device where the model lives.
+    precision : str
+        Model precision, 'fp32', 'fp16' or 'int8'.
+
+    Returns
+    -------
+    torch.nn.Module or Backend
+        Loaded model.
+    """
+
+    return registry.load(version, device, precision)
+
+
+def unload_model(version=None, device=None, precision='fp32'):
+    """Unloads a model from the shared registry.
+
+    Parameters
+    ----------
+    version : str
+        Model version, or path to a model file.
+    device : str
+        Device where the model lives.
+    precision : str
+        Model precision, 'fp32', 'fp16' or 'int8'.
+
+    Returns
+    -------
+    bool
+        True if the model was loaded, False otherwise.
+    """
+
+    return registry.unload(version, device, precision)
@@ -0,0 +1,315 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Regions of interest and tiled inference.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import hashlib
+
+import numpy as np
+import cv2
+
+
+def tile_starts(length, tile, step):
+    """Start offsets of the tiles covering a length, the last one flush."""
+
+    if length <= tile:
+        return [0]
+
+    starts = list(range(0, length - tile, step))
+
+    return starts + [length - tile]
+
+
+def merge_nms(boxes, scores, classes, crops, threshold=0.6):
+    """Merges the duplicates of objects detected by several crops.
+
+    The model already suppresses the duplicates within a crop, so only
+    boxes of the same class from different crops are compared. Their
+    overlap is measured over the smaller box, so that a box cut by a tile
+    border matches the complete box of a neighbouring tile. Each kept box
+    is grown to the union of its duplicates, whatever their scores.
+
+    Parameters
+    ----------
+    boxes : numpy.ndarray
+        (N, 4) xyxy boxes in frame coordinates.
+    scores : numpy.ndarray
+        (N,) scores.
+    classes : numpy.ndarray
+        (N,) class ids.
+    crops : numpy.ndarray
+        (N,) index of the crop of each box.
+    threshold : float
+        Boxes overlapping a kept one above this fraction of their smaller
+        area are discarded.
+
+    Returns
+    -------
+    keep : numpy.ndarray
+        Indices of the kept boxes, by decreasing score.
+    boxes : numpy.ndarray
+        Merged boxes of the kept indices.
+    """
+
+    order = np.argsort(-scores, kind='stable')
+    boxes, classes, crops = boxes[order], classes[order], crops[order]
+
+    xx1 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    yy1 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    xx2 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    yy2 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    inter = np.maximum(0., xx2 - xx1) * np.maximum(0., yy2 - yy1)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    smaller = np.maximum(np.minimum(areas[:, None], areas[None, :]), 1e-12)
+
+    duplicates = (inter / smaller > threshold) & \
+        (classes[:, None] == classes[None, :]) & \
+        (crops[:, None] != crops[None, :])
+
+    keep = np.ones(len(boxes), dtype=bool)
+    merged = boxes.copy()
+
+    for index in np.flatnonzero(duplicates.any(1)):
+        if not keep[index]:
+            continue
+
+        group = np.flatnonzero(duplicates[index] & keep)
+        group = group[group > index]
+        keep[group] = False
+
+        if len(group):
+            merged[index, :2] = np.minimum(merged[index, :2],
+                                           boxes[group, :2].min(0))
+            merged[index, 2:] = np.maximum(merged[index, 2:],
+                                           boxes[group, 2:].max(0))
+
+    return order[keep], merged[keep]
+
+
+class RegionOfInterest:
+    """Parts of the frame where the detector runs.
+
+    The frame is cropped to the configured rectangles, or to the bounding
+    rectangle of a mask, and the pixels outside the mask are grayed out.
+    Optionally, every crop is split into overlapping tiles of the model
+    input size, so that small objects of high resolution frames are not
+    downsampled. The crops of a frame are detected in a single batch and
+    their boxes are mapped back to the whole frame.
+    """
+
+    def __init__(self,
+                 rectangles=(),
+                 mask=None,
+                 tile_size=None,
+                 tile_overlap=0.2,
+                 merge_threshold=0.6,
+                 normalized=True):
+        """Class constructor.
+
+        Parameters
+        ----------
+        rectangles : list
+            List of (x1, y1, x2, y2) rectangles. If empty, the bounding
+            rectangle of the mask or the whole frame is used.
+        mask : str or numpy.ndarray
+            Path to a mask image, or the mask itself. Non-zero pixels are of
+            interest. It is resized to the frame size.
+        tile_size : int
+            Side of the square tiles in pixels, usually the model input
+            size. If None, the crops are not tiled.
+        tile_overlap : float
+            Fraction of the tile size shared by neighbouring tiles. It
+            should cover the largest objects to detect.
+        merge_threshold : float
+            Overlap over the smaller box above which boxes of different
+            crops are merged.
+        normalized : bool
+            Whether the rectangles are given relative to the frame size.
+        """
+
+        if isinstance(mask, str):
+            path = mask
+            mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+            if mask is None:
+                raise FileNotFoundError(f'Mask {path} could not be read.')
+
+        if mask is not None and mask.ndim == 3:
+            mask = mask.any(2)
+
+        if tile_size is not None and not 0 <= tile_overlap < 1:
+            raise ValueError('Tile overlap must be in [0, 1).')
+
+        self.rectangles = np.asarray(rectangles, dtype=float).reshape(-1, 4)
+        self.mask = None if mask is None else \
+            (np.asarray(mask) > 0).astype(np.uint8)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.merge_threshold = merge_threshold
+        self.normalized = normalized
+        self.scaled = {}
+
+    def key(self):
+        """Short hash of the configuration, to tell caches apart."""
+
+        digest = hashlib.sha1()
+        digest.update(self.rectangles.tobytes())
+        digest.update(repr((self.tile_size, self.tile_overlap,
+                            self.merge_threshold,
+                            self.normalized)).encode())
+
+        if self.mask is not None:
+            digest.update(repr(self.mask.shape).encode())
+            digest.update(self.mask.tobytes())
+
+        return digest.hexdigest()[:12]
+
+    def scale(self, frame_size):
+        """Crops and mask in pixels for a frame size, computed once.
+
+        Parameters
+        ----------
+        frame_size : tuple
+            (width, height) of the frames.
+
+        Returns
+        -------
+        windows : numpy.ndarray
+            (N, 4) integer x1, y1, x2, y2 pixel windows of the crops.
+        mask : numpy.ndarray
+            Boolean mask of the frame size, or None.
+        """
+
+        frame_size = tuple(frame_size)
+
+        if frame_size in self.scaled:
+            return self.scaled[frame_size]
+
+        width, height = frame_size
+        mask = None
+
+        if self.mask is not None:
+            mask = cv2.resize(self.mask, (width, height),
+                              interpolation=cv2.INTER_NEAREST) > 0
+
+        if len(self.rectangles):
+            rectangles = self.rectangles.copy()
+
+            if self.normalized:
+                rectangles *= [width, height, width, height]
+        elif mask is not None and mask.any():
+            x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
+            rectangles = np.array([[x, y, x + w, y + h]], dtype=float)
+        else:
+            rectangles = np.array([[0, 0, width, height]], dtype=float)
+
+        rectangles = np.rint(rectangles).astype(int)
+        rectangles[:, [0, 2]] = rectangles[:, [0, 2]].clip(0, width)
+        rectangles[:, [1, 3]] = rectangles[:, [1, 3]].clip(0, height)
+        rectangles = rectangles[(rectangles[:, 2] > rectangles[:, 0]) &
+                                (rectangles[:, 3] > rectangles[:, 1])]
+
+        if not len(rectangles):
+            raise ValueError(f'The region of interest is empty in frames '
+                             f'of size {frame_size}.')
+
+        if self.tile_size is None:
+            windows = rectangles
+        else:
+            tile = self.tile_size
+            step = max(1, round(tile * (1 - self.tile_overlap)))
+            windows = []
+
+            for x1, y1, x2, y2 in rectangles:
+                for y in tile_starts(y2 - y1, tile, step):
+                    for x in tile_starts(x2 - x1, tile, step):
+                        windows.append([x1 + x, y1 + y,
+                                        min(x1 + x + tile, x2),
+                                        min(y1 + y + tile, y2)])
+
+            windows = np.array(windows, dtype=int).reshape(-1, 4)
+
+        self.scaled[frame_size] = windows, mask
+
+        return windows, mask
+
+    def crop(self, frame):
+        """Crops of a frame to detect.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            Image.
+
+        Returns
+        -------
+        list
+            List of images, one per window.
+        """
+
+        height, width = frame.shape[:2]
+        windows, mask = self.scale((width, height))
+        crops = []
+
+        for x1, y1, x2, y2 in windows:
+            crop = frame[y1:y2, x1:x2]
+
+            if mask is not None:
+                crop = crop.copy()
+                crop[~mask[y1:y2, x1:x2]] = 114
+
+            crops.append(crop)
+
+        return crops
+
+    def merge(self, detections, frame_size):
+        """Maps the detections of the crops back to the frame.
+
+        Parameters
+        ----------
+        detections : list
+            List of (boxes, confidence, classes, names) tuples of the crops,
+            in the order of `crop`, with boxes relative to the crop size.
+        frame_size : tuple
+            (width, height) of the frame.
+
+        Returns
+        -------
+        tuple
+            (boxes, confidence, classes, names) of the frame, with boxes
+            relative to the frame size.
+        """
+
+        width, height = frame_size
+        windows, _ = self.scale(frame_size)
+
+        names = detections[0][3]
+        boxes = []
+
+        for (x1, y1, x2, y2), (crop_boxes, *_) in zip(windows, detections):
+            scale = np.array([x2 - x1, y2 - y1] * 2, dtype=float)
+            offset = np.array([x1, y1] * 2, dtype=float)
+            boxes.append(crop_boxes * scale + offset)
+
+        crops = np.repeat(np.arange(len(detections)),
+                          [len(crop_boxes) for crop_boxes, *_ in detections])
+        boxes = np.concatenate(boxes)
+        confidence = np.concatenate([confidence
+                                     for _, confidence, *_ in detections])
+        classes = np.concatenate([classes for _, _, classes, _ in detections])
+
+        if len(detections) > 1 and len(boxes):
+            keep, boxes = merge_nms(boxes, confidence, classes, crops,
+                                    self.merge_threshold)
+            confidence, classes = confidence[keep], classes[keep]
+
+        boxes = boxes / np.array([width, height] * 2, dtype=float)
+
+        return boxes.astype(confidence.dtype), confidence, classes, names
@@ -0,0 +1,415 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Segment-parallel tracking script.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+import cv2
+
+from ml.tracker.sort.sort import Sort
+from ml.tracker.sort.sort import iou_batch
+from ml.tracker.sort.sort import linear_assignment
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.detect import detect_batch
+from ml.detect import read_strided_frames
+from ml.detect import seek_frame
+from ml.tools import track_boxes
+from ml.track import save_json
+from ml.zones import default_counter
+
+
+logger = get_logger('segments')
+
+
+def split_segments(total_frames, segments, overlap=30):
+    """Splits a video into consecutive segments with a warm-up overlap.
+
+    Parameters
+    ----------
+    total_frames : int
+        Number of frames of the video.
+    segments : int
+        Number of segments.
+    overlap : int
+        Frames each segment starts before its own range, which are also
+        processed by the previous segment.
+
+    Returns
+    -------
+    list
+        List of (start, own_start, end) frame indices. A segment processes
+        the frames from `start` to `end` and owns the ones from `own_start`.
+    """
+
+    bounds = np.linspace(0, total_frames, segments + 1).astype(int)
+
+    return [(max(0, int(own_start) - overlap), int(own_start), int(end))
+            for own_start, end in zip(bounds[:-1], bounds[1:])
+            if end > own_start]
+
+
+def init_worker(threads=None):
+    """Limits the threads of each worker process."""
+
+    if threads is not None:
+        import torch
+        torch.set_num_threads(threads)
+
+
+def track_segment(video_path,
+                  segment,
+                  overlap=30,
+                  version=None,
+                  tracked_classes=None,
+                  tracking_params=None,
+                  threshold=0.5,
+                  batch_size=1,
+                  detection_stride=1,
+                  size=640,
+                  counter=None,
+                  roi=None):
+    """Tracks and counts the objects of a segment of a video.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to the video.
+    segment : tuple
+        (start, own_start, end) frame indices, as returned by
+        `split_segments`.
+    overlap : int
+        Frames at each end of the segment whose tracked boxes are kept to
+        stitch the tracks with the neighbouring segments.
+    version : str
+        Version of the model to use.
+    tracked_classes : list
+        List of classes to track.
+    tracking_params : dict
+        Parameters for tracking.
+    threshold : float
+        Threshold for detection.
+    batch_size : int
+        Number of frames per forward pass.
+    detection_stride : int
+        Runs the detector every `detection_stride` frames.
+    size : int
+        Model input size.
+    counter : Counter
+        Counting lines and zones. Defaults to `default_counter()`.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frames are detected.
+
+    Returns
+    -------
+    dict
+        Segment, counting events as (frame, track ID, name) tuples, and the
+        tracked [x1, y1, x2, y2, ID] boxes of the first and last `overlap`
+        frames by frame index.
+    """
+
+    start, own_start, end = segment
+
+    if tracking_params is None:
+        tracking_params = {'max_age': 10, 'min_hits': 2, 'iou_threshold': 0.25}
+
+    if counter is None:
+        counter = default_counter()
+
+    centroid_tracker = Sort(max_age=tracking_params['max_age'],
+                            min_hits=tracking_params['min_hits'],
+                            iou_threshold=tracking_params['iou_threshold'])
+    trackable_objects = {}
+    events = []
+    head = {}
+    tail = {}
+
+    # The frame indices must match the other segments for the stitching
+    vid = cv2.VideoCapture(video_path)
+    seek_frame(vid, start)
+    width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_index = start
+
+    for items in read_strided_frames(vid, batch_size, detection_stride,
+                                     retrieve_skipped=False):
+        items = items[:end - frame_index]
+        frames = [frame for frame, detect in items if detect]
+        detections = iter(detect_batch(frames, version, batch_size,
+                                       size=size, roi=roi))
+
+        for _, detect in items:
+            boxes, confidence, classes, names = \
+                next(detections) if detect else (None,) * 4
+
+            track_boxes(None, boxes, confidence, classes, names,
+                        centroid_tracker, trackable_objects,
+                        tracked_classes, threshold,
+                        draw=False,
+                        frame_size=(width, height),
+                        counter=counter,
+                        frame_index=frame_index,
+                        source=video_path)
+
+            for trackable_object, name in counter.events:
+                events.append((frame_index, trackable_object.objectID, name))
+
+            if frame_index < start + overlap:
+                head[frame_index] = centroid_tracker.get_output()
+
+            if frame_index >= end - overlap:
+                tail[frame_index] = centroid_tracker.get_output()
+
+            frame_index += 1
+
+        if frame_index >= end:
+            break
+
+    vid.release()
+
+    log_event(logger, 'segment_tracked', start=start, own_start=own_start,
+              end=frame_index, events=len(events))
+
+    return {'segment': (start, own_start, frame_index),
+            'events': events,
+            'head': head,
+            'tail': tail}
+
+
+def stitch_tracks(tail, head, iou_threshold=0.3):
+    """Matches the track IDs of two consecutive segments.
+
+    Parameters
+    ----------
+    tail : dict
+        Tracked boxes of the last frames of the first segment.
+    head : dict
+        Tracked boxes of the first frames of the second segment.
+    iou_threshold : float
+        Minimum mean IoU over the shared frames for two tracks to match.
+
+    Returns
+    -------
+    dict
+        Track ID in the second segment -> track ID in the first one.
+    """
+
+    frames = sorted(set(tail) & set(head))
+
+    if not frames:
+        return {}
+
+    tail_ids = np.unique(np.concatenate([tail[frame][:, 4]
+                                         for frame in frames]))
+    head_ids = np.unique(np.concatenate([head[frame][:, 4]
+                                         for frame in frames]))
+
+    if not len(tail_ids) or not len(head_ids):
+        return {}
+
+    # Mean IoU of every pair of tracks over the shared frames
+    iou = np.zeros((len(tail_ids), len(head_ids)))
+
+    for frame in frames:
+        a, b = tail[frame], head[frame]
+
+        if not len(a) or not len(b):
+            continue
+
+        rows = np.searchsorted(tail_ids, a[:, 4])
+        columns = np.searchsorted(head_ids, b[:, 4])
+        iou[np.ix_(rows, columns)] += iou_batch(a[:, :4], b[:, :4])
+
+    iou /= len(frames)
+    matches = linear_assignment(-iou)
+
+    return {int(head_ids[column]): int(tail_ids[row])
+            for row, column in matches
+            if iou[row, column] >= iou_threshold}
+
+
+def merge_segments(results, iou_threshold=0.3):
+    """Stitches the tracks of the segments and de-duplicates their counts.
+
+    Parameters
+    ----------
+    results : list
+        Results of `track_segment`, in frame order.
+    iou_threshold : float
+        Minimum mean IoU over the overlap for two tracks to match.
+
+    Returns
+    -------
+    list
+        List of (frame, global track ID, name) counting events, in frame
+        order, with at most one event per global track and name.
+    """
+
+    events = []
+    offset = 0
+    previous = None
+
+    for result in results:
+        ids = {}
+
+        if previous is not None:
+            matches = stitch_tracks(previous['tail'], result['head'],
+                                    iou_threshold)
+            ids = {head_id: previous['ids'][tail_id]
+                   for head_id, tail_id in matches.items()
+                   if tail_id in previous['ids']}
+
+        # Global IDs for every track of the segment
+        track_ids = {track_id for _, track_id, _ in result['events']}
+        for boxes in list(result['head'].values()) + \
+                list(result['tail'].values()):
+            track_ids.update(int(track_id) for track_id in boxes[:, 4])
+
+        for track_id in sorted(track_ids - set(ids)):
+            offset += 1
+            ids[track_id] = offset
+
+        _, own_start, _ = result['segment']
+        events.extend((frame, ids[track_id], name)
+                      for frame, track_id, name in result['events']
+                      if frame >= own_start)
+
+        previous = dict(result, ids=ids)
+
+    events.sort()
+    seen = set()
+    unique = []
+
+    for frame, track_id, name in events:
+        if (track_id, name) in seen:
+            continue
+
+        seen.add((track_id, name))
+        unique.append((frame, track_id, name))
+
+    return unique
+
+
+def object_tracking_in_segments(video_path,
+                                segments=None,
+                                overlap=30,
+                                workers=None,
+                                threads=None,
+                                version=None,
+                                tracked_classes=None,
+                                tracking_params=None,
+                                threshold=0.5,
+                                batch_size=1,
+                                detection_stride=1,
+                                size=640,
+                                counter=None,
+                                stitch_threshold=0.3,
+                                roi=None):
+    """Headless object tracking of a long video split across processes.
+
+    The video is split into segments that are tracked in a process pool,
+    each one with its own model and tracker. Every segment starts `overlap`
+    frames early so its tracks are established when its own range begins.
+    The tracks are stitched across segments by their IoU in the overlap,
+    and each object is counted at most once per line or zone.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to the video.
+    segments : int
+        Number of segments. Defaults to the number of workers.
+    overlap : int
+        Frames shared by consecutive segments. It should be larger than the
+        `min_hits` of the tracker.
+    workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    threads : int
+        Torch threads per worker. Defaults to the CPUs per worker.
+    version : str
+        Version of the model to use.
+    tracked_classes : list
+        List of classes to track.
+    tracking_params : dict
+        Parameters for tracking.
+    threshold : float
+        Threshold for detection.
+    batch_size : int
+        Number of frames per forward pass.
+    detection_stride : int
+        Runs the detector every `detection_stride` frames.
+    size : int
+        Model input size.
+    counter : Counter
+        Counting lines and zones. Each segment counts with a copy, and the
+        merged counts are set on it. Defaults to `default_counter()`.
+    stitch_threshold : float
+        Minimum mean IoU over the overlap for two tracks to be stitched.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frames are detected.
+
+    Returns
+    -------
+    int
+        Total of counted objects.
+    """
+
+    if counter is None:
+        counter = default_counter()
+
+    cpus = os.cpu_count() or 1
+    workers = workers or cpus
+    segments = segments or workers
+    threads = threads or max(1, cpus // workers)
+
+    vid = cv2.VideoCapture(video_path)
+    total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    vid.release()
+
+    bounds = split_segments(total_frames, segments, overlap)
+    log_event(logger, 'processing_video', video=video_path,
+              frames=total_frames, segments=len(bounds), workers=workers)
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(threads,)) as executor:
+        futures = [executor.submit(track_segment, video_path, segment,
+                                   overlap, version, tracked_classes,
+                                   tracking_params, threshold, batch_size,
+                                   detection_stride, size, counter, roi)
+                   for segment in bounds]
+        results = [future.result() for future in futures]
+
+    events = merge_segments(results, stitch_threshold)
+
+    counter.counts = {name: 0 for name in counter.names}
+    counts = []
+
+    for total, (frame, _, name) in enumerate(events, start=1):
+        counter.counts[name] += 1
+        counts.append([frame, total])
+
+    output_file = video_path.split('.')[0] + '_counts.json'
+
+    save_json(output_file,
+              {'video': video_path,
+               'frames': results[-1]['segment'][2] if results else 0,
+               'total': len(events),
+               'lines': counter.counts,
+               'counts': counts,
+               'events': events,
+               'segments': [result['segment'] for result in results]})
+
+    log_event(logger, 'counts_saved', path=output_file, total=len(events))
+
+    return len(events)
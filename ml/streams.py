@@ -0,0 +1,464 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Multi-stream tracking script.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from time import monotonic
+
+from tqdm import tqdm
+import cv2
+
+from ml.tracker.sort.sort import Sort
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.metrics import metrics
+from ml.pipeline import Pipeline
+from ml.detect import detect_batch
+from ml.detect import read_strided_frames
+from ml.tools import track_boxes
+from ml.tools import display_counts
+from ml.track import save_counts
+from ml.track import track_record
+from ml.zones import default_counter
+
+
+logger = get_logger('streams')
+
+
+class Stream:
+    """Capture, tracker and counter of one video source.
+
+    Every stream has its own Sort instance, and so its own object IDs,
+    trackable objects and counts.
+    """
+
+    def __init__(self,
+                 video_path,
+                 tracking_params,
+                 counter=None,
+                 headless=False,
+                 detection_stride=1,
+                 max_stride=None,
+                 sink=None,
+                 motion_gate=None,
+                 roi=None):
+        """Class constructor.
+
+        Parameters
+        ----------
+        video_path : str
+            Path to the video.
+        tracking_params : dict
+            Parameters for tracking.
+        counter : Counter
+            Counting lines and zones. Defaults to `default_counter()`.
+        headless : bool
+            Only tracks and counts, and writes the counts and track records
+            to a '_counts.json' file instead of the processed video.
+        detection_stride : int
+            Runs the detector every `detection_stride` frames.
+        max_stride : int
+            Adaptive stride used while there are no live tracks. It reacts
+            to the tracks one round late.
+        sink : callable
+            Called with the video path and every trackable object evicted
+            once its track ends.
+        motion_gate : MotionGate
+            If given, frames without motion skip the detector while there
+            are no live tracks.
+        roi : RegionOfInterest
+            If given, only its crops or tiles of the frames are detected.
+        """
+
+        self.video_path = video_path
+        self.counter = counter if counter is not None else default_counter()
+        self.headless = headless
+        self.detection_stride = detection_stride
+        self.max_stride = max_stride
+        self.sink = sink
+        self.motion_gate = motion_gate
+        self.roi = roi
+
+        self.centroid_tracker = Sort(
+            max_age=tracking_params['max_age'],
+            min_hits=tracking_params['min_hits'],
+            iou_threshold=tracking_params['iou_threshold'])
+        self.trackable_objects = {}
+        self.live_tracks = 0
+        self.total = 0
+        self.frame_index = 0
+        self.counts = []
+        self.tracks = []
+
+        self.vid = cv2.VideoCapture(video_path)
+        width = int(self.vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.vid.get(cv2.CAP_PROP_FPS)
+        self.total_frames = int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.vid_size = (width, height)
+
+        self.output_file = video_path.split('.')[0]
+        self.output_file += '_counts.json' if headless else '_processed.mp4'
+        self.out = None
+
+        if not headless:
+            codec = cv2.VideoWriter_fourcc(*'XVID')
+            self.out = cv2.VideoWriter(self.output_file, codec,
+                                       int(self.fps), self.vid_size)
+
+        self.reader = read_strided_frames(self.vid, 1, self.stride,
+                                          retrieve_skipped=not headless)
+        self.finished = False
+
+    def stride(self):
+        """Frames until the next detection."""
+
+        if self.max_stride is not None and not self.live_tracks:
+            return self.max_stride
+
+        return self.detection_stride
+
+    def needs_detection(self, frame):
+        """Whether a frame to detect passes the motion gate."""
+
+        if self.motion_gate is None or self.live_tracks:
+            return True
+
+        with metrics.time('motion_gate'):
+            return self.motion_gate.moving(frame)
+
+    def read(self):
+        """Reads the frames up to the next one to detect.
+
+        Returns
+        -------
+        list
+            List of (frame, detect) tuples, empty once the video ends.
+        """
+
+        items = next(self.reader, [])
+
+        if not items:
+            self.finished = True
+
+        return items
+
+    def record(self, trackable_object):
+        """Keeps the record of an evicted trackable object."""
+
+        if self.headless:
+            self.tracks.append(track_record(trackable_object,
+                                            self.frame_index))
+
+        if self.sink is not None:
+            self.sink(self.video_path, trackable_object)
+
+    def track(self,
+              image,
+              detections,
+              tracked_classes=None,
+              threshold=0.5,
+              color=(245, 135, 66),
+              logo_path=None,
+              position='top'):
+        """Tracks and counts the objects of the next frame.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            Frame, or None if it was not decoded.
+        detections : tuple
+            (boxes, confidence, classes, names), all None if the detector
+            was skipped on this frame.
+        tracked_classes : list
+            List of classes to track.
+        threshold : float
+            Threshold for detection.
+        color : tuple
+            Color for the bounding boxes.
+        logo_path : str
+            Path to the logo.
+        position : str
+            Position of the logo.
+
+        Returns
+        -------
+        numpy.ndarray
+            Processed frame, None in headless mode.
+        """
+
+        boxes, confidence, classes, names = detections
+        timestamp = round(self.frame_index / self.fps, 3) if self.fps \
+            else None
+
+        image, total = track_boxes(image, boxes, confidence, classes, names,
+                                   self.centroid_tracker,
+                                   self.trackable_objects,
+                                   tracked_classes, threshold, color,
+                                   logo_path, position,
+                                   sink=self.record,
+                                   draw=not self.headless,
+                                   frame_size=self.vid_size,
+                                   counter=self.counter,
+                                   frame_index=self.frame_index,
+                                   timestamp=timestamp,
+                                   source=self.video_path)
+        self.total += total
+
+        # Published for the reader and the motion gate, which may run on
+        # other threads while the tracker changes
+        self.live_tracks = len(self.centroid_tracker.live_ids())
+
+        if total:
+            self.counts.append([self.frame_index, self.total])
+
+        if not self.headless:
+            with metrics.time('drawing'):
+                image = display_counts(image, self.counter.counts, position,
+                                       color)
+
+        self.frame_index += 1
+
+        return image
+
+    def write(self, image):
+        """Writes a processed frame."""
+
+        if self.out is not None:
+            with metrics.time('encode'):
+                self.out.write(image)
+
+    def close(self):
+        """Releases the capture and writer, and saves the counts."""
+
+        self.vid.release()
+
+        if self.out is not None:
+            self.out.release()
+
+        if self.headless:
+            save_counts(self.output_file, self.video_path, self.frame_index,
+                        self.total, self.counter, self.counts, self.tracks,
+                        self.trackable_objects)
+
+
+def object_tracking_in_streams(video_paths,
+                               version=None,
+                               tracked_classes=None,
+                               tracking_params=None,
+                               threshold=0.5,
+                               color=(245, 135, 66),
+                               logo_path=None,
+                               position='top',
+                               batch_size=8,
+                               mode='serial',
+                               queue_size=8,
+                               sink=None,
+                               headless=False,
+                               detection_stride=1,
+                               max_stride=None,
+                               size=640,
+                               counters=None,
+                               summary_interval=10.,
+                               motion_gates=None,
+                               rois=None):
+    """Object tracking in several videos at once with a shared model.
+
+    Frames are read from every source in turn, and the ones to detect are
+    run together through a single loaded model. Each source keeps its own
+    tracker, object IDs and counters.
+
+    Parameters
+    ----------
+    video_paths : list
+        Paths to the videos.
+    version : str
+        Version of the model to use.
+    tracked_classes : list
+        List of classes to track.
+    tracking_params : dict
+        Parameters for tracking, shared by every source.
+    threshold : float
+        Threshold for detection.
+    color : tuple
+        Color for the bounding boxes.
+    logo_path : str
+        Path to the logo.
+    position : str
+        Position of the logo.
+    batch_size : int
+        Maximum number of frames per forward pass.
+    mode : str
+        Execution mode. 'serial' runs everything on the calling thread,
+        'threaded' runs decode, inference, tracking and encode as separate
+        stages connected by bounded queues.
+    queue_size : int
+        Maximum number of rounds waiting between stages in 'threaded' mode.
+    sink : callable
+        Called with the video path and every trackable object evicted once
+        its track ends.
+    headless : bool
+        Headless analytics mode. Writes a '_counts.json' file per source
+        instead of the processed videos.
+    detection_stride : int
+        Runs the detector every `detection_stride` frames of each source.
+    max_stride : int
+        Adaptive stride used by a source while it has no live tracks.
+    size : int
+        Model input size.
+    counters : list
+        Counter of each source, in the order of `video_paths`. Defaults to
+        a `default_counter()` per source.
+    summary_interval : float
+        Seconds between the periodic summary log records.
+    motion_gates : list
+        MotionGate of each source (or None), in the order of `video_paths`.
+        Frames without motion skip the detector while their source has no
+        live tracks.
+    rois : list
+        RegionOfInterest of each source (or None), in the order of
+        `video_paths`. The crops of every source run in the same batches.
+
+    Returns
+    -------
+    dict
+        Video path -> total of counted objects.
+    """
+
+    if tracking_params is None:
+        tracking_params = {'max_age': 10, 'min_hits': 2, 'iou_threshold': 0.25}
+
+    if counters is None:
+        counters = [None] * len(video_paths)
+
+    if motion_gates is None:
+        motion_gates = [None] * len(video_paths)
+
+    if rois is None:
+        rois = [None] * len(video_paths)
+
+    if len(counters) != len(video_paths):
+        raise ValueError(f'Expected {len(video_paths)} counters, got '
+                         f'{len(counters)}.')
+
+    if len(motion_gates) != len(video_paths):
+        raise ValueError(f'Expected {len(video_paths)} motion gates, got '
+                         f'{len(motion_gates)}.')
+
+    if len(rois) != len(video_paths):
+        raise ValueError(f'Expected {len(video_paths)} regions of interest, '
+                         f'got {len(rois)}.')
+
+    streams = [Stream(video_path, tracking_params, counter, headless,
+                      detection_stride, max_stride, sink, motion_gate, roi)
+               for video_path, counter, motion_gate, roi
+               in zip(video_paths, counters, motion_gates, rois)]
+
+    for stream in streams:
+        log_event(logger, 'processing_video', video=stream.video_path,
+                  frames=stream.total_frames)
+
+    pbar = tqdm(total=sum(stream.total_frames for stream in streams))
+
+    frames = 0
+    start_time = monotonic()
+    last_summary = start_time
+
+    def log_summary(force=False):
+        nonlocal last_summary
+        now = monotonic()
+
+        if not force and now - last_summary < summary_interval:
+            return
+
+        last_summary = now
+        log_event(logger, 'summary', streams=len(streams), frames=frames,
+                  total=sum(stream.total for stream in streams),
+                  fps=round(frames / (now - start_time), 2))
+
+    def rounds():
+        # One group of frames per source and round, up to the next frame
+        # to detect, so the sources advance at the same pace
+        active = list(streams)
+
+        while active:
+            items = [(stream, frame, detect)
+                     for stream in active
+                     for frame, detect in stream.read()]
+            active = [stream for stream in active if not stream.finished]
+
+            if items:
+                yield items
+
+    def infer(items):
+        items = [(stream, frame, detect and stream.needs_detection(frame))
+                 for stream, frame, detect in items]
+        images = [frame for _, frame, detect in items if detect]
+        regions = [stream.roi for stream, _, detect in items if detect]
+        detections = iter(detect_batch(images, version, batch_size,
+                                       size=size,
+                                       roi=regions if any(regions) else None))
+
+        return [(stream, frame, next(detections) if detect else (None,) * 4)
+                for stream, frame, detect in items]
+
+    def track(items):
+        nonlocal frames
+        images = []
+
+        for stream, img, detections in items:
+            img = stream.track(img, detections, tracked_classes, threshold,
+                               color, logo_path, position)
+            images.append((stream, img))
+            frames += 1
+
+        log_summary()
+
+        return images
+
+    def write(images):
+        for stream, img in images:
+            stream.write(img)
+
+        pbar.update(len(images))
+
+        if mode == 'threaded':
+            pbar.set_postfix(pipeline.queue_depths())
+
+    pipeline = Pipeline(rounds(), [infer, track], write,
+                        mode=mode,
+                        queue_size=queue_size,
+                        names=['decoded', 'detected', 'tracked'])
+
+    pipeline.run()
+    pbar.close()
+
+    for stream in streams:
+        stream.close()
+
+    if mode == 'threaded':
+        log_event(logger, 'max_queue_depths', **pipeline.max_queue_depths())
+
+    log_summary(force=True)
+
+    totals = {}
+
+    for stream in streams:
+        log_event(logger, 'stream_total', video=stream.video_path,
+                  frames=stream.frame_index, total=stream.total,
+                  lines=stream.counter.counts)
+
+        if stream.motion_gate is not None:
+            log_event(logger, 'motion_gate', video=stream.video_path,
+                      **stream.motion_gate.stats())
+
+        totals[stream.video_path] = stream.total
+
+    return totals
@@ -0,0 +1,78 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the exported model backends.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import numpy as np
+import pytest
+import cv2
+
+from ml.backends import Backend
+
+
+class FirstChannelBackend(Backend):
+    """Detects the bright region of the first channel of the input."""
+
+    def __init__(self):
+        super().__init__('first_channel')
+        self.names = {0: 'car'}
+
+    def forward(self, batch):
+        predictions = []
+
+        for image in batch:
+            ys, xs = np.nonzero(image[0] > 0.8)
+            x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+            predictions.append([[(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1,
+                                 y2 - y1, 0.9, 1.]])
+
+        return np.array(predictions, dtype=np.float32)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    """Image with a red square on the left and a blue one on the right."""
+
+    image = np.zeros((120, 200, 3), np.uint8)
+    image[20:60, 10:50] = (255, 0, 0)
+    image[50:100, 130:190] = (0, 0, 255)
+    path = str(tmp_path / 'squares.png')
+    cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+    return path
+
+
+def test_paths_are_read_like_the_hub_model(image_path):
+    Image = pytest.importorskip('PIL.Image')
+    backend = FirstChannelBackend()
+
+    # The hub model opens paths with PIL and uses arrays as given
+    hub_input = np.asarray(Image.open(image_path).convert('RGB'))
+    from_path = backend(image_path, size=224).xyxyn[0]
+    from_array = backend(hub_input, size=224).xyxyn[0]
+
+    np.testing.assert_allclose(from_path, from_array)
+    np.testing.assert_allclose(from_path[0, :4], [10 / 200, 20 / 120,
+                                                  50 / 200, 60 / 120],
+                               atol=0.02)
+
+    # Frames decoded by OpenCV are BGR, so they see the other square
+    bgr = backend(cv2.imread(image_path), size=224).xyxyn[0]
+    assert bgr[0, 0] > 0.5
+
+
+def test_missing_image_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        FirstChannelBackend()(str(tmp_path / 'missing.png'))
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        Backend('model.onnx')
@@ -0,0 +1,77 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the detection cache.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import os
+
+import numpy as np
+
+from ml.cache import DetectionCacheWriter
+
+
+NAMES = {0: 'car', 2: 'truck'}
+
+
+def detections(index):
+    """Detections of a frame: some skipped, some empty, some with rows."""
+
+    if index % 5 == 4:
+        return None, None, None, None
+
+    n = index % 3
+    boxes = np.full((n, 4), index / 100., dtype=np.float32)
+    confidence = np.full(n, 0.5 + index / 1000., dtype=np.float32)
+
+    return boxes, confidence, np.full(n, 2.), NAMES
+
+
+def test_streamed_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'cache')
+    writer = DetectionCacheWriter(path, {'video': 'squares.avi'},
+                                  chunk_size=4)
+
+    for index in range(23):
+        writer.append(detections(index))
+
+        # Only the frames since the last chunk are kept in memory
+        assert len(writer.chunk['detected']) < 4
+
+    cache = writer.save()
+
+    assert len(cache) == 23
+    assert cache.meta['video'] == 'squares.avi'
+    assert cache.names == NAMES
+    assert not os.path.exists(path + '.tmp')
+
+    for index in range(23):
+        boxes, confidence, classes, names = detections(index)
+        cached = cache[index]
+
+        if boxes is None:
+            assert cached == (None, None, None, None)
+            continue
+
+        np.testing.assert_array_equal(cached[0], boxes)
+        np.testing.assert_array_equal(cached[1], confidence)
+        np.testing.assert_array_equal(cached[2], classes)
+        assert cached[3] == NAMES
+
+
+def test_empty_cache(tmp_path):
+    path = str(tmp_path / 'cache')
+    os.makedirs(path)
+
+    # A stale cache is replaced, even by an empty one
+    cache = DetectionCacheWriter(path).save()
+
+    assert len(cache) == 0
+    assert cache.boxes.shape == (0, 4)
+    assert cache.offsets.tolist() == [0]
@@ -0,0 +1,227 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the tracking checkpoints.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import json
+import os
+
+import numpy as np
+import pytest
+import cv2
+
+from ml import track
+from ml.checkpoint import load_checkpoint
+from ml.detect import seek_frame
+from ml.tracker.trackable_object import TrackableObject
+
+
+WIDTH, HEIGHT = 320, 180
+FRAMES = 150
+
+
+class Killed(Exception):
+    """Stands for the process being killed in the middle of a video."""
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """MJPEG video of bright squares crossing the counting line."""
+
+    path = str(tmp_path_factory.mktemp('video') / 'squares.avi')
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30,
+                          (WIDTH, HEIGHT))
+
+    for index in range(FRAMES):
+        image = np.zeros((HEIGHT, WIDTH, 3), np.uint8)
+
+        for square in range(8):
+            x = 150 + 4 * (index - 12 * square)
+            y = 10 + 20 * square
+
+            if index >= 12 * square and x + 20 < WIDTH:
+                image[y:y + 16, x:x + 20] = 255
+
+        out.write(image)
+
+    out.release()
+
+    return path
+
+
+def detect_squares(frames, *args, **kwargs):
+    """Detector of the bright squares of the synthetic video."""
+
+    detections = []
+
+    for frame in frames:
+        mask = (frame[..., 1] > 200).astype(np.uint8)
+        n, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        x, y, w, h = stats[1:, :4].T.astype(np.float32)
+        boxes = np.stack((x / WIDTH, y / HEIGHT, (x + w) / WIDTH,
+                          (y + h) / HEIGHT), axis=1)
+        detections.append((boxes, np.full(n - 1, 0.9, dtype=np.float32),
+                           np.zeros(n - 1), {0: 'car'}))
+
+    return detections
+
+
+def killed_after(calls):
+    """Detector that kills the run on one of its calls."""
+
+    count = 0
+
+    def detect_batch(frames, *args, **kwargs):
+        nonlocal count
+        count += 1
+
+        if count == calls:
+            raise Killed()
+
+        return detect_squares(frames)
+
+    return detect_batch
+
+
+def run(video, output_file, **kwargs):
+    track.object_tracking_in_video(video, tracked_classes=['car'],
+                                   headless=True, output_file=output_file,
+                                   **kwargs)
+
+    with open(output_file) as counts_file:
+        return json.load(counts_file)
+
+
+@pytest.mark.parametrize('mode', ['serial', 'threaded'])
+@pytest.mark.parametrize('batch_size', [1, 2, 3, 4])
+@pytest.mark.parametrize('detection_stride', [1, 2])
+def test_resume_matches_uninterrupted_run(video, tmp_path, monkeypatch, mode,
+                                          batch_size, detection_stride):
+    options = {'mode': mode, 'batch_size': batch_size,
+               'detection_stride': detection_stride}
+    checkpoint_path = str(tmp_path / 'squares_checkpoint.pkl')
+
+    monkeypatch.setattr(track, 'detect_batch', detect_squares)
+    expected = run(video, str(tmp_path / 'expected.json'), **options)
+    assert expected['total'] == 8
+
+    # Killed halfway, then resumed from the last checkpoint
+    calls = FRAMES // (detection_stride * batch_size) // 2
+    monkeypatch.setattr(track, 'detect_batch', killed_after(calls))
+
+    with pytest.raises(Killed):
+        run(video, str(tmp_path / 'resumed.json'),
+            checkpoint_path=checkpoint_path, checkpoint_interval=10,
+            **options)
+
+    state = load_checkpoint(checkpoint_path)
+    records_path = str(tmp_path / 'squares_checkpoint_tracks.jsonl')
+    assert 0 < state['frame_index'] < FRAMES
+    assert state['tracks'] <= os.path.getsize(records_path)
+
+    # Records written after the checkpoint are dropped when resuming
+    with open(records_path, 'a') as records_file:
+        records_file.write(json.dumps({'object_id': -1}) + '\n')
+
+    monkeypatch.setattr(track, 'detect_batch', detect_squares)
+    resumed = run(video, str(tmp_path / 'resumed.json'),
+                  checkpoint_path=checkpoint_path, checkpoint_interval=10,
+                  **options)
+
+    assert resumed == expected
+    assert not os.path.exists(checkpoint_path)
+    assert not os.path.exists(records_path)
+
+
+def histories(spill_dir):
+    """Spilled histories by file name."""
+
+    return {name: TrackableObject.load_history(os.path.join(spill_dir,
+                                                            name)).tolist()
+            for name in sorted(os.listdir(spill_dir))}
+
+
+def test_resume_keeps_spilled_histories(video, tmp_path, monkeypatch):
+    spill_dir = str(tmp_path / 'history')
+    checkpoint_path = str(tmp_path / 'squares_checkpoint.pkl')
+    options = {'batch_size': 2, 'spill_dir': spill_dir}
+
+    monkeypatch.setattr(track, 'detect_batch', detect_squares)
+    expected = run(video, str(tmp_path / 'expected.json'), **options)
+    expected_histories = histories(spill_dir)
+
+    for record in expected['tracks']:
+        history = TrackableObject.load_history(record['history'])
+        assert len(history) == record['hits']
+        assert history[-1].tolist() == record['last_centroid']
+
+    # Killed after objects spilled and were evicted past the checkpoint
+    monkeypatch.setattr(track, 'detect_batch', killed_after(40))
+
+    with pytest.raises(Killed):
+        run(video, str(tmp_path / 'resumed.json'),
+            checkpoint_path=checkpoint_path, checkpoint_interval=10,
+            **options)
+
+    monkeypatch.setattr(track, 'detect_batch', detect_squares)
+    resumed = run(video, str(tmp_path / 'resumed.json'),
+                  checkpoint_path=checkpoint_path, checkpoint_interval=10,
+                  **options)
+
+    assert resumed == expected
+    assert histories(spill_dir) == expected_histories
+
+
+def test_seek_frame(video):
+    vid = cv2.VideoCapture(video)
+    frames = [vid.read()[1] for _ in range(FRAMES)]
+
+    for index in (0, 37, FRAMES - 1):
+        seek_frame(vid, index)
+        _, frame = vid.read()
+        np.testing.assert_array_equal(frame, frames[index])
+
+    vid.release()
+
+
+class StuckCapture:
+    """Capture whose seeks are ignored, reading frames by index."""
+
+    def __init__(self, frames):
+        self.position = 0
+        self.frames = frames
+
+    def set(self, prop, value):
+        if value == 0:
+            self.position = 0
+
+        return True
+
+    def get(self, prop):
+        return self.position
+
+    def grab(self):
+        if self.position >= self.frames:
+            return False
+
+        self.position += 1
+
+        return True
+
+
+def test_seek_frame_grabs_forward_when_seeking_fails():
+    vid = StuckCapture(20)
+    vid.position = 5
+
+    seek_frame(vid, 12)
+    assert vid.position == 12
+
+    with pytest.raises(IOError):
+        seek_frame(vid, 25)
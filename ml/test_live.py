@@ -0,0 +1,160 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the live-stream tracking.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from time import sleep
+from time import time
+import json
+
+import numpy as np
+
+from ml import live
+
+
+WIDTH, HEIGHT = 640, 360
+
+
+def frame(index):
+    """Synthetic frame that carries its own index."""
+
+    return np.broadcast_to(np.int32(index), (HEIGHT, WIDTH, 3))
+
+
+class SyntheticSource:
+    """Capture-like source of synthetic frames."""
+
+    def __init__(self, frames):
+        self.frames = iter(range(frames))
+
+    def read(self):
+        index = next(self.frames, None)
+
+        if index is None:
+            return False, None
+
+        return True, frame(index)
+
+
+class ScriptedReader:
+    """Reader that hands out a fixed script of frames.
+
+    Each entry of the script is (index, age): the index of the frame in the
+    source, so the indices skipped were dropped, and how many seconds ago it
+    was captured when it is taken.
+    """
+
+    def __init__(self, script):
+        self.script = iter(script)
+        self.ended = False
+
+    def start(self):
+        return self
+
+    def get(self, timeout=None):
+        item = next(self.script, None)
+
+        if item is None:
+            self.ended = True
+            return None
+
+        index, age = item
+
+        return index, frame(index), time() - age
+
+    def stop(self, timeout=None):
+        pass
+
+
+def moving_object(slow_frames=(), delay=0.):
+    """Detector of one car moving right 6 pixels per frame.
+
+    Parameters
+    ----------
+    slow_frames : tuple
+        Frame indices whose detection takes `delay` seconds.
+    delay : float
+        Seconds to wait in the slow frames.
+    """
+
+    calls = []
+
+    def detect_batch(frames, *args, **kwargs):
+        detections = []
+
+        for image in frames:
+            index = int(image[0, 0, 0])
+            calls.append(index)
+
+            if index in slow_frames:
+                sleep(delay)
+
+            x = 20. + 6 * index
+            boxes = np.array([[x / WIDTH, 150 / HEIGHT, (x + 40) / WIDTH,
+                               180 / HEIGHT]], dtype=np.float32)
+            detections.append((boxes, np.array([0.9], dtype=np.float32),
+                               np.array([0.]), {0: 'car'}))
+
+        return detections
+
+    return detect_batch, calls
+
+
+def test_dropped_stale_and_late_frames(monkeypatch, tmp_path):
+    # Frames 10 to 39 are dropped, longer than max_age, frame 55 is taken
+    # over the latency budget and the detection of frame 60 ends late
+    script = [(index, 0.) for index in range(10)] + \
+        [(index, 0.) for index in range(40, 51)] + \
+        [(55, 1.)] + \
+        [(index, 0.) for index in range(56, 100)]
+    detect_batch, calls = moving_object(slow_frames=(60,), delay=0.3)
+
+    monkeypatch.setattr(live, 'LatestFrameReader',
+                        lambda capture, fps: ScriptedReader(script))
+    monkeypatch.setattr(live, 'detect_batch', detect_batch)
+
+    output_path = str(tmp_path / 'live_counts.json')
+    result = live.object_tracking_live(SyntheticSource(0),
+                                       tracked_classes=['car'],
+                                       latency_budget=0.2,
+                                       output_path=output_path)
+
+    assert result == {'total': 1, 'frames': 100, 'processed': 65,
+                      'dropped': 34, 'stale': 1, 'late': 1}
+    assert 55 not in calls and len(calls) == 65
+
+    with open(output_path) as counts_file:
+        counts = json.load(counts_file)
+
+    # The car keeps its track over the gap and is counted once
+    assert len({track['object_id'] for track in counts['tracks']}) == 1
+    assert counts['lines'] == {'Right exit': 1}
+
+
+def test_latest_frame_reader_keeps_newest_frame():
+    reader = live.LatestFrameReader(SyntheticSource(50), fps=500).start()
+    indices = []
+
+    while True:
+        item = reader.get(timeout=5.)
+
+        if item is None:
+            break
+
+        index, image, _ = item
+        assert int(image[0, 0, 0]) == index
+        indices.append(index)
+        sleep(0.01)
+
+    reader.stop()
+
+    assert reader.ended and reader.captured == 50
+    assert indices == sorted(set(indices))
+    assert len(indices) < 50
@@ -0,0 +1,118 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the regions of interest and tiled inference.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import numpy as np
+import pytest
+
+from ml.roi import RegionOfInterest
+from ml.roi import merge_nms
+from ml.roi import tile_starts
+
+
+def test_tile_starts():
+    assert tile_starts(500, 640, 512) == [0]
+    assert tile_starts(640, 640, 512) == [0]
+    assert tile_starts(641, 640, 512) == [0, 1]
+    assert tile_starts(1920, 640, 512) == [0, 512, 1024, 1280]
+    assert tile_starts(1536, 640, 512) == [0, 512, 896]
+
+
+def test_tile_starts_cover_length():
+    for length in range(1, 3000, 37):
+        for tile, step in [(640, 512), (320, 320), (100, 1)]:
+            starts = tile_starts(length, tile, step)
+
+            assert starts[0] == 0
+            assert starts == sorted(set(starts))
+            assert min(starts[-1] + tile, length) == length
+            assert all(b - a <= step for a, b in zip(starts, starts[1:]))
+
+
+def test_merge_nms_merges_tile_duplicates():
+    # An object cut by the border of two tiles, and another one only
+    # detected by the second tile
+    boxes = np.array([[100., 50., 200., 90.],
+                      [150., 50., 260., 90.],
+                      [400., 10., 420., 30.]])
+    scores = np.array([0.7, 0.9, 0.8])
+    classes = np.array([2, 2, 2])
+    crops = np.array([0, 1, 1])
+
+    keep, merged = merge_nms(boxes, scores, classes, crops, threshold=0.4)
+
+    np.testing.assert_array_equal(keep, [1, 2])
+    np.testing.assert_array_equal(merged, [[100., 50., 260., 90.],
+                                           [400., 10., 420., 30.]])
+
+
+def test_merge_nms_keeps_equal_scores_whole():
+    # The partial box comes first on equal scores, but the kept box is
+    # still grown to the whole object
+    boxes = np.array([[100., 50., 130., 90.],
+                      [100., 50., 200., 90.]])
+    scores = np.array([0.8, 0.8])
+
+    keep, merged = merge_nms(boxes, scores, np.zeros(2), np.array([0, 1]))
+
+    np.testing.assert_array_equal(keep, [0])
+    np.testing.assert_array_equal(merged, [[100., 50., 200., 90.]])
+
+
+def test_merge_nms_only_merges_across_crops_and_classes():
+    boxes = np.array([[0., 0., 100., 100.]] * 3)
+    scores = np.array([0.9, 0.8, 0.7])
+
+    # Same crop: the model already suppressed its duplicates
+    keep, _ = merge_nms(boxes, scores, np.zeros(3), np.zeros(3))
+    np.testing.assert_array_equal(keep, [0, 1, 2])
+
+    # Different classes are never merged
+    keep, _ = merge_nms(boxes, scores, np.arange(3), np.arange(3))
+    np.testing.assert_array_equal(keep, [0, 1, 2])
+
+    keep, _ = merge_nms(boxes, scores, np.zeros(3), np.arange(3))
+    np.testing.assert_array_equal(keep, [0])
+
+
+def test_tiles_cover_frame():
+    roi = RegionOfInterest(tile_size=640, tile_overlap=0.2)
+    windows, mask = roi.scale((1920, 1080))
+
+    assert mask is None
+    assert len(windows) == 4 * 2
+    assert windows[:, 0].min() == 0 and windows[:, 2].max() == 1920
+    assert windows[:, 1].min() == 0 and windows[:, 3].max() == 1080
+    assert ((windows[:, 2:] - windows[:, :2]) == 640).all()
+
+
+def test_merge_maps_crops_to_frame():
+    roi = RegionOfInterest(rectangles=[(0., 0., 0.5, 1.), (0.5, 0., 1., 1.)])
+    names = {0: 'car'}
+    boxes = np.array([[0.5, 0.25, 1., 0.75]], dtype=np.float32)
+    detections = [(boxes, np.array([0.9], dtype=np.float32),
+                   np.array([0.]), names),
+                  (np.empty((0, 4), dtype=np.float32),
+                   np.empty(0, dtype=np.float32), np.empty(0), names)]
+
+    boxes, confidence, classes, merged_names = roi.merge(detections,
+                                                         (400, 200))
+
+    np.testing.assert_allclose(boxes, [[0.25, 0.25, 0.5, 0.75]])
+    np.testing.assert_allclose(confidence, [0.9])
+    assert merged_names is names
+
+
+def test_empty_region_raises():
+    roi = RegionOfInterest(rectangles=[(1.2, 0., 1.5, 1.)])
+
+    with pytest.raises(ValueError):
+        roi.scale((640, 480))
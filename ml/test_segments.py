@@ -0,0 +1,115 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the segment stitching.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import numpy as np
+
+from ml.segments import merge_segments
+from ml.segments import split_segments
+from ml.segments import stitch_tracks
+
+
+def tracked(*tracks):
+    """Tracker output of a frame from (x, y, track ID) tuples."""
+
+    return np.array([[x, y, x + 40, y + 30, track_id]
+                     for x, y, track_id in tracks],
+                    dtype=float).reshape(-1, 5)
+
+
+def overlap(frames, tracks, shift=0.):
+    """Tracked boxes over some frames, moving right 5 pixels per frame.
+
+    Parameters
+    ----------
+    frames : range
+        Frame indices.
+    tracks : list
+        (x, y, track ID) of every track at the first frame.
+    shift : float
+        Offset added to every box, to simulate a different detection.
+    """
+
+    return {frame: tracked(*[(x + 5 * step + shift, y + shift, track_id)
+                             for x, y, track_id in tracks])
+            for step, frame in enumerate(frames)}
+
+
+def test_split_segments():
+    assert split_segments(100, 4, overlap=10) == \
+        [(0, 0, 25), (15, 25, 50), (40, 50, 75), (65, 75, 100)]
+    assert split_segments(3, 5, overlap=2) == \
+        [(0, 0, 1), (0, 1, 2), (0, 2, 3)]
+
+
+def test_stitch_tracks_matches_by_iou():
+    frames = range(90, 100)
+    tail = overlap(frames, [(0, 0, 7), (200, 0, 8), (400, 300, 9)])
+    head = overlap(frames, [(400, 300, 1), (1, 1, 2), (200, 0, 3)],
+                   shift=1.)
+
+    assert stitch_tracks(tail, head) == {1: 9, 2: 7, 3: 8}
+
+
+def test_stitch_tracks_rejects_low_iou():
+    frames = range(90, 100)
+    tail = overlap(frames, [(0, 0, 7)])
+    head = overlap(frames, [(30, 0, 1)])
+
+    assert stitch_tracks(tail, head) == {}
+    assert stitch_tracks(tail, head, iou_threshold=0.1) == {1: 7}
+
+
+def test_stitch_tracks_without_shared_frames():
+    tail = overlap(range(90, 100), [(0, 0, 7)])
+    head = overlap(range(100, 110), [(0, 0, 1)])
+    empty = {frame: tracked() for frame in range(90, 100)}
+
+    assert stitch_tracks(tail, head) == {}
+    assert stitch_tracks(tail, empty) == {}
+    assert stitch_tracks(empty, tail) == {}
+
+
+def test_merge_segments_counts_stitched_tracks_once():
+    # Track 7 of the first segment continues as track 1 of the second one,
+    # which counts it again in the overlap and again after its start.
+    # Track 5 ends in the first segment and track 2 starts in the second.
+    first = {'segment': (0, 0, 100),
+             'events': [(40, 5, 'line'), (95, 7, 'line')],
+             'head': overlap(range(0, 10), [(0, 0, 5)]),
+             'tail': overlap(range(90, 100), [(0, 0, 7)])}
+    second = {'segment': (90, 100, 200),
+              'events': [(95, 1, 'line'), (120, 1, 'line'),
+                         (150, 2, 'line'), (150, 2, 'zone')],
+              'head': overlap(range(90, 100), [(0, 0, 1)], shift=1.),
+              'tail': overlap(range(190, 200), [(0, 0, 2)])}
+
+    assert merge_segments([first, second]) == \
+        [(40, 1, 'line'), (95, 2, 'line'), (150, 3, 'line'),
+         (150, 3, 'zone')]
+
+
+def test_merge_segments_chains_ids():
+    # The same object crosses three segments and is counted in each one
+    segments = []
+
+    for index in range(3):
+        start, end = 100 * index, 100 * (index + 1)
+        segments.append({'segment': (max(0, start - 10), start, end),
+                         'events': [(start + 50, index + 1, 'line')],
+                         'head': overlap(range(start - 10, start),
+                                         [(0, 0, index + 1)]),
+                         'tail': overlap(range(end - 10, end),
+                                         [(0, 0, index + 1)])})
+
+    segments[0]['head'] = {}
+
+    assert merge_segments(segments) == [(50, 1, 'line')]
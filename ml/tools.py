@@ -10,10 +10,20 @@
 # according to the license provided and its conditions.
 # ============================================================================
 
+from functools import lru_cache
+import glob
+import os
+
 import numpy as np
 import cv2
 
 from ml.tracker.trackable_object import TrackableObject
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.metrics import metrics
+
+
+logger = get_logger('tools')
 
 
 def process_boxes(image,
@@ -62,24 +72,13 @@ def process_boxes(image,
 
     height, width, _ = image.shape
 
-    for index, box in enumerate(boxes):
-        if confidence[index] > threshold:
-
-            # Get class name
-            class_id = int(classes[index])
-            label = names[class_id]
-
-            if tracked_classes is not None:
-                if label not in tracked_classes:
-                    continue
+    pixel_boxes, _, class_ids = filter_detections(boxes, confidence, classes,
+                                                  names, tracked_classes,
+                                                  threshold, width, height)
 
-            # Get the coordinates in pixels of the bounding box
-            x1 = round(box[0] * width)
-            y1 = round(box[1] * height)
-            x2 = round(box[2] * width)
-            y2 = round(box[3] * height)
-
-            image = draw_box(image, label, x1, y1, x2, y2, color, tag)
+    for (x1, y1, x2, y2), class_id in zip(pixel_boxes.tolist(),
+                                          class_ids.tolist()):
+        image = draw_box(image, names[class_id], x1, y1, x2, y2, color, tag)
 
     if logo_path is not None:
         draw_logo(image, logo_path, position=position)
@@ -87,6 +86,109 @@ def process_boxes(image,
     return image
 
 
+@lru_cache(maxsize=32)
+def build_class_mask(names, tracked_classes):
+    """Builds the boolean mask of the tracked class ids.
+
+    Parameters
+    ----------
+    names : tuple
+        (class id, name) pairs.
+    tracked_classes : tuple
+        Tracked class names.
+
+    Returns
+    -------
+    numpy.ndarray
+        Read-only mask indexed by class id.
+    """
+
+    mask = np.zeros(max(class_id for class_id, _ in names) + 1, dtype=bool)
+
+    for class_id, label in names:
+        mask[class_id] = label in tracked_classes
+
+    mask.setflags(write=False)
+
+    return mask
+
+
+def class_mask(names, tracked_classes):
+    """Boolean mask of the tracked class ids, cached per names and classes.
+
+    Parameters
+    ----------
+    names : dict or list
+        Class names.
+    tracked_classes : list
+        Tracked class names.
+
+    Returns
+    -------
+    numpy.ndarray
+        Read-only mask indexed by class id.
+    """
+
+    items = names.items() if isinstance(names, dict) else enumerate(names)
+
+    return build_class_mask(tuple(items), tuple(tracked_classes))
+
+
+def filter_detections(boxes,
+                      confidence,
+                      classes,
+                      names,
+                      tracked_classes=None,
+                      threshold=0.5,
+                      width=1,
+                      height=1):
+    """Filters detections by confidence and class, all at once.
+
+    Parameters
+    ----------
+    boxes : numpy.ndarray
+        (N, 4) normalized bounding boxes.
+    confidence : numpy.ndarray
+        Confidence values.
+    classes : numpy.ndarray
+        Class ids.
+    names : dict or list
+        Class names.
+    tracked_classes : list
+        List of tracked classes. If None, every class is kept.
+    threshold : float
+        Threshold to filter boxes.
+    width : int
+        Width of the image.
+    height : int
+        Height of the image.
+
+    Returns
+    -------
+    pixel_boxes : numpy.ndarray
+        (M, 4) integer bounding boxes in pixels.
+    confidence : numpy.ndarray
+        (M,) confidence values.
+    class_ids : numpy.ndarray
+        (M,) integer class ids.
+    """
+
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    confidence = np.asarray(confidence)
+    class_ids = np.asarray(classes).astype(int)
+
+    keep = confidence > threshold
+
+    if tracked_classes is not None:
+        keep[keep] = class_mask(names, tracked_classes)[class_ids[keep]]
+
+    # Same rounding (half to even) and precision as rounding box by box
+    scale = np.array([width, height, width, height], dtype=boxes.dtype)
+    pixel_boxes = np.rint(boxes[keep] * scale).astype(int)
+
+    return pixel_boxes, confidence[keep], class_ids[keep]
+
+
 def track_boxes(image,
                 boxes,
                 confidence,
@@ -99,21 +201,35 @@ def track_boxes(image,
                 color=(245, 135, 66),
                 logo_path=None,
                 position='top',
-                tag=True):
+                tag=True,
+                sink=None,
+                draw=True,
+                frame_size=None,
+                counter=None,
+                frame_index=None,
+                timestamp=None,
+                source=None,
+                spill_dir=None):
     """Track boxes.
 
     Parameters
     ----------
     image : numpy.ndarray
-        Image to process.
+        Image to process. Can be None when `draw` is False.
     boxes : numpy.ndarray
-        Bounding boxes.
+        Bounding boxes. If None, the detector was skipped in this frame and
+        the tracker is advanced by prediction only.
     confidence : numpy.ndarray
         Confidence values.
     classes : numpy.ndarray
         Class ids.
     names : list
         Class names.
+    centroid_tracker : Sort
+        SORT tracker.
+    trackable_objects : dict
+        Trackable objects by object ID. Objects whose track was terminated
+        by the tracker are evicted.
     tracked_classes : list
         List of tracked classes.
     threshold : float
@@ -126,83 +242,205 @@ def track_boxes(image,
         Position to draw logo.
     tag : bool
         Tag mode. Draws class name.
+    sink : callable
+        Called with every evicted trackable object.
+    draw : bool
+        Draws boxes, counting line and logo. If False, only tracks and
+        counts, and the image is returned untouched.
+    frame_size : tuple
+        (width, height) of the frame, used when `image` is None.
+    counter : Counter
+        Counting lines and zones. Required; the same counter must be passed
+        every frame to keep its counts (see `ml.zones.default_counter`).
+    frame_index : int
+        Index of the frame, for the counting events.
+    timestamp : float
+        Time of the frame in seconds, for the counting events.
+    source : str
+        Video source of the frame, for the counting events.
+    spill_dir : str
+        Directory where the full history of every object is spilled (see
+        `spill_path`). Otherwise only its recent centroids are kept.
     
     Returns
     -------
     numpy.ndarray
         Image with boxes.
+    int
+        Number of objects counted in this frame.
     """
 
-    height, width, _ = image.shape
-    tracked_boxes = []
-    total = 0
+    if image is None:
+        width, height = frame_size
+    else:
+        height, width, _ = image.shape
+
+    if counter is None:
+        raise ValueError('A counter is required to track boxes.')
+
+    predicted = boxes is None
+
+    if not predicted:
+        with metrics.time('filtering'):
+            pixel_boxes, scores, class_ids = filter_detections(
+                boxes, confidence, classes, names, tracked_classes,
+                threshold, width, height)
+
+            # [x1, y1, x2, y2, score] rows for the tracker
+            detections = np.column_stack((pixel_boxes, scores))
+
+    if draw:
+        with metrics.time('drawing'):
+            if not predicted:
+                for (x1, y1, x2, y2), class_id in zip(pixel_boxes.tolist(),
+                                                      class_ids.tolist()):
+                    image = draw_box(image, names[class_id], x1, y1, x2, y2,
+                                     color, tag)
+
+            image = counter.draw(image, color)
+
+    with metrics.time('sort'):
+        # The tracker must be updated every frame so that tracks age and die.
+        # Frames without detector results are advanced by prediction only.
+        if predicted:
+            objects = centroid_tracker.predict()
+        else:
+            objects = centroid_tracker.update(detections)
+
+    # Draw the predicted boxes when the detector was skipped
+    if predicted and draw:
+        with metrics.time('drawing'):
+            for obj in objects:
+                x1, y1, x2, y2 = (int(value) for value in obj[:4])
+                image = draw_box(image, None, x1, y1, x2, y2, color, False)
+
+    with metrics.time('counting'):
+        # Centroids of the tracked objects
+        object_ids = objects[:, -1].astype(int).tolist()
+        centroids = ((objects[:, 2:4] - objects[:, 0:2]) // 2 +
+                     objects[:, 0:2]).astype(int)
+
+        moved, previous, current = [], [], []
+
+        for object_id, centroid in zip(object_ids, centroids):
+            trackable_object = trackable_objects.get(object_id, None)
 
-    for index, box in enumerate(boxes):
-        if confidence[index] > threshold:
+            if trackable_object is None:
+                trackable_object = TrackableObject(
+                    object_id, centroid,
+                    spill_path=spill_path(spill_dir, object_id))
+                trackable_objects[object_id] = trackable_object
+            else:
+                moved.append(trackable_object)
+                previous.append(trackable_object.centroid)
+                current.append(centroid)
+                trackable_object.add(centroid)
 
-            # Get class name
-            class_id = int(classes[index])
-            label = names[class_id]
+        # Count line crossings and zone entries, for every object at once
+        events = counter.update(moved, previous, current, (width, height))
+        total = len(events)
 
-            if tracked_classes is not None:
-                if label not in tracked_classes:
-                    continue
+        for trackable_object, name in events:
+            log_event(logger, 'object_counted',
+                      source=source, track_id=trackable_object.objectID,
+                      line=name, frame=frame_index, timestamp=timestamp)
 
-            # Get the coordinates in pixels of the bounding box
-            x1 = round(box[0] * width)
-            y1 = round(box[1] * height)
-            x2 = round(box[2] * width)
-            y2 = round(box[3] * height)
+        # Evict objects whose track was terminated
+        evict_objects(trackable_objects, centroid_tracker.terminated, sink)
 
-            pixel_box = np.concatenate(([x1, y1, x2, y2], confidence[index]),
-                                       axis=None)
-            tracked_boxes.append(pixel_box)
+    if draw and logo_path is not None:
+        with metrics.time('drawing'):
+            draw_logo(image, logo_path, position=position)
 
-            image = draw_box(image, label, x1, y1, x2, y2, color, tag)
+    return image, total
 
-    # TODO: Improve line -> boxes
-    image = cv2.line(image, (1920 - (1920 // 16), 0),
-                     (1920 - (1920 // 16), 1080), color, 2)
 
-    if len(tracked_boxes):
-        objects = centroid_tracker.update(np.array(tracked_boxes))
+def spill_path(spill_dir, object_id):
+    """Path to the spilled history of an object, or None without a directory.
 
-        for obj in objects:
-            object_id = int(obj[-1])
-            cent_x = (obj[2] - obj[0]) // 2 + obj[0]
-            cent_y = (obj[3] - obj[1]) // 2 + obj[1]
-            centroid = [int(cent_x), int(cent_y)]
+    Parameters
+    ----------
+    spill_dir : str
+        Directory of the spilled histories.
+    object_id : int
+        Object ID.
 
-            trackable_object = trackable_objects.get(object_id, None)
+    Returns
+    -------
+    str
+        Path to a 'track_<ID>.bin' file of int32 (x, y) centroids.
+    """
 
-            if trackable_object is None:
-                trackable_object = TrackableObject(object_id, centroid)
-            else:
-                x_centroids = [c[0] for c in trackable_object.centroids]
-                direction = centroid[0] - np.mean(x_centroids)
-                trackable_object.centroids.append(centroid)
+    if spill_dir is None:
+        return None
 
-                # TODO: Improve line -> boxes
-                if not trackable_object.counted:
-                    line_site = 1920 - (1920 // 16)
+    return os.path.join(spill_dir, f'track_{object_id}.bin')
 
-                    if centroid[0] < line_site and \
-                        centroid[0] > line_site - 300:
-                        trackable_object.init_position = True
-                        print('[INFO] Object tracked in band.')
 
-                    if direction > 0 and centroid[0] > line_site and \
-                        trackable_object.init_position:
-                        trackable_object.counted = True
-                        total += 1
-                        print('[INFO] Object counted.')
+def restore_spilled(spill_dir, trackable_objects=None, next_id=1):
+    """Makes the spilled histories match a tracking state.
 
-            trackable_objects[object_id] = trackable_object
+    The histories of the live objects are cut to the centroids they had
+    spilled, and the ones of objects created later are removed, so that
+    tracking from the state does not append the same centroids twice.
+    Without a state, every spilled history is removed.
 
-    if logo_path is not None:
-        draw_logo(image, logo_path, position=position)
+    Parameters
+    ----------
+    spill_dir : str
+        Directory of the spilled histories.
+    trackable_objects : dict
+        Live trackable objects of the state, by object ID.
+    next_id : int
+        First object ID not assigned in the state.
+    """
 
-    return image, total
+    trackable_objects = trackable_objects or {}
+
+    for path in glob.glob(os.path.join(spill_dir, 'track_*.bin')):
+        object_id = int(os.path.basename(path)[6:-4])
+        trackable_object = trackable_objects.get(object_id)
+
+        if trackable_object is not None:
+            # 8 bytes per int32 (x, y) centroid
+            os.truncate(path, trackable_object.spilled * 8)
+        elif object_id >= next_id:
+            os.remove(path)
+
+
+def evict_objects(trackable_objects, object_ids, sink=None):
+    """Evict objects from the trackable objects.
+
+    Parameters
+    ----------
+    trackable_objects : dict
+        Trackable objects by object ID.
+    object_ids : iterable
+        IDs of the objects to evict.
+    sink : callable
+        Called with every evicted trackable object.
+
+    Returns
+    -------
+    list
+        Evicted trackable objects.
+    """
+
+    evicted = []
+
+    for object_id in object_ids:
+        trackable_object = trackable_objects.pop(int(object_id), None)
+
+        if trackable_object is None:
+            continue
+
+        trackable_object.flush()
+        evicted.append(trackable_object)
+
+        if sink is not None:
+            sink(trackable_object)
+
+    return evicted
 
 
 def draw_box(image, label, x1, y1, x2, y2, color, tag):
@@ -280,6 +518,122 @@ def display_numbers(image,
     return image
 
 
+def display_counts(image, counts, position='top', color=(255, 255, 255)):
+    """Displays one line per counter.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Image to draw on.
+    counts : dict
+        Counter name -> count.
+    position : str
+        Position of the counts, 'top' or 'bottom'.
+    color : tuple
+        Text color.
+
+    Returns
+    -------
+    numpy.ndarray
+        Image with counts.
+    """
+
+    step = min(image.shape[:2]) // 20
+
+    for index, (name, count) in enumerate(counts.items()):
+        dy = index * step
+        dy = dy if position == 'top' else -dy
+        image = display_numbers(image, name, count, position=position, dy=dy,
+                                color=color)
+
+    return image
+
+
+class LogoOverlay:
+    """Logo resized and pre-blended for a frame size and position."""
+
+    def __init__(self, logo_path, shape, position='top'):
+        """Class constructor.
+
+        Parameters
+        ----------
+        logo_path : str
+            Path to logo.
+        shape : tuple
+            Shape of the frames the logo is drawn on.
+        position : str
+            Position to draw logo.
+        """
+
+        height, width = shape[:2]
+        side_value = min(height, width)
+        size = side_value // 6
+        padding = side_value // 60
+
+        logo = cv2.imread(logo_path, -1)
+        logo = cv2.resize(logo, (size, size))
+
+        # Premultiplied logo and inverse alpha, ready to blend
+        alpha = logo[:, :, 3:].astype(np.float32) / 255.
+        self.premultiplied = logo[:, :, :3] * alpha
+        self.inverse_alpha = 1. - alpha
+
+        self.rows = None
+        self.cols = slice(-size - padding, -padding)
+
+        if position == 'top':
+            self.rows = slice(padding, size + padding)
+
+        if position == 'bottom':
+            self.rows = slice(-size - padding, -padding)
+
+    def apply(self, image):
+        """Blends the logo into the image in place.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            Image to draw logo.
+
+        Returns
+        -------
+        numpy.ndarray
+            Image with logo.
+        """
+
+        if self.rows is None:
+            return image
+
+        roi = image[self.rows, self.cols, :3]
+        blended = roi * self.inverse_alpha
+        blended += self.premultiplied
+        roi[...] = blended
+
+        return image
+
+
+@lru_cache(maxsize=8)
+def get_logo_overlay(logo_path, shape, position='top'):
+    """Returns the cached logo overlay for a frame size and position.
+
+    Parameters
+    ----------
+    logo_path : str
+        Path to logo.
+    shape : tuple
+        Shape of the frames the logo is drawn on.
+    position : str
+        Position to draw logo.
+
+    Returns
+    -------
+    LogoOverlay
+        Logo overlay.
+    """
+
+    return LogoOverlay(logo_path, shape, position)
+
+
 def draw_logo(image, logo_path, position='top'):
     """Draw logo.
 
@@ -298,34 +652,6 @@ def draw_logo(image, logo_path, position='top'):
         Image with logo.
     """
 
-    x, y, _ = image.shape
-    side_value = min(x, y)
-    size = side_value // 6
-    padding = side_value // 60
-
-    logo = cv2.imread(logo_path, -1)
-    logo = logo[:, :]
-    logo = cv2.resize(logo, (size, size))
-
-    rlh, rlw, _ = logo.shape
+    overlay = get_logo_overlay(logo_path, image.shape[:2], position)
 
-    x = x - rlw - padding
-    y = y - rlh - padding
-    alpha_logo = logo[:, :, 3] / 255.
-    alpha_image = 1.0 - alpha_logo
-
-    if position == 'top':
-        for c in range(0, 3):
-            A = alpha_logo * logo[:, :, c]
-            B_img = image[padding:rlh + padding, -rlw - padding:-padding, c]
-            B = alpha_image * B_img
-            image[padding:rlh + padding, -rlw - padding:-padding, c] = A + B
-
-    if position == 'bottom':
-        for c in range(0, 3):
-            A = alpha_logo * logo[:, :, c]
-            B_img = image[-rlh - padding:-padding, -rlw - padding:-padding, c]
-            B = alpha_image * B_img
-            image[-rlh - padding:-padding, -rlw - padding:-padding, c] = A + B
-
-    return image
+    return overlay.apply(image)
@@ -10,13 +10,37 @@
 # according to the license provided and its conditions.
 # ============================================================================
 
+from time import monotonic
+import logging
+import json
+import os
+
 from tqdm import tqdm
 import cv2
 
 from ml.tracker.sort.sort import Sort
-from ml.detect import detect_single_frame
+from ml.logger import get_logger
+from ml.logger import log_event
+from ml.metrics import metrics
+from ml.pipeline import Pipeline
+from ml.registry import resolve_version
+from ml.cache import DetectionCache
+from ml.cache import DetectionCacheWriter
+from ml.cache import cache_path
+from ml.checkpoint import RecordLog
+from ml.checkpoint import load_checkpoint
+from ml.checkpoint import save_checkpoint
+from ml.checkpoint import snapshot
+from ml.detect import detect_batch
+from ml.detect import read_strided_frames
+from ml.detect import seek_frame
 from ml.tools import track_boxes
-from ml.tools import display_numbers
+from ml.tools import display_counts
+from ml.tools import restore_spilled
+from ml.zones import default_counter
+
+
+logger = get_logger('track')
 
 
 def object_tracking_in_video(video_path,
@@ -26,7 +50,24 @@ def object_tracking_in_video(video_path,
                              threshold=0.5,
                              color=(245, 135, 66),
                              logo_path=None,
-                             position='top'):
+                             position='top',
+                             batch_size=1,
+                             mode='serial',
+                             queue_size=8,
+                             sink=None,
+                             headless=False,
+                             detection_stride=1,
+                             max_stride=None,
+                             cache_dir=None,
+                             size=640,
+                             counter=None,
+                             summary_interval=10.,
+                             motion_gate=None,
+                             roi=None,
+                             checkpoint_path=None,
+                             checkpoint_interval=9000,
+                             output_file=None,
+                             spill_dir=None):
     """Object tracking in video.
     
     Parameters
@@ -47,12 +88,85 @@ def object_tracking_in_video(video_path,
         Path to the logo.
     position : str
         Position of the logo.
+    batch_size : int
+        Number of frames per forward pass.
+    mode : str
+        Execution mode. 'serial' runs everything on the calling thread,
+        'threaded' runs decode, inference, tracking and encode as separate
+        stages connected by bounded queues.
+    queue_size : int
+        Maximum number of batches waiting between stages in 'threaded' mode.
+    sink : callable
+        Called with every trackable object evicted once its track ends, to
+        keep its count and trajectory.
+    headless : bool
+        Headless analytics mode. Only decodes, detects, tracks and counts,
+        without drawing nor encoding the processed video, and writes the
+        counts and track records to a '_counts.json' file.
+    detection_stride : int
+        Runs the detector every `detection_stride` frames. The frames in
+        between are tracked with the Kalman prediction of the tracker.
+    max_stride : int
+        Adaptive stride. If given, the detector runs every `max_stride`
+        frames while there are no live tracks, and every `detection_stride`
+        frames otherwise. The reader sees the live tracks as of the last
+        tracked frame, so the stride reacts one batch late (more in
+        'threaded' mode, with batches waiting in the queues).
+    cache_dir : str
+        Directory of the detection caches. If the cache of this video,
+        model, input size and detection settings (strides, region of
+        interest and motion gate) exists, tracking replays the cached
+        detections (and strides) instead of running the model. Otherwise,
+        the detections are saved to it.
+    size : int
+        Model input size.
+    counter : Counter
+        Counting lines and zones. Defaults to a vertical line at 15/16 of
+        the frame width counting objects moving right.
+    summary_interval : float
+        Seconds between the periodic summary log records.
+    motion_gate : MotionGate
+        If given, frames without motion skip the detector while there are
+        no live tracks, and are tracked by prediction only. The live tracks
+        are checked once per batch of frames.
+    roi : RegionOfInterest
+        If given, only its crops or tiles of the frames are detected.
+    checkpoint_path : str
+        Path to checkpoint the tracker and counter state to (headless mode
+        only). If it exists, tracking resumes from it by seeking the video,
+        and it is removed once the video is done. Results are identical to
+        an uninterrupted run, except with the adaptive stride or the motion
+        gate, whose decisions right after resuming may differ. The records
+        of the finished tracks are appended to a '_tracks.jsonl' file beside
+        it, so checkpoints only store its size.
+    checkpoint_interval : int
+        Minimum number of frames between checkpoints. They are taken just
+        before a frame to detect, so that resuming reads the same strides.
+    output_file : str
+        Path to the counts (headless) or processed video. Defaults to the
+        video path ending in '_counts.json' or '_processed.mp4'.
+    spill_dir : str
+        Directory where the full centroid history of every object is
+        spilled, one file per object, so that long-lived tracks keep only
+        their recent centroids in memory. The histories of an earlier run
+        are removed, or cut back to the checkpoint when resuming.
+
+    Returns
+    -------
+    int
+        Total of counted objects.
     """
 
+    if checkpoint_path is not None and not headless:
+        raise ValueError('Checkpoints are only supported in headless mode.')
+
     # Initialize the SORT tracker
     if tracking_params is None:
         tracking_params = {'max_age': 10, 'min_hits': 2, 'iou_threshold': 0.25}
 
+    if counter is None:
+        counter = default_counter()
+
     global_total = 0
     centroid_tracker = Sort(max_age=tracking_params['max_age'],
                             min_hits=tracking_params['min_hits'],
@@ -67,37 +181,404 @@ def object_tracking_in_video(video_path,
     codec = cv2.VideoWriter_fourcc(*'XVID')
     total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    output_file = video_path.split('.')[0]
-    output_file += '_processed.mp4'
+    if output_file is None:
+        output_file = video_path.split('.')[0]
+        output_file += '_counts.json' if headless else '_processed.mp4'
     vid_size = (width, height)
-    out = cv2.VideoWriter(output_file, codec, fps, vid_size)
+    out = None
+
+    if not headless:
+        out = cv2.VideoWriter(output_file, codec, fps, vid_size)
+
+    # Counts and track records for the headless mode
+    frame_index = 0
+    counts = []
+    tracks = []
+    records_path = None
+
+    # With checkpoints, the records go to a file that is only appended to
+    if checkpoint_path is not None:
+        records_path = os.path.splitext(checkpoint_path)[0] + '_tracks.jsonl'
+
+    def record(trackable_object):
+        tracks.append(track_record(trackable_object, frame_index))
+
+        if sink is not None:
+            sink(trackable_object)
+
+    # Resume from the checkpoint, if any
+    state = None
+
+    if checkpoint_path is not None:
+        state = load_checkpoint(checkpoint_path)
+
+    if state is not None:
+        if sorted(state['lines']) != sorted(counter.names):
+            raise ValueError(f'Checkpoint {checkpoint_path} counts '
+                             f'{sorted(state["lines"])}, not '
+                             f'{sorted(counter.names)}.')
+
+        frame_index = state['frame_index']
+        global_total = state['total']
+        centroid_tracker = state['tracker']
+        trackable_objects = state['trackable_objects']
+        counter.counts = state['lines']
+        counts = state['counts']
+        tracks = RecordLog(records_path, state['tracks'])
+        seek_frame(vid, frame_index)
+    elif checkpoint_path is not None:
+        tracks = RecordLog(records_path)
+
+    # Spilled histories as of the state tracking starts from
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+
+        if state is None:
+            restore_spilled(spill_dir)
+        else:
+            restore_spilled(spill_dir, trackable_objects,
+                            centroid_tracker.trackers.count + 1)
+
+    last_checkpoint = frame_index
+    pending = None
+
+    def checkpoint():
+        return snapshot({'video': video_path,
+                         'frame_index': frame_index,
+                         'total': global_total,
+                         'tracker': centroid_tracker,
+                         'trackable_objects': trackable_objects,
+                         'lines': counter.counts,
+                         'counts': counts,
+                         'tracks': tracks.offset()})
+
+    def write_checkpoint(index, data):
+        nonlocal last_checkpoint
+
+        with metrics.time('checkpoint'):
+            save_checkpoint(checkpoint_path, data)
+
+        last_checkpoint = index
+        log_event(logger, 'checkpoint_saved', path=checkpoint_path,
+                  frame=index, bytes=len(data))
+
+    log_event(logger, 'processing_video', video=video_path,
+              frames=total_frames, start=frame_index)
+
+    pbar = tqdm(total=total_frames - 1, initial=frame_index)
+
+    source_fps = vid.get(cv2.CAP_PROP_FPS)
+    start_time = monotonic()
+    last_summary = start_time
+
+    def timestamp(index):
+        return round(index / source_fps, 3) if source_fps else None
+
+    def log_summary(frames, force=False):
+        nonlocal last_summary
+        now = monotonic()
+
+        if not force and now - last_summary < summary_interval:
+            return
+
+        last_summary = now
+        log_event(logger, 'summary', frames=frames,
+                  total=global_total,
+                  live_tracks=len(centroid_tracker.live_ids()),
+                  objects=len(trackable_objects),
+                  fps=round(frames / (now - start_time), 2))
+
+    # Live tracks as of the last tracked frame, published by the tracking
+    # stage for the reader and the motion gate, which may run on other
+    # threads while the tracker changes
+    live_tracks = len(centroid_tracker.live_ids())
+
+    def stride():
+        if max_stride is not None and not live_tracks:
+            return max_stride
+
+        return detection_stride
+
+    # Detection cache
+    cache = None
+    cache_writer = None
+    cache_index = frame_index
+
+    if cache_dir is not None:
+        path = cache_path(video_path, resolve_version(version), size,
+                          cache_dir, roi, detection_stride, max_stride,
+                          motion_gate)
+
+        if os.path.exists(path):
+            log_event(logger, 'replaying_detections', cache=path)
+            cache = DetectionCache(path)
+        elif frame_index:
+            log_event(logger, 'detections_not_cached', cache=path,
+                      reason='resumed')
+        else:
+            cache_writer = DetectionCacheWriter(path, {'video': video_path,
+                                                       'size': size})
+
+    def needs_detection(frame):
+        if live_tracks:
+            return True
+
+        with metrics.time('motion_gate'):
+            return motion_gate.moving(frame)
+
+    cache_exhausted = False
+
+    def infer(items):
+        nonlocal cache_index, cache_exhausted
+        replayed = []
+
+        if cache is not None:
+            cached = items[:max(0, len(cache) - cache_index)]
+            replayed = [(frame, cache[cache_index + i], True)
+                        for i, (frame, _) in enumerate(cached)]
+            cache_index += len(cached)
+            items = items[len(cached):]
+
+            if not items:
+                return replayed
+
+            # The video has more frames than the cache, detect the rest
+            if not cache_exhausted:
+                cache_exhausted = True
+                log_event(logger, 'cache_exhausted', logging.WARNING,
+                          cache=cache.path, frame=cache_index)
+
+        # Frames the reader flagged to detect, where checkpoints can resume
+        flags = [detect for _, detect in items]
+
+        if motion_gate is not None:
+            items = [(frame, detect and needs_detection(frame))
+                     for frame, detect in items]
+
+        frames = [frame for frame, detect in items if detect]
+        detections = iter(detect_batch(frames, version, batch_size,
+                                       size=size, roi=roi))
+        results = [(frame, next(detections) if detect else (None,) * 4, flag)
+                   for (frame, detect), flag in zip(items, flags)]
+
+        if cache_writer is not None:
+            for _, detections, _ in results:
+                cache_writer.append(detections)
+
+        return replayed + results
+
+    def track(batch):
+        nonlocal global_total, frame_index, pending, live_tracks
+        images = []
+
+        # Checkpoint taken at the end of the previous batch
+        if pending is not None and batch[0][2]:
+            write_checkpoint(*pending)
 
-    print(f'[INFO] Processing video {video_path} with {total_frames} frames')
+        pending = None
 
-    pbar = tqdm(total=total_frames - 1)
-    while True:
-        ret, frame = vid.read()
+        # Feed the tracker in frame order
+        for item, (img, results, _) in enumerate(batch):
+            boxes, confidence, classes, names = results
 
-        if not ret:
-            break
+            # Process boxes
+            img, total = track_boxes(img, boxes, confidence, classes, names,
+                                     centroid_tracker, trackable_objects,
+                                     tracked_classes, threshold, color,
+                                     logo_path, position,
+                                     sink=record if headless else sink,
+                                     draw=not headless,
+                                     frame_size=vid_size,
+                                     counter=counter,
+                                     frame_index=frame_index,
+                                     timestamp=timestamp(frame_index),
+                                     source=video_path,
+                                     spill_dir=spill_dir)
+            global_total += total
+            live_tracks = len(centroid_tracker.live_ids())
+            log_event(logger, 'total_objects', logging.DEBUG,
+                      frame=frame_index, total=global_total)
+            log_summary(frame_index + 1)
 
-        img = frame.copy()
-        results = detect_single_frame(img, version=version)
-        boxes, confidence, classes, names = results
+            if total:
+                counts.append([frame_index, global_total])
 
-        # Process boxes
-        img, total = track_boxes(img, boxes, confidence, classes, names,
-                                 centroid_tracker, trackable_objects,
-                                 tracked_classes, threshold, color, logo_path,
-                                 position)
-        global_total += total
-        print(f'[INFO] Total objects: {global_total}')
+            if not headless:
+                with metrics.time('drawing'):
+                    img = display_counts(img, counter.counts, position,
+                                         color)
+                images.append(img)
+            else:
+                images.append(None)
+
+            frame_index += 1
+
+            if checkpoint_path is None or \
+                    frame_index - last_checkpoint < checkpoint_interval:
+                continue
+
+            # Only before a frame to detect, known once the next one is read
+            if item + 1 == len(batch):
+                pending = (frame_index, checkpoint())
+            elif batch[item + 1][2]:
+                write_checkpoint(frame_index, checkpoint())
+
+        return images
+
+    def write(images):
+        for img in images:
+            if out is not None:
+                with metrics.time('encode'):
+                    out.write(img)
+            pbar.update(1)
+
+        if mode == 'threaded':
+            pbar.set_postfix(pipeline.queue_depths())
+
+    if cache is not None and headless:
+        source = cache.frames(batch_size, frame_index)
+    elif cache is not None:
+        source = read_strided_frames(vid, batch_size)
+    else:
+        source = read_strided_frames(vid, batch_size, stride,
+                                     retrieve_skipped=not headless)
+
+    pipeline = Pipeline(source, [infer, track], write,
+                        mode=mode,
+                        queue_size=queue_size,
+                        names=['decoded', 'detected', 'tracked'])
+    pipeline.run()
+
+    if mode == 'threaded':
+        log_event(logger, 'max_queue_depths', **pipeline.max_queue_depths())
+
+    vid.release()
+    pbar.close()
+
+    if out is not None:
+        out.release()
+
+    if cache_writer is not None:
+        cache_writer.save()
+        log_event(logger, 'detections_cached', cache=cache_writer.path)
+
+    log_summary(frame_index, force=True)
+
+    if motion_gate is not None:
+        log_event(logger, 'motion_gate', **motion_gate.stats())
+
+    if metrics.enabled:
+        for name, stats in metrics.summary().items():
+            log_event(logger, 'stage_timing', stage=name, **stats)
+
+    if checkpoint_path is not None:
+        record_log, tracks = tracks, tracks.read()
+
+    if headless:
+        save_counts(output_file, video_path, frame_index, global_total,
+                    counter, counts, tracks, trackable_objects)
+
+    # The video is done, a later run starts over
+    if checkpoint_path is not None:
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        record_log.remove()
+
+    return global_total
+
+
+def track_record(trackable_object, frame_index):
+    """Compact record of a trackable object.
+
+    Parameters
+    ----------
+    trackable_object : TrackableObject
+        Trackable object.
+    frame_index : int
+        Frame index when the record is taken.
+
+    Returns
+    -------
+    dict
+        Object ID, whether it was counted, number of centroids seen, last
+        centroid and frame index, and the path to its spilled history if
+        any.
+    """
+
+    record = {'object_id': trackable_object.objectID,
+              'counted': trackable_object.counted,
+              'hits': trackable_object.count,
+              'last_centroid': trackable_object.centroid.tolist(),
+              'frame': frame_index}
+
+    if trackable_object.spill_path is not None:
+        record['history'] = trackable_object.spill_path
+
+    return record
+
+
+def save_json(path, data):
+    """Writes a JSON file aside and renames it, replacing it atomically.
+
+    A job killed while saving must not leave a partial counts file, that
+    the job runner would take as done.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file.
+    data : object
+        JSON serializable data.
+    """
+
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+
+    os.replace(tmp_path, path)
+
+
+def save_counts(output_file,
+                video_path,
+                frames,
+                total,
+                counter,
+                counts,
+                tracks,
+                trackable_objects):
+    """Writes the counts and track records of a video to a JSON file.
+
+    Parameters
+    ----------
+    output_file : str
+        Path to the JSON file.
+    video_path : str
+        Path to the video.
+    frames : int
+        Number of processed frames.
+    total : int
+        Total of counted objects.
+    counter : Counter
+        Counting lines and zones.
+    counts : list
+        List of [frame index, running total] pairs.
+    tracks : list
+        Records of the evicted trackable objects. The records of the live
+        ones are appended to it.
+    trackable_objects : dict
+        Live trackable objects, flushed before saving.
+    """
 
-        img = display_numbers(img,
-                              'Right exit',
-                              global_total,
-                              position=position,
-                              color=color)
+    for trackable_object in trackable_objects.values():
+        trackable_object.flush()
+        tracks.append(track_record(trackable_object, frames))
 
-        out.write(img)
-        pbar.update(1)
+    save_json(output_file, {'video': video_path,
+                            'frames': frames,
+                            'total': total,
+                            'lines': counter.counts,
+                            'counts': counts,
+                            'tracks': tracks})
+    log_event(logger, 'counts_saved', path=output_file)
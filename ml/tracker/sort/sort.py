@@ -19,29 +19,28 @@ from __future__ import print_function
 
 import os
 import numpy as np
-import matplotlib
-# matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from skimage import io
 
 import glob
 import time
 import argparse
-from filterpy.kalman import KalmanFilter
+
+try:
+  import lap
+except ImportError: #scipy is used instead, see linear_assignment
+  lap = None
 
 np.random.seed(0)
 
+DENSE_PAIRS = 1024 #below this number of detection-tracker pairs, every pair is tested
+
 
 def linear_assignment(cost_matrix):
-  try:
-    import lap
+  if lap is not None:
     _, x, y = lap.lapjv(cost_matrix, extend_cost=True)
-    return np.array([[y[i],i] for i in x if i >= 0]) #
-  except ImportError:
-    from scipy.optimize import linear_sum_assignment
-    x, y = linear_sum_assignment(cost_matrix)
-    return np.array(list(zip(x, y)))
+    return np.array([[y[i],i] for i in x if i >= 0], dtype=int).reshape(-1, 2) #
+  from scipy.optimize import linear_sum_assignment
+  x, y = linear_sum_assignment(cost_matrix)
+  return np.stack((x, y), axis=1)
 
 
 def iou_batch(bb_test, bb_gt):
@@ -63,6 +62,83 @@ def iou_batch(bb_test, bb_gt):
   return(o)  
 
 
+def iou_pairs(bb_test, bb_gt):
+  """
+  Computes the IOU of each pair of rows of two (K,4) arrays of [x1,y1,x2,y2] bboxes
+  """
+  xx1 = np.maximum(bb_test[:, 0], bb_gt[:, 0])
+  yy1 = np.maximum(bb_test[:, 1], bb_gt[:, 1])
+  xx2 = np.minimum(bb_test[:, 2], bb_gt[:, 2])
+  yy2 = np.minimum(bb_test[:, 3], bb_gt[:, 3])
+  w = np.maximum(0., xx2 - xx1)
+  h = np.maximum(0., yy2 - yy1)
+  wh = w * h
+  return wh / ((bb_test[:, 2] - bb_test[:, 0]) * (bb_test[:, 3] - bb_test[:, 1])
+    + (bb_gt[:, 2] - bb_gt[:, 0]) * (bb_gt[:, 3] - bb_gt[:, 1]) - wh)
+
+
+def overlapping_pairs(bb_test, bb_gt):
+  """
+  Sort-and-sweep broad phase: returns the indices (i, j) of the pairs of bboxes bb_test[i]
+    and bb_gt[j] that overlap, without testing every pair. bb_gt is sorted by x1, and
+    only the bboxes whose x1 falls in the window where they can reach each bb_test are
+    tested.
+  """
+  if(len(bb_test)==0 or len(bb_gt)==0):
+    return np.empty(0, dtype=int), np.empty(0, dtype=int)
+  order = np.argsort(bb_gt[:, 0], kind='stable')
+  x1 = bb_gt[order, 0]
+  max_w = (bb_gt[:, 2] - bb_gt[:, 0]).max()
+  lo = np.searchsorted(x1, bb_test[:, 0] - max_w, side='right')
+  hi = np.searchsorted(x1, bb_test[:, 2], side='left')
+  counts = np.maximum(hi - lo, 0)
+  i = np.repeat(np.arange(len(bb_test)), counts)
+  starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+  j = order[np.arange(len(i)) + starts]
+  overlap = (bb_gt[j, 2] > bb_test[i, 0]) & (bb_gt[j, 0] < bb_test[i, 2]) & \
+    (bb_gt[j, 3] > bb_test[i, 1]) & (bb_gt[j, 1] < bb_test[i, 3])
+  return i[overlap], j[overlap]
+
+
+def solve_components(i, j, iou):
+  """
+  Solves the assignment of the sparse bipartite graph of overlapping pairs (i, j) with
+    weights iou, one connected component at a time. Pairs that do not overlap have IOU 0,
+    so this is the same assignment as solving the dense matrix.
+  Returns the (K,2) matched pairs and their IOU.
+  """
+  # detections and trackers as nodes of one graph, the trackers after the detections.
+  # Every node takes the smallest label among its neighbours until nothing changes.
+  n = i.max() + 1
+  labels = np.arange(n + j.max() + 1)
+  while True:
+    edge = np.minimum(labels[i], labels[n + j])
+    previous = labels.copy()
+    np.minimum.at(labels, i, edge)
+    np.minimum.at(labels, n + j, edge)
+    if np.array_equal(labels, previous):
+      break
+  component = labels[i]
+  sizes = np.bincount(component)
+  single = sizes[component] == 1 #a single pair, nothing to solve
+  matches = [np.stack((i[single], j[single]), axis=1)]
+  ious = [iou[single]]
+  multiple = np.flatnonzero(~single)
+  multiple = multiple[np.argsort(component[multiple], kind='stable')]
+  bounds = np.flatnonzero(np.diff(component[multiple])) + 1
+  for edges in np.split(multiple, bounds):
+    if(len(edges)==0):
+      continue
+    rows, r = np.unique(i[edges], return_inverse=True)
+    cols, c = np.unique(j[edges], return_inverse=True)
+    matrix = np.zeros((len(rows), len(cols)))
+    matrix[r, c] = iou[edges]
+    matched = linear_assignment(-matrix)
+    matches.append(np.stack((rows[matched[:, 0]], cols[matched[:, 1]]), axis=1))
+    ious.append(matrix[matched[:, 0], matched[:, 1]])
+  return np.concatenate(matches), np.concatenate(ious)
+
+
 def convert_bbox_to_z(bbox):
   """
   Takes a bounding box in the form [x1,y1,x2,y2] and returns z in the form
@@ -91,6 +167,29 @@ def convert_x_to_bbox(x,score=None):
     return np.array([x[0]-w/2.,x[1]-h/2.,x[0]+w/2.,x[1]+h/2.,score]).reshape((1,5))
 
 
+def convert_bboxes_to_z(bboxes):
+  """
+  Vectorised convert_bbox_to_z: takes N bounding boxes in the form [x1,y1,x2,y2]
+    and returns an (N,4) array of [x,y,s,r] rows
+  """
+  w = bboxes[:, 2] - bboxes[:, 0]
+  h = bboxes[:, 3] - bboxes[:, 1]
+  x = bboxes[:, 0] + w/2.
+  y = bboxes[:, 1] + h/2.
+  return np.stack([x, y, w * h, w / h.astype(float)], axis=1)
+
+
+def convert_xs_to_bboxes(xs):
+  """
+  Vectorised convert_x_to_bbox: takes an (N,7) array of states and returns an
+    (N,4) array of [x1,y1,x2,y2] rows
+  """
+  with np.errstate(invalid='ignore', divide='ignore'):
+    w = np.sqrt(xs[:, 2] * xs[:, 3])
+    h = xs[:, 2] / w
+  return np.stack([xs[:, 0]-w/2., xs[:, 1]-h/2., xs[:, 0]+w/2., xs[:, 1]+h/2.], axis=1)
+
+
 class KalmanBoxTracker(object):
   """
   This class represents the internal state of individual tracked objects observed as bbox.
@@ -100,6 +199,7 @@ class KalmanBoxTracker(object):
     """
     Initialises a tracker using initial bounding box.
     """
+    from filterpy.kalman import KalmanFilter #imported on first use, it pulls in scipy.stats
     #define constant velocity model
     self.kf = KalmanFilter(dim_x=7, dim_z=4) 
     self.kf.F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]])
@@ -151,49 +251,148 @@ class KalmanBoxTracker(object):
     return convert_x_to_bbox(self.kf.x)
 
 
+class KalmanBoxBank(object):
+  """
+  Struct-of-arrays state of every tracked object. The constant velocity Kalman
+  filters of all tracks (same model as KalmanBoxTracker) are stacked so that
+  predict and update run as batched matrix operations across live tracks.
+  """
+  F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]], dtype=float)
+  H = np.array([[1,0,0,0,0,0,0],[0,1,0,0,0,0,0],[0,0,1,0,0,0,0],[0,0,0,1,0,0,0]], dtype=float)
+  R = np.diag([1., 1., 10., 10.])
+  Q = np.diag([1., 1., 1., 1., 0.01, 0.01, 0.0001])
+  P0 = np.diag([10., 10., 10., 10., 10000., 10000., 10000.]) #high uncertainty to the unobservable initial velocities
+
+  def __init__(self):
+    self.count = 0 #next id, so that every bank (and Sort instance) has its own id space
+    self.x = np.empty((0, 7))
+    self.P = np.empty((0, 7, 7))
+    self.ids = np.empty(0, dtype=int)
+    self.time_since_update = np.empty(0, dtype=int)
+    self.hits = np.empty(0, dtype=int)
+    self.hit_streak = np.empty(0, dtype=int)
+    self.age = np.empty(0, dtype=int)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def add(self, bboxes):
+    """
+    Creates one track per bounding box, assigning consecutive ids from the bank count.
+    """
+    k = len(bboxes)
+    if(k==0):
+      return
+    x = np.zeros((k, 7))
+    x[:, :4] = convert_bboxes_to_z(bboxes)
+    ids = np.arange(self.count, self.count + k)
+    self.count += k
+    zeros = np.zeros(k, dtype=int)
+    self.x = np.concatenate((self.x, x))
+    self.P = np.concatenate((self.P, np.repeat(self.P0[None], k, axis=0)))
+    self.ids = np.concatenate((self.ids, ids))
+    self.time_since_update = np.concatenate((self.time_since_update, zeros))
+    self.hits = np.concatenate((self.hits, zeros))
+    self.hit_streak = np.concatenate((self.hit_streak, zeros))
+    self.age = np.concatenate((self.age, zeros))
+
+  def keep(self, mask):
+    """
+    Keeps only the tracks selected by a boolean mask (or index array).
+    """
+    self.x = self.x[mask]
+    self.P = self.P[mask]
+    self.ids = self.ids[mask]
+    self.time_since_update = self.time_since_update[mask]
+    self.hits = self.hits[mask]
+    self.hit_streak = self.hit_streak[mask]
+    self.age = self.age[mask]
+
+  def predict(self, bookkeeping=True):
+    """
+    Advances every state vector and returns the (N,4) predicted bounding boxes.
+    With bookkeeping=False only the motion model runs and the hit/update counters
+    are left untouched (for frames where the detector was skipped).
+    """
+    self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] = 0.
+    self.x = self.x @ self.F.T
+    self.P = self.F @ self.P @ self.F.T + self.Q
+    if(bookkeeping):
+      self.age += 1
+      self.hit_streak[self.time_since_update > 0] = 0
+      self.time_since_update += 1
+    return self.get_state()
+
+  def update(self, indices, bboxes):
+    """
+    Updates the tracks at `indices` with their observed bboxes.
+    """
+    if(len(indices)==0):
+      return
+    x = self.x[indices]
+    P = self.P[indices]
+    y = convert_bboxes_to_z(bboxes) - x @ self.H.T
+    PHT = P @ self.H.T
+    S = self.H @ PHT + self.R
+    K = PHT @ np.linalg.inv(S)
+    x = x + (K @ y[..., None])[..., 0]
+    I_KH = np.eye(7) - K @ self.H
+    P = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ self.R @ K.transpose(0, 2, 1) #Joseph form, as filterpy
+    self.x[indices] = x
+    self.P[indices] = P
+    self.time_since_update[indices] = 0
+    self.hits[indices] += 1
+    self.hit_streak[indices] += 1
+
+  def get_state(self):
+    """
+    Returns the (N,4) current bounding box estimates.
+    """
+    return convert_xs_to_bboxes(self.x)
+
+
 def associate_detections_to_trackers(detections,trackers,iou_threshold = 0.3):
   """
   Assigns detections to tracked object (both represented as bounding boxes)
 
+  Only the pairs of overlapping boxes are considered (found with a sort-and-sweep broad
+  phase), and the assignment is solved for each group of boxes that overlap each other,
+  so the cost grows with the number of overlaps instead of detections x trackers.
+
   Returns 3 lists of matches, unmatched_detections and unmatched_trackers
   """
   if(len(trackers)==0):
     return np.empty((0,2),dtype=int), np.arange(len(detections)), np.empty((0,5),dtype=int)
 
-  iou_matrix = iou_batch(detections, trackers)
-
-  if min(iou_matrix.shape) > 0:
-    a = (iou_matrix > iou_threshold).astype(np.int32)
-    if a.sum(1).max() == 1 and a.sum(0).max() == 1:
-        matched_indices = np.stack(np.where(a), axis=1)
-    else:
-      matched_indices = linear_assignment(-iou_matrix)
+  dense = len(detections) * len(trackers) <= DENSE_PAIRS #few boxes, the broad phase does not pay off
+  if(dense):
+    iou_matrix = iou_batch(detections, trackers)
+    i, j = np.nonzero(iou_matrix > 0)
+    iou = iou_matrix[i, j]
   else:
-    matched_indices = np.empty(shape=(0,2))
-
-  unmatched_detections = []
-  for d, det in enumerate(detections):
-    if(d not in matched_indices[:,0]):
-      unmatched_detections.append(d)
-  unmatched_trackers = []
-  for t, trk in enumerate(trackers):
-    if(t not in matched_indices[:,1]):
-      unmatched_trackers.append(t)
-
-  #filter out matched with low IOU
-  matches = []
-  for m in matched_indices:
-    if(iou_matrix[m[0], m[1]]<iou_threshold):
-      unmatched_detections.append(m[0])
-      unmatched_trackers.append(m[1])
-    else:
-      matches.append(m.reshape(1,2))
-  if(len(matches)==0):
+    i, j = overlapping_pairs(detections[:, :4], trackers[:, :4])
+    iou = iou_pairs(detections[i, :4], trackers[j, :4])
+
+  above = iou > iou_threshold
+  if not np.any(above):
     matches = np.empty((0,2),dtype=int)
+  elif np.bincount(i[above]).max() == 1 and np.bincount(j[above]).max() == 1:
+    matches = np.stack((i[above], j[above]), axis=1)
   else:
-    matches = np.concatenate(matches,axis=0)
+    if(dense):
+      matches = linear_assignment(-iou_matrix)
+      ious = iou_matrix[matches[:, 0], matches[:, 1]]
+    else:
+      matches, ious = solve_components(i, j, iou)
+    #filter out matched with low IOU
+    matches = matches[ious >= iou_threshold]
+
+  unmatched_detections = np.ones(len(detections), dtype=bool)
+  unmatched_detections[matches[:, 0]] = False
+  unmatched_trackers = np.ones(len(trackers), dtype=bool)
+  unmatched_trackers[matches[:, 1]] = False
 
-  return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+  return matches, np.flatnonzero(unmatched_detections), np.flatnonzero(unmatched_trackers)
 
 
 class Sort(object):
@@ -204,8 +403,45 @@ class Sort(object):
     self.max_age = max_age
     self.min_hits = min_hits
     self.iou_threshold = iou_threshold
-    self.trackers = []
+    self.trackers = KalmanBoxBank()
     self.frame_count = 0
+    self.terminated = np.empty(0, dtype=int)
+
+  def live_ids(self):
+    """
+    Returns the object IDs (as reported by update) of the live tracks.
+    """
+    return self.trackers.ids + 1
+
+  def get_output(self):
+    """
+    Returns the [x1,y1,x2,y2,ID] rows of the tracks updated in the last detection frame
+    that are confirmed, newest trackers first as MOT output used to be built.
+    """
+    trackers = self.trackers
+    d = trackers.get_state()[::-1]
+    alive = (trackers.time_since_update < 1)[::-1]
+    confirmed = (trackers.hit_streak >= self.min_hits)[::-1] | (self.frame_count <= self.min_hits)
+    ids = trackers.ids[::-1]
+    out = alive & confirmed
+    return np.concatenate((d[out], ids[out, None] + 1), axis=1) # +1 as MOT benchmark requires positive
+
+  def predict(self):
+    """
+    Advances every track one frame with the motion model only, for frames where the
+    detector is skipped. Hit streaks and ages are left untouched, so max_age and
+    min_hits keep counting detection frames.
+    Returns the predicted boxes in the same format as update.
+    """
+    trks = self.trackers.predict(bookkeeping=False)
+    valid = ~np.any(np.isnan(trks), axis=1)
+    self.terminated = self.trackers.ids[~valid] + 1
+    if not np.all(valid):
+      self.trackers.keep(valid)
+    ret = self.get_output()
+    if(len(ret)>0):
+      return ret
+    return np.empty((0,5))
 
   def update(self, dets=np.empty((0, 5))):
     """
@@ -213,43 +449,37 @@ class Sort(object):
       dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
     Requires: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
     Returns the a similar array, where the last column is the object ID.
+    The IDs of the tracks terminated in this call are left in self.terminated.
 
     NOTE: The number of objects returned may differ from the number of detections provided.
     """
     self.frame_count += 1
     # get predicted locations from existing trackers.
-    trks = np.zeros((len(self.trackers), 5))
-    to_del = []
-    ret = []
-    for t, trk in enumerate(trks):
-      pos = self.trackers[t].predict()[0]
-      trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-      if np.any(np.isnan(pos)):
-        to_del.append(t)
-    trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-    for t in reversed(to_del):
-      self.trackers.pop(t)
+    trks = self.trackers.predict()
+    valid = ~np.any(np.isnan(trks), axis=1)
+    terminated = [self.trackers.ids[~valid]]
+    if not np.all(valid):
+      self.trackers.keep(valid)
+      trks = trks[valid]
+    trks = np.concatenate((trks, np.zeros((len(trks), 1))), axis=1)
     matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold)
 
     # update matched trackers with assigned detections
-    for m in matched:
-      self.trackers[m[1]].update(dets[m[0], :])
+    self.trackers.update(matched[:, 1], dets[matched[:, 0], :4])
 
     # create and initialise new trackers for unmatched detections
-    for i in unmatched_dets:
-        trk = KalmanBoxTracker(dets[i,:])
-        self.trackers.append(trk)
-    i = len(self.trackers)
-    for trk in reversed(self.trackers):
-        d = trk.get_state()[0]
-        if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
-          ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1)) # +1 as MOT benchmark requires positive
-        i -= 1
-        # remove dead tracklet
-        if(trk.time_since_update > self.max_age):
-          self.trackers.pop(i)
+    self.trackers.add(dets[unmatched_dets.astype(int), :4])
+
+    ret = self.get_output()
+
+    # remove dead tracklet
+    trackers = self.trackers
+    alive = trackers.time_since_update <= self.max_age
+    terminated.append(trackers.ids[~alive])
+    trackers.keep(alive)
+    self.terminated = np.concatenate(terminated) + 1 # IDs of the tracks terminated in this update
     if(len(ret)>0):
-      return np.concatenate(ret)
+      return ret
     return np.empty((0,5))
 
 def parse_args():
@@ -269,6 +499,12 @@ def parse_args():
     return args
 
 if __name__ == '__main__':
+  import matplotlib
+  # matplotlib.use('TkAgg')
+  import matplotlib.pyplot as plt
+  import matplotlib.patches as patches
+  from skimage import io
+
   # all train
   args = parse_args()
   display = args.display
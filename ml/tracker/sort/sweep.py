@@ -0,0 +1,239 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: SORT parameter sweep.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from time import time
+import argparse
+import glob
+import os
+
+import numpy as np
+
+from ml.tracker.sort.sort import Sort
+
+
+# Sequences loaded in each worker process
+SEQUENCES = {}
+
+
+def load_sequence(det_path):
+    """Loads a MOT det.txt file indexed by frame.
+
+    Parameters
+    ----------
+    det_path : str
+        Path to the det.txt file.
+
+    Returns
+    -------
+    list
+        List of [x1, y1, x2, y2, score] arrays, one per frame (frame
+        numbers begin at 1 in the file and at 0 in the list).
+    """
+
+    seq_dets = np.loadtxt(det_path, delimiter=',', ndmin=2)
+    seq_dets = seq_dets[np.argsort(seq_dets[:, 0], kind='stable')]
+
+    frames = seq_dets[:, 0].astype(int)
+    dets = seq_dets[:, 2:7].copy()
+    dets[:, 2:4] += dets[:, 0:2]  # [x1, y1, w, h] to [x1, y1, x2, y2]
+
+    bounds = np.searchsorted(frames, np.arange(1, frames.max() + 2))
+
+    return [dets[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def load_sequences(seq_path='data', phase='train'):
+    """Loads every det.txt sequence of a MOT directory.
+
+    Parameters
+    ----------
+    seq_path : str
+        Path to detections.
+    phase : str
+        Subdirectory in seq_path.
+
+    Returns
+    -------
+    dict
+        Sequence name -> frames, as returned by `load_sequence`.
+    """
+
+    pattern = os.path.join(seq_path, phase, '*', 'det', 'det.txt')
+    sequences = {}
+
+    for det_path in sorted(glob.glob(pattern)):
+        name = det_path[pattern.find('*'):].split(os.path.sep)[0]
+        sequences[name] = load_sequence(det_path)
+
+    return sequences
+
+
+def init_worker(sequences):
+    """Keeps the sequences in the worker process."""
+
+    SEQUENCES.update(sequences)
+
+
+def run_config(config, output_dir='output'):
+    """Runs SORT with a configuration over every loaded sequence.
+
+    Parameters
+    ----------
+    config : tuple
+        (max_age, min_hits, iou_threshold).
+    output_dir : str
+        Directory where the tracking outputs are written.
+
+    Returns
+    -------
+    dict
+        Configuration, number of frames, tracking time, FPS and output
+        directory.
+    """
+
+    max_age, min_hits, iou_threshold = config
+    name = f'age{max_age}_hits{min_hits}_iou{iou_threshold}'
+    config_dir = os.path.join(output_dir, name)
+    os.makedirs(config_dir, exist_ok=True)
+
+    total_time = 0.
+    total_frames = 0
+
+    for seq, frames in SEQUENCES.items():
+        mot_tracker = Sort(max_age=max_age,
+                           min_hits=min_hits,
+                           iou_threshold=iou_threshold)
+        lines = []
+
+        for frame, dets in enumerate(frames, start=1):
+            start = time()
+            trackers = mot_tracker.update(dets)
+            total_time += time() - start
+            total_frames += 1
+
+            for d in trackers:
+                lines.append(f'{frame:d},{d[4]:.0f},{d[0]:.2f},{d[1]:.2f},'
+                             f'{d[2] - d[0]:.2f},{d[3] - d[1]:.2f},1,-1,-1,-1')
+
+        with open(os.path.join(config_dir, f'{seq}.txt'), 'w') as out_file:
+            out_file.write('\n'.join(lines) + '\n' if lines else '')
+
+    return {'max_age': max_age,
+            'min_hits': min_hits,
+            'iou_threshold': iou_threshold,
+            'frames': total_frames,
+            'time': total_time,
+            'fps': total_frames / total_time if total_time else 0.,
+            'output': config_dir}
+
+
+def sweep(sequences, grid, output_dir='output', workers=None):
+    """Runs a grid of SORT configurations across a process pool.
+
+    Parameters
+    ----------
+    sequences : dict
+        Sequence name -> frames, as returned by `load_sequences`.
+    grid : list
+        List of (max_age, min_hits, iou_threshold) configurations.
+    output_dir : str
+        Directory where the tracking outputs are written.
+    workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    list
+        Results of `run_config`, in the order of `grid`.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(sequences,)) as executor:
+        futures = [executor.submit(run_config, config, output_dir)
+                   for config in grid]
+
+        return [future.result() for future in futures]
+
+
+def write_summary(results, summary_path):
+    """Writes the sweep results as a CSV table.
+
+    Parameters
+    ----------
+    results : list
+        Results of `run_config`.
+    summary_path : str
+        Path to the CSV file.
+    """
+
+    columns = ['max_age', 'min_hits', 'iou_threshold', 'frames', 'time',
+               'fps', 'output']
+
+    with open(summary_path, 'w') as summary_file:
+        summary_file.write(','.join(columns) + '\n')
+
+        for result in results:
+            row = [str(result[column]) for column in columns]
+            summary_file.write(','.join(row) + '\n')
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(description='SORT parameter sweep')
+    parser.add_argument('--seq_path', help='Path to detections.', type=str,
+                        default='data')
+    parser.add_argument('--phase', help='Subdirectory in seq_path.', type=str,
+                        default='train')
+    parser.add_argument('--max_age', help='Values of max_age.', type=int,
+                        nargs='+', default=[1])
+    parser.add_argument('--min_hits', help='Values of min_hits.', type=int,
+                        nargs='+', default=[3])
+    parser.add_argument('--iou_threshold', help='Values of iou_threshold.',
+                        type=float, nargs='+', default=[0.3])
+    parser.add_argument('--output', help='Output directory.', type=str,
+                        default='output')
+    parser.add_argument('--workers', help='Number of worker processes.',
+                        type=int, default=None)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Main function."""
+
+    args = parse_args()
+
+    start = time()
+    sequences = load_sequences(args.seq_path, args.phase)
+    print(f'[INFO] Loaded {len(sequences)} sequences in '
+          f'{time() - start:.3f} s.')
+
+    grid = list(product(args.max_age, args.min_hits, args.iou_threshold))
+    results = sweep(sequences, grid, args.output, args.workers)
+
+    print(f'{"max_age":>8} {"min_hits":>8} {"iou":>6} {"frames":>8} '
+          f'{"fps":>10}  output')
+    for result in results:
+        print(f'{result["max_age"]:>8} {result["min_hits"]:>8} '
+              f'{result["iou_threshold"]:>6} {result["frames"]:>8} '
+              f'{result["fps"]:>10.1f}  {result["output"]}')
+
+    summary_path = os.path.join(args.output, 'summary.csv')
+    write_summary(results, summary_path)
+    print(f'[INFO] Summary saved to {summary_path}')
+
+
+if __name__ == '__main__':
+    main()
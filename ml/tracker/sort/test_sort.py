@@ -0,0 +1,181 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the SORT tracker against the upstream implementation.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from ml.tracker.sort import sort
+from ml.tracker.sort.sort import KalmanBoxTracker
+from ml.tracker.sort.sort import Sort
+from ml.tracker.sort.sort import associate_detections_to_trackers
+from ml.tracker.sort.sort import iou_batch
+from ml.tracker.sort.sort import iou_pairs
+from ml.tracker.sort.sort import linear_assignment
+from ml.tracker.sort.sort import overlapping_pairs
+from ml.tracker.sort.sweep import load_sequence
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'train')
+SEQUENCES = sorted(glob.glob(os.path.join(DATA, '*', 'det', 'det.txt')))
+
+
+class ReferenceSort:
+    """Upstream SORT: one filterpy tracker per track, dense association."""
+
+    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        self.trackers = []
+        self.frame_count = 0
+
+    def associate(self, dets, trks):
+        if not len(trks):
+            return np.empty((0, 2), dtype=int), np.arange(len(dets))
+
+        iou_matrix = iou_batch(dets, trks)
+
+        if min(iou_matrix.shape) > 0:
+            above = (iou_matrix > self.iou_threshold).astype(np.int32)
+
+            if above.sum(1).max() == 1 and above.sum(0).max() == 1:
+                matched = np.stack(np.where(above), axis=1)
+            else:
+                matched = linear_assignment(-iou_matrix)
+        else:
+            matched = np.empty((0, 2), dtype=int)
+
+        matches = [m for m in matched
+                   if iou_matrix[m[0], m[1]] >= self.iou_threshold]
+        unmatched = [d for d in range(len(dets))
+                     if d not in [m[0] for m in matches]]
+
+        return matches, unmatched
+
+    def update(self, dets):
+        self.frame_count += 1
+        trks = np.zeros((len(self.trackers), 5))
+        to_del = []
+
+        for t, trk in enumerate(trks):
+            pos = self.trackers[t].predict()[0]
+            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
+
+            if np.any(np.isnan(pos)):
+                to_del.append(t)
+
+        trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
+
+        for t in reversed(to_del):
+            self.trackers.pop(t)
+
+        matches, unmatched = self.associate(dets, trks)
+
+        for d, t in matches:
+            self.trackers[t].update(dets[d, :])
+
+        for d in unmatched:
+            self.trackers.append(KalmanBoxTracker(dets[d, :]))
+
+        ret = []
+        i = len(self.trackers)
+
+        for trk in reversed(self.trackers):
+            d = trk.get_state()[0]
+
+            if trk.time_since_update < 1 and \
+                    (trk.hit_streak >= self.min_hits or
+                     self.frame_count <= self.min_hits):
+                ret.append(np.concatenate((d, [trk.id + 1])))
+
+            i -= 1
+
+            if trk.time_since_update > self.max_age:
+                self.trackers.pop(i)
+
+        return np.array(ret).reshape(-1, 5)
+
+
+def random_boxes(rng, n, size=1000., scale=80.):
+    """Random [x1, y1, x2, y2] boxes."""
+
+    xy = rng.uniform(0, size, (n, 2))
+    wh = rng.uniform(2, scale, (n, 2))
+
+    return np.concatenate((xy, xy + wh), axis=1)
+
+
+def test_overlapping_pairs_match_dense_iou():
+    rng = np.random.default_rng(0)
+
+    for n, m in [(1, 1), (5, 40), (60, 60), (200, 150), (0, 10), (10, 0)]:
+        a, b = random_boxes(rng, n), random_boxes(rng, m)
+
+        # Touching and identical boxes, whose IOU is 0 and 1
+        if n and m:
+            a[0] = b[0]
+            a[-1] = [b[-1, 2], b[-1, 1], b[-1, 2] + 10, b[-1, 3]]
+
+        i, j = overlapping_pairs(a, b)
+        dense = iou_batch(a, b).reshape(n, m)
+        expected = np.argwhere(dense > 0)
+        pairs = np.stack((i, j), axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+        np.testing.assert_array_equal(pairs, expected)
+        np.testing.assert_allclose(iou_pairs(a[i], b[j]), dense[i, j])
+
+
+def test_sparse_association_matches_dense(monkeypatch):
+    rng = np.random.default_rng(1)
+    dets = random_boxes(rng, 120, size=600.)
+    trks = dets + rng.normal(0, 4, dets.shape)
+    trks = trks[rng.permutation(len(trks))][:100]
+
+    monkeypatch.setattr(sort, 'DENSE_PAIRS', 10 ** 9)
+    dense = associate_detections_to_trackers(dets, trks, 0.3)
+    monkeypatch.setattr(sort, 'DENSE_PAIRS', 0)
+    sparse = associate_detections_to_trackers(dets, trks, 0.3)
+
+    def matched(matches):
+        return matches[np.argsort(matches[:, 0])]
+
+    np.testing.assert_array_equal(matched(sparse[0]), matched(dense[0]))
+    np.testing.assert_array_equal(sparse[1], dense[1])
+    np.testing.assert_array_equal(sparse[2], dense[2])
+
+
+@pytest.mark.parametrize('params', [(1, 3, 0.3), (10, 2, 0.25)])
+def test_matches_upstream_sort_on_mot_sequences(params):
+    assert len(SEQUENCES) == 11
+
+    for det_path in SEQUENCES:
+        reference, tracker = ReferenceSort(*params), Sort(*params)
+        ids = {}
+
+        for frame, dets in enumerate(load_sequence(det_path)):
+            expected = reference.update(dets)
+            output = tracker.update(dets)
+
+            assert output.shape == expected.shape, (det_path, frame)
+            np.testing.assert_allclose(output[:, :4], expected[:, :4],
+                                       atol=1e-6, err_msg=det_path)
+
+            # Both trackers start their IDs elsewhere, but the same tracks
+            # must keep the same IDs
+            for reference_id, track_id in zip(expected[:, 4], output[:, 4]):
+                assert ids.setdefault(reference_id, track_id) == track_id
+
+        assert len(set(ids.values())) == len(ids), det_path
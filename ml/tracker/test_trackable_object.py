@@ -0,0 +1,83 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Tests of the trackable object history.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import numpy as np
+
+from ml.tracker.trackable_object import TrackableObject
+
+
+def path(length):
+    """Distinct (x, y) centroids of a moving object."""
+
+    return [(3 * step, 100 + step) for step in range(length)]
+
+
+def test_history_before_wrap_around():
+    centroids = path(5)
+    trackable_object = TrackableObject(1, centroids[0], history_size=8)
+
+    for centroid in centroids[1:]:
+        trackable_object.add(centroid)
+
+    assert trackable_object.count == 5
+    np.testing.assert_array_equal(trackable_object.centroids, centroids)
+    assert tuple(trackable_object.centroid) == centroids[-1]
+
+
+def test_history_wraps_around():
+    for length in (8, 9, 16, 17, 50):
+        centroids = path(length)
+        trackable_object = TrackableObject(1, centroids[0], history_size=8)
+
+        for centroid in centroids[1:]:
+            trackable_object.add(centroid)
+
+        assert trackable_object.count == length
+        np.testing.assert_array_equal(trackable_object.centroids,
+                                      centroids[-8:])
+        assert tuple(trackable_object.centroid) == centroids[-1]
+
+
+def test_spill_keeps_full_history(tmp_path):
+    spill_path = str(tmp_path / 'history.bin')
+    centroids = path(37)
+    trackable_object = TrackableObject(1, centroids[0], history_size=8,
+                                       spill_path=spill_path)
+
+    for centroid in centroids[1:]:
+        trackable_object.add(centroid)
+
+    # Only full buffers are spilled while adding, never a centroid twice
+    assert trackable_object.spilled == 32
+    np.testing.assert_array_equal(
+        TrackableObject.load_history(spill_path), centroids[:32])
+
+    trackable_object.flush()
+    trackable_object.flush()
+
+    assert trackable_object.spilled == 37
+    np.testing.assert_array_equal(
+        TrackableObject.load_history(spill_path), centroids)
+    np.testing.assert_array_equal(trackable_object.centroids,
+                                  centroids[-8:])
+
+
+def test_no_spill_without_path(tmp_path):
+    trackable_object = TrackableObject(1, (0, 0), history_size=2)
+
+    for centroid in path(10):
+        trackable_object.add(centroid)
+
+    trackable_object.flush()
+
+    assert trackable_object.spilled == 0
+    assert not list(tmp_path.iterdir())
@@ -10,22 +10,107 @@
 # according to the license provided and its conditions.
 # ============================================================================
 
+import numpy as np
+
 
 class TrackableObject:
-    """Trackable Object."""
+    """Trackable Object.
+
+    Keeps only the most recent centroids in a fixed-size ring buffer, so
+    updating it costs the same no matter how long the object has been
+    visible. The full history can optionally be spilled to a binary file of
+    int32 (x, y) pairs.
+    """
 
-    def __init__(self, objectID, centroid):
+    __slots__ = ('objectID', 'counted', 'counted_in', 'count', 'buffer',
+                 'spilled', 'spill_path')
+
+    def __init__(self,
+                 objectID,
+                 centroid,
+                 history_size=32,
+                 spill_path=None):
         """Class constructor
-        
+
         Parameters
         ----------
         object_id : int
             The ID of the object to be tracked.
         centroid : tuple
             The centroid of the object.
+        history_size : int
+            Number of recent centroids kept in memory.
+        spill_path : str
+            Path to a file where the full history is appended.
         """
 
         self.objectID = objectID
-        self.centroids = [centroid]
-        self.init_position = False
-        self.counted = False
\ No newline at end of file
+        self.counted = False
+        self.counted_in = ()
+        self.count = 0
+        self.buffer = np.empty((history_size, 2), dtype=np.int32)
+        self.spilled = 0
+        self.spill_path = spill_path
+        self.add(centroid)
+
+    @property
+    def centroids(self):
+        """Recent centroids, oldest first."""
+
+        size = len(self.buffer)
+        if self.count <= size:
+            return self.buffer[:self.count]
+
+        start = self.count % size
+        return np.concatenate((self.buffer[start:], self.buffer[:start]))
+
+    @property
+    def centroid(self):
+        """Last centroid."""
+
+        return self.buffer[(self.count - 1) % len(self.buffer)]
+
+    def add(self, centroid):
+        """Adds a centroid to the history.
+
+        Parameters
+        ----------
+        centroid : tuple
+            The centroid of the object.
+        """
+
+        size = len(self.buffer)
+        if self.spill_path is not None and self.count - self.spilled == size:
+            self.flush()
+
+        self.buffer[self.count % size] = centroid
+        self.count += 1
+
+    def flush(self):
+        """Appends the centroids not yet spilled to `spill_path`."""
+
+        pending = self.count - self.spilled
+        if self.spill_path is None or not pending:
+            return
+
+        with open(self.spill_path, 'ab') as spill_file:
+            self.centroids[-pending:].tofile(spill_file)
+
+        self.spilled = self.count
+
+    @staticmethod
+    def load_history(spill_path):
+        """Loads a history spilled to disk.
+
+        Parameters
+        ----------
+        spill_path : str
+            Path to the spilled history.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of (x, y) centroids.
+        """
+
+        return np.fromfile(spill_path, dtype=np.int32).reshape(-1, 2)
@@ -0,0 +1,296 @@
+# ============================================================================
+# Author: Rodolfo Ferro @ Datlacuache
+# Twitter: @rodo_ferro
+#
+# Script: Counting lines and zones.
+#
+# ABOUT COPYING OR USING PARTIAL INFORMATION:
+# This script was originally created by Rodolfo Ferro. Any
+# explicit usage of this script or its contents is granted
+# according to the license provided and its conditions.
+# ============================================================================
+
+import numpy as np
+import cv2
+
+
+class CountingLine:
+    """Line segment that counts the objects crossing it."""
+
+    def __init__(self,
+                 start,
+                 end,
+                 direction=None,
+                 name='line',
+                 normalized=True):
+        """Class constructor.
+
+        Parameters
+        ----------
+        start : tuple
+            (x, y) start point of the segment.
+        end : tuple
+            (x, y) end point of the segment.
+        direction : tuple
+            (dx, dy) vector. Only crossings moving along it are counted. If
+            None, crossings in both directions are counted.
+        name : str
+            Name of the counter.
+        normalized : bool
+            Whether the points are given relative to the frame size.
+        """
+
+        self.start = np.asarray(start, dtype=float)
+        self.end = np.asarray(end, dtype=float)
+        self.direction = direction
+        self.name = name
+        self.normalized = normalized
+
+
+class CountingZone:
+    """Polygon that counts the objects entering it."""
+
+    def __init__(self, polygon, name='zone', normalized=True):
+        """Class constructor.
+
+        Parameters
+        ----------
+        polygon : list
+            List of (x, y) vertices.
+        name : str
+            Name of the counter.
+        normalized : bool
+            Whether the vertices are given relative to the frame size.
+        """
+
+        self.polygon = np.asarray(polygon, dtype=float)
+        self.name = name
+        self.normalized = normalized
+
+
+def cross(a, b):
+    """2D cross product of the last axis of two arrays."""
+
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def segments_intersect(p0, p1, q0, q1):
+    """Tests every segment p0->p1 against every segment q0->q1.
+
+    Parameters
+    ----------
+    p0, p1 : numpy.ndarray
+        (N, 2) start and end points of the first segments.
+    q0, q1 : numpy.ndarray
+        (L, 2) start and end points of the second segments.
+
+    Returns
+    -------
+    numpy.ndarray
+        (N, L) boolean matrix. A segment p that ends exactly on q counts as
+        crossing it, one that starts on it does not.
+    """
+
+    r = (p1 - p0)[:, None]
+    s = (q1 - q0)[None]
+    qp = q0[None] - p0[:, None]
+    denom = cross(r, s)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = cross(qp, s) / denom
+        u = cross(qp, r) / denom
+
+    return (denom != 0) & (t > 0) & (t <= 1) & (u >= 0) & (u <= 1)
+
+
+def points_in_polygon(points, polygon):
+    """Ray casting test of many points against a polygon.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        (N, 2) points.
+    polygon : numpy.ndarray
+        (V, 2) vertices.
+
+    Returns
+    -------
+    numpy.ndarray
+        (N,) boolean array.
+    """
+
+    x, y = points[:, 0:1], points[:, 1:2]
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    straddles = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+
+    return np.count_nonzero(straddles & (x < x_cross), axis=1) % 2 == 1
+
+
+class Counter:
+    """Set of counting lines and zones, each with its own count."""
+
+    def __init__(self, lines=(), zones=()):
+        """Class constructor.
+
+        Parameters
+        ----------
+        lines : list
+            List of CountingLine.
+        zones : list
+            List of CountingZone.
+        """
+
+        self.lines = list(lines)
+        self.zones = list(zones)
+        self.names = [item.name for item in self.lines + self.zones]
+
+        if len(set(self.names)) != len(self.names):
+            raise ValueError(f'Names of lines and zones must be unique, '
+                             f'got {self.names}.')
+
+        self.counts = {name: 0 for name in self.names}
+        self.events = []
+        self.frame_size = None
+
+    @property
+    def total(self):
+        """Total of counted objects over every line and zone."""
+
+        return sum(self.counts.values())
+
+    def scale(self, frame_size):
+        """Scales the geometry to pixels, once per frame size.
+
+        Parameters
+        ----------
+        frame_size : tuple
+            (width, height) of the frames.
+        """
+
+        if frame_size == self.frame_size:
+            return
+
+        size = np.array(frame_size, dtype=float)
+
+        def pixels(points, normalized):
+            return points * size if normalized else points
+
+        self.frame_size = frame_size
+        self.starts = np.array([pixels(line.start, line.normalized)
+                                for line in self.lines]).reshape(-1, 2)
+        self.ends = np.array([pixels(line.end, line.normalized)
+                              for line in self.lines]).reshape(-1, 2)
+        self.directions = np.array([line.direction or (0, 0)
+                                    for line in self.lines],
+                                   dtype=float).reshape(-1, 2)
+        self.directed = np.array([line.direction is not None
+                                  for line in self.lines], dtype=bool)
+        self.polygons = [pixels(zone.polygon, zone.normalized)
+                         for zone in self.zones]
+
+    def update(self, objects, previous, current, frame_size):
+        """Counts the objects crossing lines or entering zones.
+
+        Parameters
+        ----------
+        objects : list
+            List of TrackableObject, each one counted at most once per line
+            or zone.
+        previous : numpy.ndarray
+            (N, 2) previous centroids of the objects.
+        current : numpy.ndarray
+            (N, 2) current centroids of the objects.
+        frame_size : tuple
+            (width, height) of the frames.
+
+        Returns
+        -------
+        list
+            List of (TrackableObject, name) counting events. They are also
+            kept in `events` until the next update.
+        """
+
+        events = []
+        self.events = events
+
+        if not len(objects):
+            return events
+
+        self.scale(frame_size)
+        previous = np.asarray(previous, dtype=float)
+        current = np.asarray(current, dtype=float)
+
+        hits = np.zeros((len(objects), 0), dtype=bool)
+        if len(self.lines):
+            hits = segments_intersect(previous, current, self.starts,
+                                      self.ends)
+            moving = (current - previous) @ self.directions.T > 0
+            hits &= moving | ~self.directed
+
+        for polygon in self.polygons:
+            entered = points_in_polygon(current, polygon) & \
+                ~points_in_polygon(previous, polygon)
+            hits = np.concatenate((hits, entered[:, None]), axis=1)
+
+        for index, item in zip(*np.nonzero(hits)):
+            trackable_object = objects[index]
+            name = self.names[item]
+
+            if name in trackable_object.counted_in:
+                continue
+
+            trackable_object.counted_in += (name,)
+            trackable_object.counted = True
+            self.counts[name] += 1
+            events.append((trackable_object, name))
+
+        return events
+
+    def draw(self, image, color=(245, 135, 66)):
+        """Draws the lines and zones.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            Image to draw on.
+        color : tuple
+            Color of the lines and zones.
+
+        Returns
+        -------
+        numpy.ndarray
+            Image with lines and zones.
+        """
+
+        height, width, _ = image.shape
+        self.scale((width, height))
+
+        for start, end in zip(self.starts, self.ends):
+            cv2.line(image, tuple(int(v) for v in start),
+                     tuple(int(v) for v in end), color, 2)
+
+        for polygon in self.polygons:
+            cv2.polylines(image, [polygon.astype(np.int32)], True, color, 2)
+
+        return image
+
+
+def default_counter():
+    """Counter with the default line.
+
+    Returns
+    -------
+    Counter
+        Counter with a vertical line at 15/16 of the frame width, counting
+        the objects moving right.
+    """
+
+    line = CountingLine((15 / 16, 0), (15 / 16, 1),
+                        direction=(1, 0),
+                        name='Right exit')
+
+    return Counter(lines=[line])